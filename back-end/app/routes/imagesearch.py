@@ -1,37 +1,242 @@
 # app/routes/imagesearch.py
-from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
-from typing import List, Dict, Any
+from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Query, Response
+from fastapi.responses import JSONResponse
+import asyncio
+import os
+from typing import List, Dict, Any, Optional
 
 from app.database import get_database
-from app.services.imagesearch_service import ImageSearchService
+from app.services.auth import verify_admin_token
+from app.schemas.imagesearch import ImageSearchBatchResult, ImageSearchFilters
+from app.services.image_io import read_upload
+from app.services.search_sessions import SEARCH_SESSION_DEPTH, search_page, start_search
 
 router = APIRouter()
 
+# "local" runs CLIP and the index inside this worker; "remote" forwards image
+# search to a separate process (python -m app.services.inference_server), so
+# API workers never import torch
+IMAGE_SEARCH_MODE = os.getenv("IMAGE_SEARCH_MODE", "local")
+# Images accepted by one batch search request
+MAX_BATCH_IMAGES = int(os.getenv("IMAGE_SEARCH_MAX_BATCH_IMAGES", "8"))
+
 # Create image search service with dependency injection
 image_search_service = None
 
+def get_image_search_service(db):
+    """Return the shared service, creating it on first use."""
+    global image_search_service
+    if image_search_service is None:
+        if IMAGE_SEARCH_MODE == "remote":
+            from app.services.inference_client import RemoteImageSearch
+            image_search_service = RemoteImageSearch(db)
+        else:
+            # Imported lazily: loading torch and CLIP is slow and memory-hungry
+            from app.services.imagesearch_service import ImageSearchService
+            image_search_service = ImageSearchService(db)
+    return image_search_service
+
+async def warm_up(db):
+    """Load the CLIP model and build the index in the background at startup."""
+    service = get_image_search_service(db)
+    try:
+        await service.initialize()
+    except Exception as e:
+        print(f"Image search warm-up failed: {e}")
+
+async def shut_down():
+    """Save image search state that only lives in memory before the process exits."""
+    if image_search_service is None or IMAGE_SEARCH_MODE == "remote":
+        return
+    await image_search_service.flush_store()
+
+def search_filters(
+    gender: Optional[str] = Query(None),
+    subcategory: Optional[str] = Query(None),
+    product_type: Optional[str] = Query(None),
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+) -> ImageSearchFilters:
+    """Catalog filters shared by the search endpoints, from query parameters."""
+    return ImageSearchFilters(
+        gender=gender,
+        subcategory=subcategory,
+        product_type=product_type,
+        min_price=min_price,
+        max_price=max_price,
+    )
+
+def _not_ready(service) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail=f"Image search is not ready yet ({service.state})",
+        headers={"Retry-After": "30"},
+    )
+
+async def sync_product_index(product_id: str):
+    """Update a product's image-search entry after it was added or its status changed.
+
+    Meant to run as a background task; does nothing until the service exists,
+    since the first initialize() picks up every product anyway.
+    """
+    if image_search_service is None:
+        return
+    try:
+        await image_search_service.sync_product(product_id)
+    except Exception as e:
+        print(f"Error updating image index for product {product_id}: {e}")
+
 @router.post("/search", response_model=List[Dict[Any, Any]])
 async def search_similar_products(
+    response: Response,
     file: UploadFile = File(...),
     limit: int = 12,
+    filters: ImageSearchFilters = Depends(search_filters),
     db = Depends(get_database)
 ):
-    """Search for similar products based on uploaded image."""
-    global image_search_service
-    
-    # Initialize service on first use
-    if image_search_service is None:
-        image_search_service = ImageSearchService(db)
+    """Search for similar approved products based on uploaded image, optionally filtered.
+
+    Returns up to ``limit`` results, ranked among the closest CLIP matches as
+    they always were. When there are more, the X-Search-Id header names the
+    ranked list kept for GET /results/{search_id}, whose later pages start at
+    the number of results returned here; X-Total-Count is the number of
+    results across all pages.
+    """
+    service = get_image_search_service(db)
+    if not service.is_initialized:
+        # Start warming up if startup did not, but never make this request wait for it
+        if service.state in ("idle", "failed"):
+            asyncio.create_task(warm_up(db))
+        raise _not_ready(service)
         
     if not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
     
     try:
-        # Initialize service if not already initialized
-        if not image_search_service.is_initialized:
-            await image_search_service.initialize()
-            
-        similar_products = await image_search_service.find_similar_products(file, top_k=limit)
+        image_data = await read_upload(file)
+        first_page = await service.rank_image(image_data, top_k=limit, filters=filters)
+        # Later pages continue from a deeper ranking (the query embedding is cached by now)
+        deeper = await service.rank_image(
+            image_data, top_k=SEARCH_SESSION_DEPTH, top_n_clip=SEARCH_SESSION_DEPTH, filters=filters
+        )
+        shown = {product_id for product_id, _ in first_page}
+        ranked = first_page + [(product_id, score) for product_id, score in deeper if product_id not in shown]
+        similar_products, search_id = await start_search(db, ranked, len(first_page), filters.status)
+        if search_id is not None:
+            response.headers["X-Search-Id"] = search_id
+        response.headers["X-Total-Count"] = str(len(ranked))
         return similar_products
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing search: {str(e)}")
+
+@router.get("/results/{search_id}", response_model=List[Dict[Any, Any]])
+async def get_search_results(
+    search_id: str,
+    response: Response,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(12, ge=1),
+    db = Depends(get_database)
+):
+    """Another page of an earlier image search, without re-encoding the image."""
+    products, total = await search_page(db, search_id, offset, limit)
+    response.headers["X-Total-Count"] = str(total)
+    return products
+
+@router.post("/search/batch", response_model=List[ImageSearchBatchResult])
+async def search_similar_products_batch(
+    files: List[UploadFile] = File(...),
+    limit: int = Query(12, ge=1),
+    filters: ImageSearchFilters = Depends(search_filters),
+    db = Depends(get_database)
+):
+    """Search for products similar to each of several uploaded images, e.g. the pieces of an outfit.
+
+    The images are encoded and scored together; results come back per image, in upload order.
+    """
+    service = get_image_search_service(db)
+    if not service.is_initialized:
+        if service.state in ("idle", "failed"):
+            asyncio.create_task(warm_up(db))
+        raise _not_ready(service)
+    if len(files) > MAX_BATCH_IMAGES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IMAGES} images per request")
+    for position, file in enumerate(files):
+        if not file.content_type.startswith('image/'):
+            raise HTTPException(status_code=400, detail=f"File {position + 1} must be an image")
+    try:
+        results = await service.find_similar_products_batch(files, top_k=limit, filters=filters)
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing search: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error processing search: {str(e)}")
+    return [
+        {"index": position, "filename": file.filename, "results": products}
+        for position, (file, products) in enumerate(zip(files, results))
+    ]
+
+@router.get("/text", response_model=List[Dict[Any, Any]])
+async def search_products_by_text(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(12, ge=1),
+    filters: ImageSearchFilters = Depends(search_filters),
+    db = Depends(get_database)
+):
+    """Search approved products by a free-text description, e.g. "maroon embroidered sherwani"."""
+    service = get_image_search_service(db)
+    if not service.is_initialized:
+        if service.state in ("idle", "failed"):
+            asyncio.create_task(warm_up(db))
+        raise _not_ready(service)
+    try:
+        return await service.find_products_by_text(q, top_k=limit, filters=filters)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing search: {str(e)}")
+
+@router.get("/ready")
+async def readiness():
+    """Readiness probe: 200 once the model and index are loaded, 503 until then."""
+    if image_search_service is None:
+        return JSONResponse(status_code=503, content={"ready": False, "state": "idle"})
+    status = image_search_service.status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+@router.get("/cache-stats")
+async def get_cache_stats():
+    """Hit/miss counters of the image search query caches."""
+    if image_search_service is None:
+        return {"initialized": False}
+    stats = image_search_service.cache_stats()
+    # The remote client has to ask the inference server
+    return await stats if asyncio.iscoroutine(stats) else stats
+
+@router.get("/admin/index")
+async def get_index_generations(authorized: bool = Depends(verify_admin_token), db = Depends(get_database)):
+    """Published index generations with their model and preprocessing versions, and the one being served."""
+    service = get_image_search_service(db)
+    if not service.is_initialized:
+        raise _not_ready(service)
+    generations = service.index_generations()
+    return await generations if asyncio.iscoroutine(generations) else generations
+
+@router.post("/admin/index/rebuild", status_code=202)
+async def rebuild_index(authorized: bool = Depends(verify_admin_token), db = Depends(get_database)):
+    """Rebuild the index from the catalog in the background; the current one serves until it is done."""
+    service = get_image_search_service(db)
+    status = service.start_rebuild()
+    return await status if asyncio.iscoroutine(status) else status
+
+@router.post("/admin/index/rollback")
+async def rollback_index(
+    generation: Optional[str] = Query(None, description="Generation to serve; default: the one before the current one"),
+    authorized: bool = Depends(verify_admin_token),
+    db = Depends(get_database)
+):
+    """Switch every worker back to an earlier published index generation."""
+    service = get_image_search_service(db)
+    if not service.is_initialized:
+        raise _not_ready(service)
+    return {"generation": await service.rollback_index(generation)}
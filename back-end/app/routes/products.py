@@ -1,5 +1,8 @@
-from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi import APIRouter, Depends, Query, HTTPException, BackgroundTasks
 from app.database import get_database
+from app.routes.imagesearch import sync_product_index
+from app.services.product_neighbours import NEIGHBOUR_COUNT, NEIGHBOURS_COLLECTION
+from app.services.search_results import fetch_ranked_products
 from bson import ObjectId
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
@@ -73,7 +76,7 @@ async def get_products(
 
 
 @router.post("/add")
-async def add_product(product: Product, db=Depends(get_database)):
+async def add_product(product: Product, background_tasks: BackgroundTasks, db=Depends(get_database)):
     collection = db["products"]
     product_dict = product.dict()
     product_dict["_id"] = ObjectId()
@@ -81,11 +84,12 @@ async def add_product(product: Product, db=Depends(get_database)):
 
     result = await collection.insert_one(product_dict)
     if result.inserted_id:
+        background_tasks.add_task(sync_product_index, str(result.inserted_id))
         return {"message": "Product added successfully", "product_id": str(result.inserted_id)}
     raise HTTPException(status_code=500, detail="Failed to add product")
 
 @router.patch("/{product_id}/approve")
-async def approve_product(product_id: str, db=Depends(get_database)):
+async def approve_product(product_id: str, background_tasks: BackgroundTasks, db=Depends(get_database)):
     collection = db["products"]
     result = await collection.update_one(
         {"_id": ObjectId(product_id)},
@@ -93,10 +97,11 @@ async def approve_product(product_id: str, db=Depends(get_database)):
     )
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    background_tasks.add_task(sync_product_index, product_id)
     return {"message": "Product approved successfully"}
 
 @router.patch("/{product_id}/disapprove")
-async def disapprove_product(product_id: str, db=Depends(get_database)):
+async def disapprove_product(product_id: str, background_tasks: BackgroundTasks, db=Depends(get_database)):
     collection = db["products"]
     result = await collection.update_one(
         {"_id": ObjectId(product_id)},
@@ -104,6 +109,7 @@ async def disapprove_product(product_id: str, db=Depends(get_database)):
     )
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    background_tasks.add_task(sync_product_index, product_id)
     return {"message": "Product disapproved successfully"}
 
 @router.get("/pending")
@@ -137,6 +143,24 @@ async def get_all_products(db=Depends(get_database)):
     for product in products:
         product["_id"] = str(product["_id"])  # Convert ObjectId to string
     return {"products": products}
+
+@router.get("/{product_id}/similar")
+async def get_similar_products(
+    product_id: str,
+    limit: int = Query(12, ge=1, le=NEIGHBOUR_COUNT),
+    db=Depends(get_database)
+):
+    """Visually similar approved products, from the precomputed neighbour lists."""
+    if not ObjectId.is_valid(product_id):
+        raise HTTPException(status_code=404, detail="Product not found")
+    entry = await db[NEIGHBOURS_COLLECTION].find_one({"_id": ObjectId(product_id)})
+    if entry is None:
+        return []
+    ranked = [(neighbour["product_id"], neighbour["score"]) for neighbour in entry["neighbours"]]
+    products = await fetch_ranked_products(db, ranked)
+    # A neighbour may have been disapproved since its list was computed
+    return [product for product in products if product.get("status") == "approved"][:limit]
+
 @router.get("/{product_id}")
 async def get_product(product_id: str, db=Depends(get_database)):
     try:
@@ -0,0 +1,24 @@
+from pydantic import BaseModel, Field
+from typing import Any, Dict, List, Optional, Tuple
+
+class ImageSearchFilters(BaseModel):
+    status: Optional[str] = Field("approved", description="Only return products with this status")
+    gender: Optional[str] = Field(None, description="Gender, or 'kids' for Girl and Boy products")
+    subcategory: Optional[str] = None
+    product_type: Optional[str] = None
+    min_price: Optional[float] = Field(None, ge=0)
+    max_price: Optional[float] = Field(None, ge=0)
+
+    def genders(self) -> Optional[List[str]]:
+        """Accepted gender values, expanding 'kids' the same way the product listing does."""
+        if self.gender == "kids":
+            return ["Girl", "Boy"]
+        return [self.gender] if self.gender else None
+
+    def cache_key(self) -> Tuple:
+        return (self.status, self.gender, self.subcategory, self.product_type, self.min_price, self.max_price)
+
+class ImageSearchBatchResult(BaseModel):
+    index: int = Field(..., description="Position of the image in the request")
+    filename: Optional[str] = None
+    results: List[Dict[Any, Any]]
@@ -0,0 +1,111 @@
+# services/clip_backends.py
+import os
+from typing import Callable, Optional, Tuple
+
+import clip
+import numpy as np
+import torch
+
+# Image encoder implementation: "torch" (the reference model), "torchscript"
+# (traced and frozen), "quantized" (dynamic int8 Linear layers) or "onnx"
+# (ONNX Runtime; needs the onnxruntime package)
+CLIP_BACKEND = os.getenv("IMAGE_SEARCH_CLIP_BACKEND", "torch")
+CLIP_BACKENDS = ("torch", "torchscript", "quantized", "onnx")
+# Intra-op threads used by the encoder; 0 keeps the library default (one per core)
+CLIP_THREADS = int(os.getenv("IMAGE_SEARCH_CLIP_THREADS", "0"))
+ONNX_OPSET = 14
+
+
+class ClipEncoder:
+    """A CLIP model whose image tower may run on an optimized backend.
+
+    Has the encode_image/encode_text interface of the clip model, so callers
+    do not care which backend is in use. Text always runs on the reference
+    model: queries are short and cached, images are the bulk of the work.
+    """
+
+    def __init__(self, model, encode_image: Callable[[torch.Tensor], torch.Tensor], backend: str):
+        self.model = model
+        self.backend = backend
+        self._encode_image = encode_image
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        return self._encode_image(images)
+
+    def encode_text(self, tokens: torch.Tensor) -> torch.Tensor:
+        return self.model.encode_text(tokens)
+
+
+def _example_input(model) -> torch.Tensor:
+    resolution = model.visual.input_resolution
+    return torch.zeros(2, 3, resolution, resolution)
+
+
+def _torchscript_encoder(model) -> Callable[[torch.Tensor], torch.Tensor]:
+    with torch.no_grad():
+        traced = torch.jit.trace(model.visual, _example_input(model))
+    # Freezes the weights into the graph and fuses what it can for CPU
+    return torch.jit.optimize_for_inference(traced)
+
+
+def _quantized_encoder(model) -> Callable[[torch.Tensor], torch.Tensor]:
+    # Returns a quantized copy; the reference weights stay untouched
+    return torch.quantization.quantize_dynamic(model.visual, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _onnx_encoder(model, model_name: str, cache_dir: str, threads: int) -> Callable[[torch.Tensor], torch.Tensor]:
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise RuntimeError("The onnx CLIP backend needs the onnxruntime package") from e
+    safe_model = model_name.replace("/", "-").replace(" ", "_")
+    path = os.path.join(cache_dir, f"clip_visual_{safe_model}.onnx")
+    if not os.path.exists(path):
+        # Exported once and reused; written aside so concurrent workers never read a partial file
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                model.visual, _example_input(model), tmp_path, opset_version=ONNX_OPSET,
+                input_names=["image"], output_names=["embedding"],
+                dynamic_axes={"image": {0: "batch"}, "embedding": {0: "batch"}},
+            )
+        os.replace(tmp_path, path)
+        print(f"Exported the CLIP image encoder to {path}")
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        options.intra_op_num_threads = threads
+    session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def encode(images: torch.Tensor) -> torch.Tensor:
+        inputs = images.cpu().numpy().astype(np.float32, copy=False)
+        return torch.from_numpy(session.run(None, {"image": inputs})[0])
+
+    return encode
+
+
+def load_clip(model_name: str, device: str = "cpu", backend: str = CLIP_BACKEND, threads: int = CLIP_THREADS,
+              cache_dir: Optional[str] = None) -> Tuple[ClipEncoder, Callable]:
+    """Load CLIP with its image encoder on the given backend; returns (encoder, preprocess).
+
+    The optimized backends are CPU-only; on a GPU the reference model is used.
+    ``cache_dir`` is where the onnx backend keeps its exported model.
+    """
+    if backend not in CLIP_BACKENDS:
+        raise ValueError(f"Unknown CLIP backend {backend!r}; expected one of {', '.join(CLIP_BACKENDS)}")
+    if threads:
+        torch.set_num_threads(threads)
+    model, preprocess = clip.load(model_name, device=device)
+    if backend != "torch" and device != "cpu":
+        print(f"CLIP backend {backend} is CPU-only; using the torch model on {device}")
+        backend = "torch"
+    if backend == "torchscript":
+        encode_image = _torchscript_encoder(model)
+    elif backend == "quantized":
+        encode_image = _quantized_encoder(model)
+    elif backend == "onnx":
+        encode_image = _onnx_encoder(model, model_name, cache_dir or os.getcwd(), threads)
+    else:
+        encode_image = model.encode_image
+    return ClipEncoder(model, encode_image, backend), preprocess
@@ -0,0 +1,94 @@
+# services/color_features.py
+from typing import Dict
+
+import numpy as np
+from PIL import Image
+
+# Color descriptor: hue x saturation x value bins
+COLOR_BINS = (8, 3, 3)
+# Color features are computed on the center crop resized to this many pixels square
+COLOR_SAMPLE_SIZE = 64
+CENTER_CROP_RATIO = 0.5
+# Dominant color: hue x saturation x value bins searched for the most common color
+DOMINANT_BINS = (16, 4, 4)
+# Pixels at or below these saturation/value levels are treated as background
+MIN_SATURATION = 10
+MIN_VALUE = 10
+
+
+def center_sample(image: Image.Image, crop_ratio: float = CENTER_CROP_RATIO,
+                  size: int = COLOR_SAMPLE_SIZE) -> np.ndarray:
+    """HSV pixels (PIL scale, 0-255) of the image's center region at a fixed size, as an (n, 3) array."""
+    width, height = image.size
+    crop_w, crop_h = max(1, int(width * crop_ratio)), max(1, int(height * crop_ratio))
+    left, upper = (width - crop_w) // 2, (height - crop_h) // 2
+    center_region = image.crop((left, upper, left + crop_w, upper + crop_h))
+    center_region = center_region.resize((size, size), Image.BILINEAR)
+    return np.asarray(center_region.convert("HSV"), dtype=np.int32).reshape(-1, 3)
+
+
+def color_descriptor(hsv: np.ndarray) -> np.ndarray:
+    """Coarse joint HSV histogram of the sampled pixels, normalized to sum to 1.
+
+    Two descriptors are compared by histogram intersection.
+    """
+    h_bins, s_bins, v_bins = COLOR_BINS
+    bins = (hsv[:, 0] * h_bins // 256) * (s_bins * v_bins) + (hsv[:, 1] * s_bins // 256) * v_bins + hsv[:, 2] * v_bins // 256
+    descriptor = np.bincount(bins, minlength=h_bins * s_bins * v_bins).astype(np.float32)
+    return (descriptor / descriptor.sum()).astype(np.float16)
+
+
+def dominant_color(hsv: np.ndarray) -> np.ndarray:
+    """Most common (hue, saturation, value) among the sampled pixels.
+
+    Finds the mode of a coarse HSV histogram, smoothed over neighbouring bins
+    (circularly in hue) so a color split across a bin edge still wins, and
+    returns the mean of the pixels in and around that bin, with a circular
+    mean for hue. Greyish and dark pixels are ignored as likely background.
+    """
+    pixels = hsv[(hsv[:, 1] > MIN_SATURATION) & (hsv[:, 2] > MIN_VALUE)]
+    if len(pixels) == 0:
+        return hsv.mean(axis=0).astype(np.float32)
+    h_bins, s_bins, v_bins = DOMINANT_BINS
+    h = pixels[:, 0] * h_bins // 256
+    s = pixels[:, 1] * s_bins // 256
+    v = pixels[:, 2] * v_bins // 256
+    counts = np.bincount((h * s_bins + s) * v_bins + v, minlength=h_bins * s_bins * v_bins)
+    counts = counts.reshape(h_bins, s_bins, v_bins).astype(np.float32)
+    smoothed = counts + 0.5 * (np.roll(counts, 1, axis=0) + np.roll(counts, -1, axis=0))
+    padded = np.pad(smoothed, ((0, 0), (1, 1), (1, 1)))
+    smoothed = smoothed + 0.25 * (padded[:, :-2, 1:-1] + padded[:, 2:, 1:-1] + padded[:, 1:-1, :-2] + padded[:, 1:-1, 2:])
+    mode_h, mode_s, mode_v = np.unravel_index(np.argmax(smoothed), smoothed.shape)
+    hue_offset = (h - mode_h + h_bins // 2) % h_bins - h_bins // 2
+    near = (np.abs(hue_offset) <= 1) & (np.abs(s - mode_s) <= 1) & (np.abs(v - mode_v) <= 1)
+    selected = pixels[near]
+    angles = selected[:, 0] * (2 * np.pi / 256)
+    hue = np.arctan2(np.sin(angles).mean(), np.cos(angles).mean()) * 256 / (2 * np.pi) % 256
+    return np.array([hue, selected[:, 1].mean(), selected[:, 2].mean()], dtype=np.float32)
+
+
+def extract_color_features(image: Image.Image) -> Dict[str, np.ndarray]:
+    """Color descriptor and dominant HSV of an image, from one shared center sample."""
+    hsv = center_sample(image)
+    return {"color_descriptor": color_descriptor(hsv), "dominant_hsv": dominant_color(hsv)}
+
+
+def dominant_color_kmeans(image: Image.Image, n_colors: int = 3, crop_ratio: float = CENTER_CROP_RATIO) -> np.ndarray:
+    """The previous extractor: k-means over every pixel of the full-size center crop.
+
+    Kept as the reference for scripts/bench_dominant_color.py.
+    """
+    from sklearn.cluster import KMeans
+
+    width, height = image.size
+    crop_w, crop_h = int(width * crop_ratio), int(height * crop_ratio)
+    left, upper = (width - crop_w) // 2, (height - crop_h) // 2
+    arr = np.array(image.crop((left, upper, left + crop_w, upper + crop_h)).convert("HSV"))
+    pixels = arr.reshape(-1, 3)
+    pixels = pixels[(pixels[:, 1] > MIN_SATURATION) & (pixels[:, 2] > MIN_VALUE)]
+    if len(pixels) == 0:
+        return arr.reshape(-1, 3).mean(axis=0)
+    kmeans = KMeans(n_clusters=n_colors, n_init=5, random_state=42)
+    kmeans.fit(pixels)
+    counts = np.bincount(kmeans.labels_)
+    return kmeans.cluster_centers_[np.argmax(counts)]
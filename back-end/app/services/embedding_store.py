@@ -0,0 +1,153 @@
+# services/embedding_store.py
+import os
+import hashlib
+import tempfile
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+
+def image_key(image_url: str) -> str:
+    """Return a stable key for a product image.
+
+    Catalog image URLs carry a version (e.g. Shopify's ``?v=`` or a new
+    Cloudinary public id) whenever the picture changes, so hashing the URL is
+    enough to notice a changed image without downloading it.
+    """
+    return hashlib.sha1(image_url.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """Persistent per-product feature cache for the image search index.
+
+    Rows are keyed by product id and stamped with the image key and the model
+    name they were computed with; stores for other models or preprocessing
+    versions live in separate files. Each row holds a set of named feature arrays
+    (the CLIP embedding and any colour features) stored column-wise in a single
+    ``.npz`` file, so loading a catalog is a handful of array reads.
+    """
+
+    def __init__(self, directory: str, model_name: str, version: str = "1"):
+        self.directory = directory
+        self.model_name = model_name
+        safe_model = model_name.replace("/", "-").replace(" ", "_")
+        # Each preprocessing version gets its own file, so workers on different
+        # versions (e.g. during a rolling deploy) never overwrite each other's rows
+        suffix = "" if version == "1" else f"_p{version}"
+        self.path = os.path.join(directory, f"embeddings_{safe_model}{suffix}.npz")
+        self._rows: Dict[str, int] = {}
+        self._image_keys = np.array([], dtype="U40")
+        self._features: Dict[str, np.ndarray] = {}
+        self._pending: Dict[str, tuple] = {}
+
+    def load(self) -> int:
+        """Load the store from disk, returning the number of cached rows."""
+        self._rows = {}
+        self._features = {}
+        if not os.path.exists(self.path):
+            return 0
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if str(data["model_name"]) != self.model_name:
+                    print(f"Embedding store at {self.path} was built with {data['model_name']}, ignoring it")
+                    return 0
+                product_ids = data["product_ids"]
+                self._image_keys = data["image_keys"]
+                self._features = {
+                    name[len("f_"):]: data[name] for name in data.files if name.startswith("f_")
+                }
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Could not read embedding store {self.path}: {e}")
+            return 0
+        self._rows = {str(pid): row for row, pid in enumerate(product_ids)}
+        return len(self._rows)
+
+    def release(self):
+        """Forget the rows loaded from disk to free their memory; unsaved rows are kept."""
+        self._rows = {}
+        self._image_keys = np.array([], dtype="U40")
+        self._features = {}
+
+    def has(self, product_id: str) -> bool:
+        """Return True if the store has a row for the product on disk."""
+        return product_id in self._rows
+
+    def product_ids(self) -> List[str]:
+        """Return the ids of the products with a row on disk, as of the last load()."""
+        return list(self._rows)
+
+    def get(self, product_id: str, key: str, fields: Iterable[str] = ()) -> Optional[Dict[str, np.ndarray]]:
+        """Return the cached features for a product, or None if missing or stale.
+
+        Rows that lack any of ``fields`` (e.g. written before a feature was
+        added) are treated as stale too.
+        """
+        if product_id in self._pending:
+            pending_key, features = self._pending[product_id]
+        else:
+            row = self._rows.get(product_id)
+            if row is None:
+                return None
+            pending_key = self._image_keys[row]
+            features = {name: values[row] for name, values in self._features.items()}
+        if pending_key != key or any(field not in features for field in fields):
+            return None
+        return features
+
+    def put(self, product_id: str, key: str, features: Dict[str, np.ndarray]):
+        """Record freshly computed features for a product."""
+        self._pending[product_id] = (key, features)
+
+    def forget(self, product_id: str):
+        """Drop a product's unsaved row, e.g. once it has been used and will not be saved."""
+        self._pending.pop(product_id, None)
+
+    def save(self, product_ids: Iterable[str]):
+        """Write the rows for ``product_ids`` to disk, dropping everything else.
+
+        Passing the ids of the products currently in the catalog prunes rows for
+        deleted products. The file is replaced atomically so a crash mid-write
+        never leaves a truncated store behind.
+        """
+        product_ids = list(product_ids)
+        keys, columns = [], {}
+        kept = []
+        for product_id in product_ids:
+            if product_id in self._pending:
+                key, features = self._pending[product_id]
+            elif product_id in self._rows:
+                row = self._rows[product_id]
+                key = str(self._image_keys[row])
+                features = {name: values[row] for name, values in self._features.items()}
+            else:
+                continue
+            kept.append(product_id)
+            keys.append(key)
+            for name, value in features.items():
+                columns.setdefault(name, []).append(np.asarray(value))
+
+        arrays = {
+            "model_name": np.array(self.model_name),
+            "product_ids": np.array(kept, dtype="U24"),
+            "image_keys": np.array(keys, dtype="U40"),
+        }
+        # Features only some rows have (e.g. a retired feature) are dropped
+        columns = {name: values for name, values in columns.items() if len(values) == len(kept)}
+        for name, values in columns.items():
+            arrays[f"f_{name}"] = np.stack(values)
+
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".npz.tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self._rows = {pid: row for row, pid in enumerate(kept)}
+        self._image_keys = arrays["image_keys"]
+        self._features = {name: arrays[f"f_{name}"] for name in columns}
+        self._pending = {}
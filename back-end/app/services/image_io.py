@@ -0,0 +1,75 @@
+# services/image_io.py
+import io
+import os
+
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+
+# Largest accepted upload, in bytes
+MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_SEARCH_MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# Largest accepted image, in pixels (guards against decompression bombs)
+MAX_IMAGE_PIXELS = int(os.getenv("IMAGE_SEARCH_MAX_IMAGE_PIXELS", str(50_000_000)))
+# Images are decoded at the smallest size whose shorter side is still at least
+# this many pixels; CLIP preprocessing scales the shorter side to 224 anyway
+DECODE_MIN_SIDE = int(os.getenv("IMAGE_SEARCH_DECODE_MIN_SIDE", "224"))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+class ImageRejected(ValueError):
+    """Raised for images that cannot be decoded or are too large."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+async def read_upload(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES) -> bytes:
+    """Read an uploaded file, rejecting it with 413 as soon as it exceeds max_bytes."""
+    chunks, total = [], 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Image must be at most {max_bytes // (1024 * 1024)} MB")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def decode_image(data: bytes, min_side: int = DECODE_MIN_SIDE, max_pixels: int = MAX_IMAGE_PIXELS) -> Image.Image:
+    """Decode image bytes to RGB at reduced size.
+
+    The header is checked against ``max_pixels`` before any pixel data is
+    decoded. JPEGs are decoded with draft mode, which lets libjpeg scale by
+    1/2, 1/4 or 1/8 while decoding; other formats are shrunk by an integer
+    factor right after loading. Either way the shorter side stays at least
+    ``min_side`` pixels.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ImageRejected(f"Could not read image: {e}")
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageRejected(f"Image is {width}x{height}; at most {max_pixels} pixels are allowed", 413)
+    shorter = min(width, height)
+    try:
+        if image.format == "JPEG" and shorter > 2 * min_side:
+            scale = min_side / shorter
+            image.draft("RGB", (max(1, round(width * scale)), max(1, round(height * scale))))
+        image = image.convert("RGB")
+    except OSError as e:
+        raise ImageRejected(f"Could not decode image: {e}")
+    factor = min(image.size) // min_side
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image
+
+
+def decode_upload(data: bytes) -> Image.Image:
+    """Decode an uploaded image, turning rejections into HTTP errors."""
+    try:
+        return decode_image(data)
+    except ImageRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
@@ -3,192 +3,1303 @@ import torch
 import clip
 from PIL import Image
 import numpy as np
-import io
-from typing import List, Dict, Any
+import os
+import time
+import asyncio
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Tuple
 from fastapi import UploadFile, HTTPException
 from bson.objectid import ObjectId
-import requests
-from requests.exceptions import RequestException
-import cv2
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.cluster import KMeans
+import httpx
+
+from app.services.embedding_store import EmbeddingStore, image_key
+from app.services.vector_index import build_vector_index, load_vector_index
+from app.services.product_neighbours import (
+    NEIGHBOURS_COLLECTION, batched_upserts, nearest_neighbours, neighbour_documents,
+)
+from app.services.index_artifact import (
+    BUILD_LOCK, NEIGHBOURS_LOCK, REBUILD_LOCK, STORE_LOCK, FileLock, current_published_at, list_generations,
+    load_generation, prune_generations, publish_generation, read_current, read_manifest, set_current,
+)
+from app.services.search_cache import PerceptualHashCache, TTLCache, color_key, content_hash, perceptual_hash
+from app.services.inference_batcher import BatchingExecutor
+from app.services.product_filters import ProductAttributes
+from app.services.image_io import ImageRejected, decode_image, decode_upload, read_upload
+from app.services.index_shards import SHARD_ADDRESSES, ShardedIndex, ShardUnavailable
+from app.services.clip_backends import CLIP_BACKEND, load_clip
+from app.services.color_features import COLOR_BINS, extract_color_features
+from app.services.search_results import (
+    decode_product_id, encode_product_ids, fetch_ranked_product_lists, fetch_ranked_products,
+)
+from app.schemas.imagesearch import ImageSearchFilters
+
+CLIP_MODEL_NAME = "ViT-B/32"
+# Bump when image decoding, CLIP preprocessing or the color features change in
+# a way that alters stored features. Index generations and embedding-store rows
+# from another version are never mixed with this one.
+PREPROCESSING_VERSION = "1"
+# Where precomputed product features are kept between restarts
+IMAGE_INDEX_DIR = os.getenv(
+    "IMAGE_INDEX_DIR",
+    os.path.join(os.path.dirname(__file__), "..", "..", "data", "image_index"),
+)
+# Index build pipeline: parallel image downloads and images per encoder forward pass
+DOWNLOAD_CONCURRENCY = int(os.getenv("IMAGE_INDEX_DOWNLOAD_CONCURRENCY", "16"))
+ENCODE_BATCH_SIZE = int(os.getenv("IMAGE_INDEX_BATCH_SIZE", "32"))
+IMAGE_FETCH_TIMEOUT = 10.0
+# Features every indexed product must have in the embedding store
+INDEX_FEATURES = ("embedding", "color_descriptor", "dominant_hsv")
+# Weight of color histogram intersection (0..1) added to CLIP similarity when ordering results
+COLOR_WEIGHT = float(os.getenv("IMAGE_SEARCH_COLOR_WEIGHT", "0.05"))
+# Nearest-neighbour index: "exact" (brute force) or "ivf" (approximate).
+# IVF cells default to 4*sqrt(catalog size); more probes = better recall, slower queries.
+VECTOR_INDEX_TYPE = os.getenv("IMAGE_SEARCH_INDEX", "exact")
+IVF_NLIST = int(os.getenv("IMAGE_SEARCH_IVF_NLIST", "0"))
+IVF_NPROBE = int(os.getenv("IMAGE_SEARCH_IVF_NPROBE", "8"))
+# Storage for index vectors: float32, float16 or int8 (with per-vector scales).
+# The compact types save memory at the cost of slower exact search, about 2x
+# for int8 and 7x for float16 (see vector_index.ExactIndex); prefer int8, or
+# combine either with the IVF index, which scores only the probed lists
+EMBEDDING_DTYPE = os.getenv("IMAGE_SEARCH_EMBEDDING_DTYPE", "float32")
+# Catalogs smaller than this always use exact search
+IVF_MIN_SIZE = int(os.getenv("IMAGE_SEARCH_IVF_MIN_SIZE", "10000"))
+# Rebuild the index once this share of its rows are deleted placeholders
+INDEX_COMPACT_RATIO = 0.25
+# Query cache: identical uploads reuse the ranking, and uploads with a similar
+# perceptual hash and the same dominant color reuse the query embedding
+QUERY_CACHE_SIZE = int(os.getenv("IMAGE_SEARCH_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = float(os.getenv("IMAGE_SEARCH_CACHE_TTL", "3600"))
+# Uploads whose 64-bit perceptual hashes differ in at most this many bits count as the same picture
+QUERY_CACHE_HASH_DISTANCE = int(os.getenv("IMAGE_SEARCH_CACHE_HASH_DISTANCE", "4"))
+# Concurrent query images are encoded together: up to this many per forward
+# pass, waiting at most this long for a batch to fill
+QUERY_BATCH_SIZE = int(os.getenv("IMAGE_SEARCH_QUERY_BATCH_SIZE", "16"))
+QUERY_BATCH_WAIT_MS = float(os.getenv("IMAGE_SEARCH_QUERY_BATCH_WAIT_MS", "5"))
+# Text queries: cached embeddings for repeated searches
+TEXT_CACHE_SIZE = int(os.getenv("IMAGE_SEARCH_TEXT_CACHE_SIZE", "4096"))
+TEXT_CACHE_TTL = float(os.getenv("IMAGE_SEARCH_TEXT_CACHE_TTL", "86400"))
+# Publish the built index as memory-mapped files under IMAGE_INDEX_DIR that
+# every worker process maps, instead of each worker building its own copy
+SHARED_INDEX = os.getenv("IMAGE_SEARCH_SHARED_INDEX", "1") != "0"
+# Seconds between checks for a newer index published by another worker
+INDEX_POLL_INTERVAL = float(os.getenv("IMAGE_SEARCH_INDEX_POLL_SECONDS", "2"))
+# Incremental updates are published to the other workers after this many seconds
+INDEX_PUBLISH_DELAY = float(os.getenv("IMAGE_SEARCH_INDEX_PUBLISH_DELAY", "2"))
+# Embedding store rows encoded for single products are written out together,
+# this many seconds after the first of them (and at shutdown)
+STORE_SAVE_DELAY = float(os.getenv("IMAGE_SEARCH_STORE_SAVE_DELAY", "30"))
+# Published index generations kept on disk, plus the newest full builds
+# (from the whole catalog) kept as rollback targets
+INDEX_KEEP_GENERATIONS = 3
+INDEX_KEEP_FULL_BUILDS = 2
+# At startup, "build" indexes the catalog (reusing the embedding store) and
+# "load" maps the last published generation, e.g. one written by
+# scripts/build_image_index.py, building only if there is none
+INDEX_STARTUP = os.getenv("IMAGE_SEARCH_INDEX_STARTUP", "build")
+# Keep the precomputed "similar items" lists (GET /products/{id}/similar) up to
+# date as products change, and build them once if the collection is empty
+PRODUCT_NEIGHBOURS = os.getenv("IMAGE_SEARCH_NEIGHBOURS", "1") != "0"
+# Sharded indexes serve whatever generation is current under IMAGE_INDEX_DIR
+SHARDED_GENERATIONS_DETAIL = (
+    "Index shards serve the current published generation; publish a new one with "
+    "scripts/build_image_index.py, or point CURRENT at an earlier one"
+)
+# PIL's HSV mode scales hue to 0-255, so hue distances wrap around at 256
+HUE_RANGE = 256.0
+
+def publish_index(vector_index, product_ids: np.ndarray, color_descriptors: np.ndarray, hsv: np.ndarray,
+                  attributes: ProductAttributes, rows: Optional[np.ndarray] = None,
+                  index_dir: str = IMAGE_INDEX_DIR, image_keys: Optional[np.ndarray] = None, **manifest) -> str:
+    """Write index rows (all live rows by default) as a new generation and make it current.
+
+    ``product_ids`` are packed as by encode_product_ids(); ``image_keys``
+    (see embedding_store.image_key) are stored with the rows when given. Extra
+    keyword arguments are recorded in the generation's manifest.
+    """
+    rows = np.flatnonzero(vector_index.live) if rows is None else rows
+    arrays = {
+        **vector_index.to_arrays(rows),
+        "product_ids": product_ids[rows],
+        "color_descriptors": color_descriptors[rows],
+        "hsv": hsv[rows],
+        **attributes.to_arrays(rows),
+    }
+    if image_keys is not None:
+        arrays["image_keys"] = np.asarray(image_keys, dtype="U40")[rows]
+    manifest = {
+        "model": CLIP_MODEL_NAME,
+        "preprocessing_version": PREPROCESSING_VERSION,
+        "kind": vector_index.kind,
+        "dtype": vector_index.dtype,
+        "products": len(rows),
+        "quantization": vector_index.quantization_report,
+        "attribute_vocab": attributes.vocab,
+        **manifest,
+    }
+    generation = publish_generation(index_dir, arrays, manifest)
+    prune_generations(index_dir, INDEX_KEEP_GENERATIONS, keep_full_builds=INDEX_KEEP_FULL_BUILDS)
+    return generation
+
+
+def compatible_manifest(manifest: Dict[str, Any]) -> bool:
+    """Whether a generation was built with this process's model and preprocessing."""
+    return (manifest.get("model") == CLIP_MODEL_NAME
+            and manifest.get("preprocessing_version", "1") == PREPROCESSING_VERSION)
 
 class ImageSearchService:
     def __init__(self, database):
         """Initialize the service with a database connection."""
         self.database = database
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model, self.preprocess = clip.load("ViT-B/32", device=self.device)
-        # Store product embeddings and color histograms
-        self.product_embeddings = None
-        self.product_color_histograms = []
-        self.product_ids = []
+        # Loaded by initialize() in a worker thread
+        self.model, self.preprocess = None, None
+        # Product embeddings live in the vector index; the lists and arrays
+        # below are aligned with its rows (rows of removed products stay as
+        # placeholders until the index is compacted)
+        self.vector_index = None
+        # Color descriptor per product (see _extract_color_descriptor)
+        self.product_color_descriptors = np.zeros((0, int(np.prod(COLOR_BINS))), dtype=np.float16)
+        # Dominant (hue, saturation, value) per product, PIL HSV scale
+        self.product_hsv = np.zeros((0, 3), dtype=np.float32)
+        # Raw 12-byte ObjectId of each row
+        self.product_ids = np.zeros((0, 12), dtype=np.uint8)
+        # Image key of each row (see embedding_store.image_key), so a product
+        # whose image did not change is not encoded again; empty when unknown
+        self.product_image_keys = np.zeros(0, dtype="U40")
+        # Status, gender, category and price of each row, for search filters
+        self.product_attributes = ProductAttributes()
+        # Serializes incremental index updates
+        self._update_lock = asyncio.Lock()
+        # Products changed while initialize() was running, replayed once it finishes
+        self._pending_syncs = set()
+        # Bumped whenever the set of indexed products changes
+        self.index_version = 0
+        # Shared index generation this worker has mapped, when last checked for a
+        # newer one, and products changed here but not yet published
+        self.generation: Optional[str] = None
+        self._generation_checked = 0.0
+        self._unpublished = set()
+        self._publish_task: Optional[asyncio.Task] = None
+        # Products encoded by syncs whose store rows are not on disk yet
+        self._unsaved_rows = set()
+        self._save_task: Optional[asyncio.Task] = None
+        # Incompatible generation already reported, so polling does not log it again
+        self._skipped_generation: Optional[str] = None
+        self._neighbours_indexed = False
+        # With IMAGE_SEARCH_SHARDS set the index is partitioned across shard
+        # servers (see shard_server) and this process only encodes queries and
+        # merges the shards' candidates; the local index stays empty
+        self.shards = ShardedIndex(SHARD_ADDRESSES, CLIP_MODEL_NAME, PREPROCESSING_VERSION) if SHARD_ADDRESSES else None
+        self._shard_watch: Optional[asyncio.Task] = None
+        # Background rebuild (see start_rebuild): its status, and the products
+        # synced while it runs, replayed onto the new index after the swap
+        self._rebuild_task: Optional[asyncio.Task] = None
+        self._rebuild_syncs: Optional[set] = None
+        self.rebuild_status: Dict[str, Any] = {"state": "idle"}
+        # (perceptual hash, quantized dominant color) -> query embedding; the
+        # query's color features are always taken from the upload itself
+        self.query_embedding_cache = PerceptualHashCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL, QUERY_CACHE_HASH_DISTANCE)
+        # (content hash, search params, index version) -> ranked [(product_id, score)]
+        self.result_cache = TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+        # Encodes query images off the event loop, batching concurrent searches
+        self.query_encoder = BatchingExecutor(
+            self._encode_query_batch, QUERY_BATCH_SIZE, QUERY_BATCH_WAIT_MS, name="clip-query"
+        )
+        # Same for free-text queries through CLIP's text tower
+        self.text_encoder = BatchingExecutor(
+            self._encode_text_batch, QUERY_BATCH_SIZE, QUERY_BATCH_WAIT_MS, name="clip-text"
+        )
+        # Normalized query text -> text embedding
+        self.text_embedding_cache = TTLCache(TEXT_CACHE_SIZE, TEXT_CACHE_TTL)
+        self.embedding_store = EmbeddingStore(IMAGE_INDEX_DIR, CLIP_MODEL_NAME, PREPROCESSING_VERSION)
+        # Counts from the last initialize(): rows reused from disk vs. re-encoded
+        self.index_stats = {"loaded": 0, "recomputed": 0, "stale": 0, "failed": 0}
         self.is_initialized = False
+        # Initialization runs once, as a shared task every caller awaits
+        self._init_task: Optional[asyncio.Task] = None
+        # idle -> loading_model -> building_index -> ready (or failed)
+        self.state = "idle"
+        self.progress = {"products": 0, "to_encode": 0, "encoded": 0}
+        self.error: Optional[str] = None
         print(f"ImageSearchService initialized with device: {self.device}")
 
-    def _extract_color_histogram(self, image: Image.Image) -> np.ndarray:
-        """Extract color histogram from an image."""
-        # Convert PIL Image to OpenCV format
-        img_cv = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-        
-        # Convert to HSV color space
-        hsv = cv2.cvtColor(img_cv, cv2.COLOR_BGR2HSV)
-        
-        # Calculate histogram
-        hist = cv2.calcHist([hsv], [0, 1], None, [180, 256], [0, 180, 0, 256])
-        
-        # Normalize histogram
-        cv2.normalize(hist, hist, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
-        
-        return hist.flatten()
-
-    def _extract_dominant_color(self, image: Image.Image, n_colors: int = 3, crop_ratio: float = 0.5) -> np.ndarray:
-        """Extract the dominant color from the center region of the image using k-means clustering in HSV."""
-        width, height = image.size
-        crop_w, crop_h = int(width * crop_ratio), int(height * crop_ratio)
-        left = (width - crop_w) // 2
-        upper = (height - crop_h) // 2
-        right = left + crop_w
-        lower = upper + crop_h
-        center_region = image.crop((left, upper, right, lower))
-        hsv_img = center_region.convert('HSV')
-        arr = np.array(hsv_img)
-        pixels = arr.reshape(-1, 3)
-        # Remove low saturation/value pixels (likely background)
-        pixels = pixels[(pixels[:,1] > 10) & (pixels[:,2] > 10)]
-        if len(pixels) == 0:
-            # fallback: use mean color
-            return arr.reshape(-1, 3).mean(axis=0)
-        kmeans = KMeans(n_clusters=n_colors, n_init=5, random_state=42)
-        kmeans.fit(pixels)
-        counts = np.bincount(kmeans.labels_)
-        dominant = kmeans.cluster_centers_[np.argmax(counts)]
-        return dominant
+    def status(self) -> Dict[str, Any]:
+        """Readiness of the model and index, with build progress."""
+        return {
+            "ready": self.is_initialized,
+            "state": self.state,
+            "device": self.device,
+            "model": CLIP_MODEL_NAME,
+            "model_loaded": self.model is not None,
+            "encoder": self.model.backend if self.model is not None else CLIP_BACKEND,
+            "progress": dict(self.progress),
+            "index": self.index_info(),
+            "index_stats": self.index_stats,
+            "rebuild": self.rebuild_status,
+            "error": self.error,
+        }
+
+    async def _load_model(self):
+        if self.model is None:
+            self.model, self.preprocess = await asyncio.to_thread(
+                load_clip, CLIP_MODEL_NAME, self.device, cache_dir=IMAGE_INDEX_DIR
+            )
+            print(f"Loaded {CLIP_MODEL_NAME} with the {self.model.backend} image encoder")
+
+    @property
+    def product_embeddings(self) -> np.ndarray:
+        """Matrix of normalized product embeddings, one row per index row."""
+        if self.vector_index is None:
+            return np.zeros((0, 512), dtype=np.float32)
+        return self.vector_index.embeddings
+
+    @property
+    def indexed_count(self) -> int:
+        """Number of products currently searchable."""
+        if self.shards is not None:
+            return self.shards.products
+        if self.vector_index is None:
+            return 0
+        return len(self.vector_index) - self.vector_index.dead_count
+
+    def _find_rows(self, product_id: str) -> np.ndarray:
+        """Live index rows holding a product (at most one)."""
+        raw = np.frombuffer(ObjectId(product_id).binary, dtype=np.uint8)
+        return np.flatnonzero((self.product_ids == raw).all(axis=1) & self.vector_index.live)
+
+    def _live_product_ids(self) -> List[str]:
+        return [decode_product_id(raw) for raw in self.product_ids[self.vector_index.live]]
 
     async def initialize(self):
-        """Load and precompute product embeddings and color histograms from product images."""
+        """Load and precompute product embeddings and color features from product images.
+
+        Features already in the embedding store for the same product, image and
+        model are reused; only new products or products whose image changed are
+        downloaded and encoded again.
+
+        Concurrent callers share a single initialization run; a failed run is
+        retried by the next caller.
+        """
         if self.is_initialized:
             return
-            
+        if self._init_task is None or (self._init_task.done() and not self.is_initialized):
+            self._init_task = asyncio.create_task(self._initialize())
+        # Shielded so a cancelled request does not abort the shared run
+        await asyncio.shield(self._init_task)
+
+    async def _initialize(self):
+        try:
+            self.state = "loading_model"
+            self.error = None
+            await self._load_model()
+            self.state = "building_index"
+            if self.shards is not None:
+                await self._connect_shards()
+            elif INDEX_STARTUP == "load" and await self._attach_current():
+                pass
+            elif SHARED_INDEX:
+                await self._build_shared()
+            else:
+                await self._build_from_catalog()
+            self.is_initialized = True
+            pending, self._pending_syncs = self._pending_syncs, set()
+            for product_id in pending:
+                # The index is already serving; one bad product must not fail initialization
+                try:
+                    await self.sync_product(product_id)
+                except Exception as e:
+                    print(f"Could not update image index for product {product_id}: {e}")
+            if PRODUCT_NEIGHBOURS and self.shards is None:
+                asyncio.create_task(self._ensure_neighbours())
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            print(f"Image search initialization failed: {e}")
+            raise
+        self.state = "ready"
+
+    async def _attach_current(self) -> bool:
+        """Map the published generation, if there is a usable one.
+
+        When the current generation was built with another model or
+        preprocessing version (e.g. while a deploy rolls over to a new one),
+        the newest compatible generation is used instead.
+        """
+        current = read_current(IMAGE_INDEX_DIR)
+        candidates = self._compatible_generations()
+        if current in candidates:
+            candidates.remove(current)
+            candidates.insert(0, current)
+        for generation in candidates:
+            try:
+                await self._attach_generation(generation)
+                return True
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Could not map image index generation {generation}: {e}")
+        print("No usable published image index generation, building from the catalog")
+        return False
+
+    async def _connect_shards(self):
+        """Check the shard servers are serving a compatible index and start following their status."""
+        try:
+            await self.shards.connect()
+        except ShardUnavailable as e:
+            raise RuntimeError(f"Image index shards unavailable: {e}")
+        print(f"Connected to {len(self.shards)} image index shards ({self.shards.products} products)")
+        if self._shard_watch is None or self._shard_watch.done():
+            self._shard_watch = asyncio.create_task(self._watch_shards())
+
+    async def _watch_shards(self):
+        """Invalidate cached results when a shard's generation or product count changes."""
+        def signature():
+            return [(shard["generation"], shard["products"]) for shard in self.shards.info()["shards"]]
+
+        while True:
+            await asyncio.sleep(INDEX_POLL_INTERVAL)
+            before = signature()
+            await self.shards.refresh_status()
+            if signature() != before:
+                self.index_version += 1
+
+    def _compatible_generations(self) -> List[str]:
+        """Published generations this process can serve, newest first."""
+        generations = []
+        for generation in reversed(list_generations(IMAGE_INDEX_DIR)):
+            try:
+                manifest = read_manifest(IMAGE_INDEX_DIR, generation)
+            except (OSError, ValueError):
+                continue
+            if compatible_manifest(manifest):
+                generations.append(generation)
+        return generations
+
+    async def _build_shared(self):
+        """Build the index once for all worker processes, or map the one another worker built.
+
+        Workers take the build lock in turn. The first one builds from the
+        catalog and publishes the result; the others find a generation published
+        after they started waiting and memory-map it instead of building again.
+        """
+        lock = FileLock(IMAGE_INDEX_DIR, BUILD_LOCK)
+        started = time.time()
+        await asyncio.to_thread(lock.acquire)
+        try:
+            published_at = current_published_at(IMAGE_INDEX_DIR)
+            if published_at is not None and published_at >= started:
+                await self._attach_generation(read_current(IMAGE_INDEX_DIR))
+                return
+            index = await self._build_from_catalog()
+            # The store is only needed while building; don't keep a private copy of it
+            self.embedding_store.release()
+            await self._publish_generation(full_build=True, source="initialize", catalog_read_at=index["catalog_read_at"])
+        finally:
+            lock.release()
+
+    async def _build_from_catalog(self, swap: bool = True) -> Dict[str, Any]:
+        """Index every searchable product, reusing the embedding store.
+
+        Returns the new index (see _new_index) with the time the catalog was
+        read; unless ``swap`` is False it also replaces the one being served.
+        """
         print("Starting embeddings initialization...")
-        products = await self.database.products.find({}).to_list(None)
-        
-        # Prepare product IDs, embeddings tensors, and color histograms
-        all_embeddings = []
-        all_color_histograms = []
-        valid_product_ids = []
+        catalog_read_at = time.time()
+        products = await self.database.products.find({"status": {"$ne": "disapproved"}}).to_list(None)
+        cached_rows = self.embedding_store.load()
+        print(f"Embedding store has {cached_rows} cached products")
+        self.progress = {"products": len(products), "to_encode": 0, "encoded": 0}
         
+        stats = {"loaded": 0, "recomputed": 0, "stale": 0, "failed": 0}
+        catalog = []
+        to_encode = []
         for product in products:
             product_id = str(product["_id"])
-            
-            if "image_url" in product and product["image_url"]:
-                try:
-                    # Download and process image
-                    image = await self._fetch_image(product["image_url"])
-                    if image:
-                        # Preprocess and encode the image
-                        image_input = self.preprocess(image).unsqueeze(0).to(self.device)
-                        
-                        with torch.no_grad():
-                            # Get image embedding
-                            image_embedding = self.model.encode_image(image_input).squeeze(0)
-                            # Normalize embedding
-                            normalized_embedding = image_embedding / image_embedding.norm()
-                            all_embeddings.append(normalized_embedding.cpu())
-                            
-                            # Extract and store color histogram
-                            color_hist = self._extract_color_histogram(image)
-                            all_color_histograms.append(color_hist)
-                            
-                            valid_product_ids.append(product_id)
-                            print(f"Processed embedding and color histogram for product: {product_id}")
-                    else:
-                        print(f"Could not fetch image for product: {product_id}")
-                except Exception as e:
-                    print(f"Error processing product {product_id}: {e}")
-            else:
+            if not product.get("image_url"):
                 print(f"No image URL for product: {product_id}")
+                continue
+            key = image_key(product["image_url"])
+            catalog.append((product_id, key, product))
+            if self.embedding_store.get(product_id, key, INDEX_FEATURES) is not None:
+                stats["loaded"] += 1
+            else:
+                # A cached row with a different image key is stale
+                if self.embedding_store.has(product_id):
+                    stats["stale"] += 1
+                to_encode.append((product_id, key, product["image_url"]))
         
-        # Update product IDs with only valid ones
-        self.product_ids = valid_product_ids
+        if to_encode:
+            print(f"Encoding {len(to_encode)} product images...")
+            self.progress["to_encode"] = len(to_encode)
+            encoded = await self._encode_products(to_encode, self.progress)
+            stats["recomputed"] = encoded
+            stats["failed"] = len(to_encode) - encoded
         
-        # Stack all embeddings into a single tensor
-        if all_embeddings:
-            self.product_embeddings = torch.stack(all_embeddings)
-            self.product_color_histograms = np.array(all_color_histograms)
-        else:
-            self.product_embeddings = torch.zeros((0, 512))
-            self.product_color_histograms = np.array([])
+        # Assemble the index in catalog order from the store
+        all_embeddings = []
+        all_color_descriptors = []
+        all_hsv = []
+        valid_product_ids = []
+        valid_image_keys = []
+        valid_products = []
+        for product_id, key, product in catalog:
+            features = self.embedding_store.get(product_id, key, INDEX_FEATURES)
+            if features is None:
+                continue
+            all_embeddings.append(features["embedding"])
+            all_color_descriptors.append(features["color_descriptor"])
+            all_hsv.append(features["dominant_hsv"])
+            valid_product_ids.append(product_id)
+            valid_image_keys.append(key)
+            valid_products.append(product)
         
-        self.is_initialized = True
-        print(f"Initialized embeddings and color histograms for {len(self.product_ids)} products")
+        # Persist the refreshed store, pruning products that no longer exist
+        if stats["recomputed"] or len(valid_product_ids) != cached_rows:
+            try:
+                await asyncio.to_thread(self._save_store, valid_product_ids, True)
+            except OSError as e:
+                print(f"Could not save embedding store: {e}")
+        
+        index = await self._new_index(
+            valid_product_ids,
+            np.stack(all_embeddings) if all_embeddings else np.zeros((0, 512), dtype=np.float32),
+            np.stack(all_color_descriptors) if all_color_descriptors else self.product_color_descriptors[:0],
+            np.stack(all_hsv) if all_hsv else np.zeros((0, 3), dtype=np.float32),
+            ProductAttributes.from_products(valid_products),
+            valid_image_keys,
+        )
+        index["catalog_read_at"] = catalog_read_at
+        if swap:
+            self._swap_index(index)
+        
+        self.index_stats = stats
+        print(
+            f"Initialized embeddings and color features for {self.indexed_count} products "
+            f"(loaded {stats['loaded']}, recomputed {stats['recomputed']}, "
+            f"stale {stats['stale']}, failed {stats['failed']})"
+        )
+        return index
+
+    def _save_store(self, product_ids: List[str], prune: bool = False):
+        """Persist the embedding store.
+
+        With a shared index several workers (and scripts/build_image_index.py)
+        write the same store, so the file is re-read under a lock first and
+        this worker's rows saved together with every row already on disk.
+        With ``prune`` (``product_ids`` is the whole catalog) the others are
+        dropped instead.
+        """
+        if not SHARED_INDEX:
+            self.embedding_store.save(product_ids)
+            return
+        lock = FileLock(IMAGE_INDEX_DIR, STORE_LOCK)
+        lock.acquire()
+        try:
+            self.embedding_store.load()
+            if not prune:
+                own = set(product_ids)
+                product_ids = list(product_ids) + [
+                    product_id for product_id in self.embedding_store.product_ids() if product_id not in own
+                ]
+            self.embedding_store.save(product_ids)
+        finally:
+            self.embedding_store.release()
+            lock.release()
+
+    async def _save_store_later(self):
+        """Save the store once a burst of product syncs has settled."""
+        await asyncio.sleep(STORE_SAVE_DELAY)
+        await self.flush_store()
+
+    async def flush_store(self):
+        """Write store rows encoded by product syncs but not saved yet, e.g. at shutdown."""
+        while self._unsaved_rows:
+            live = self._live_product_ids() if self.vector_index is not None else []
+            unsaved, self._unsaved_rows = self._unsaved_rows, set()
+            try:
+                await asyncio.to_thread(self._save_store, live + sorted(unsaved - set(live)))
+            except OSError as e:
+                print(f"Could not save embedding store: {e}")
+                return
+
+    async def _build_index(self, product_ids: List[str], embeddings: np.ndarray,
+                           color_descriptors: np.ndarray, hsv: np.ndarray,
+                           attributes: ProductAttributes, image_keys: List[str]):
+        """Build the vector index and swap it in together with its row metadata."""
+        self._swap_index(await self._new_index(product_ids, embeddings, color_descriptors, hsv, attributes, image_keys))
+
+    async def _new_index(self, product_ids: List[str], embeddings: np.ndarray,
+                         color_descriptors: np.ndarray, hsv: np.ndarray,
+                         attributes: ProductAttributes, image_keys: List[str]) -> Dict[str, Any]:
+        """Build a vector index and its row metadata without touching the one being served."""
+        vector_index = await asyncio.to_thread(
+            build_vector_index, embeddings.astype(np.float32), VECTOR_INDEX_TYPE,
+            min_ivf_size=IVF_MIN_SIZE, nlist=IVF_NLIST, nprobe=IVF_NPROBE, dtype=EMBEDDING_DTYPE,
+        )
+        print(
+            f"Built {vector_index.kind} vector index over {len(product_ids)} products "
+            f"({vector_index.dtype}, {vector_index.nbytes / 2**20:.1f} MiB)"
+        )
+        if vector_index.quantization_report:
+            print(f"Embedding quantization vs float32: {vector_index.quantization_report}")
+        return {
+            "vector_index": vector_index,
+            "product_ids": encode_product_ids(product_ids),
+            "color_descriptors": color_descriptors.astype(np.float16),
+            "hsv": hsv.astype(np.float32),
+            "attributes": attributes,
+            "image_keys": np.array(image_keys, dtype="U40"),
+        }
+
+    def _swap_index(self, index: Dict[str, Any]):
+        """Serve a built index. Synchronous, so no query sees a mix of old and new rows."""
+        self.vector_index = index["vector_index"]
+        self.product_ids = index["product_ids"]
+        self.product_color_descriptors = index["color_descriptors"]
+        self.product_hsv = index["hsv"]
+        self.product_attributes = index["attributes"]
+        self.product_image_keys = index["image_keys"]
+        self.index_version += 1
+
+    async def _publish_generation(self, **manifest) -> str:
+        """Write the live rows of the index as a new shared generation and map it.
+
+        Keyword arguments are recorded in the generation's manifest.
+        """
+        generation = await asyncio.to_thread(
+            publish_index, self.vector_index, self.product_ids, self.product_color_descriptors,
+            self.product_hsv, self.product_attributes, image_keys=self.product_image_keys,
+            encoder=self.model.backend, **manifest,
+        )
+        print(f"Published image index generation {generation} ({self.indexed_count} products)")
+        await self._attach_generation(generation)
+        return generation
+
+    async def _attach_generation(self, generation: str):
+        """Swap in a published generation, memory-mapped and shared with the other workers."""
+        manifest, arrays = await asyncio.to_thread(load_generation, IMAGE_INDEX_DIR, generation)
+        if not compatible_manifest(manifest):
+            raise ValueError(
+                f"Index generation {generation} was built with {manifest.get('model')} "
+                f"(preprocessing version {manifest.get('preprocessing_version', '1')})"
+            )
+        vector_index = await asyncio.to_thread(
+            load_vector_index, manifest["kind"], arrays, manifest["dtype"], nprobe=IVF_NPROBE
+        )
+        vector_index.quantization_report = manifest.get("quantization")
+        self.vector_index = vector_index
+        self.product_ids = arrays["product_ids"]
+        self.product_color_descriptors = arrays["color_descriptors"]
+        self.product_hsv = arrays["hsv"]
+        self.product_attributes = ProductAttributes.from_arrays(arrays, manifest["attribute_vocab"])
+        # Generations published before image keys were stored have none
+        self.product_image_keys = arrays.get("image_keys", np.full(len(vector_index), "", dtype="U40"))
+        self.generation = generation
+        self.index_version += 1
+        print(f"Mapped image index generation {generation} ({len(vector_index)} products)")
+
+    async def _refresh_generation(self):
+        """Switch to a newer generation published by another worker.
+
+        Checks the CURRENT pointer at most every INDEX_POLL_INTERVAL seconds.
+        Skipped while this worker has unpublished changes; publishing them
+        merges with the newer generation.
+        """
+        if not SHARED_INDEX or self.shards is not None or not self.is_initialized:
+            return
+        now = time.monotonic()
+        if now - self._generation_checked < INDEX_POLL_INTERVAL:
+            return
+        self._generation_checked = now
+        generation = read_current(IMAGE_INDEX_DIR)
+        if generation is None or generation in (self.generation, self._skipped_generation):
+            return
+        if self._unpublished or self._update_lock.locked():
+            return
+        async with self._update_lock:
+            try:
+                await self._attach_generation(generation)
+            except (OSError, ValueError, KeyError) as e:
+                # E.g. published by workers already running a new model; keep serving ours
+                print(f"Could not map image index generation {generation}, keeping {self.generation}: {e}")
+                self._skipped_generation = generation
+
+    async def _publish_later(self):
+        """Publish this worker's incremental updates once they have settled."""
+        await asyncio.sleep(INDEX_PUBLISH_DELAY)
+        lock = FileLock(IMAGE_INDEX_DIR, BUILD_LOCK)
+        await asyncio.to_thread(lock.acquire)
+        try:
+            async with self._update_lock:
+                changed, self._unpublished = self._unpublished, set()
+                if not changed:
+                    # Superseded by a rebuild or rollback
+                    return
+                current = read_current(IMAGE_INDEX_DIR)
+                if current is not None and current != self.generation:
+                    # Another worker published meanwhile: start from its index and
+                    # replay our products on top (syncing is idempotent)
+                    await self._attach_generation(current)
+                    for product_id in changed:
+                        await self._sync_locked(product_id)
+                await self._publish_generation()
+        except Exception as e:
+            print(f"Could not publish image index: {e}")
+        finally:
+            lock.release()
+
+    def start_rebuild(self) -> Dict[str, Any]:
+        """Start rebuilding the whole index from the catalog in the background.
+
+        The current index keeps serving until the new one is complete, then
+        the two are swapped atomically (with a shared index, by publishing the
+        new generation, which the other workers pick up). Returns the rebuild
+        status; see index_generations() for progress.
+        """
+        if not self.is_initialized:
+            raise HTTPException(status_code=503, detail=f"Image search is not ready yet ({self.state})")
+        if self.shards is not None:
+            raise HTTPException(status_code=400, detail=SHARDED_GENERATIONS_DETAIL)
+        if self._rebuild_task is not None and not self._rebuild_task.done():
+            raise HTTPException(status_code=409, detail="An index rebuild is already running")
+        lock = None
+        if SHARED_INDEX:
+            lock = FileLock(IMAGE_INDEX_DIR, REBUILD_LOCK)
+            if not lock.acquire(blocking=False):
+                raise HTTPException(status_code=409, detail="Another worker is rebuilding the index")
+        self.rebuild_status = {
+            "state": "running", "started_at": datetime.utcnow().isoformat() + "Z",
+            "finished_at": None, "generation": None, "error": None,
+        }
+        self._rebuild_task = asyncio.create_task(self._rebuild(lock))
+        return dict(self.rebuild_status)
+
+    async def _rebuild(self, lock: Optional[FileLock]):
+        self._rebuild_syncs = set()
+        try:
+            index = await self._build_from_catalog(swap=False)
+            if SHARED_INDEX:
+                self.embedding_store.release()
+            # Same lock order as _publish_later: build lock, then update lock
+            build_lock = FileLock(IMAGE_INDEX_DIR, BUILD_LOCK) if SHARED_INDEX else None
+            if build_lock is not None:
+                await asyncio.to_thread(build_lock.acquire)
+            try:
+                async with self._update_lock:
+                    if SHARED_INDEX:
+                        generation = await asyncio.to_thread(
+                            publish_index, index["vector_index"], index["product_ids"], index["color_descriptors"],
+                            index["hsv"], index["attributes"], image_keys=index["image_keys"], encoder=self.model.backend,
+                            full_build=True, source="rebuild", catalog_read_at=index["catalog_read_at"],
+                        )
+                        await self._attach_generation(generation)
+                        self.rebuild_status["generation"] = generation
+                    else:
+                        self._swap_index(index)
+                    # The catalog was read at the start: replay what changed since
+                    changed, self._rebuild_syncs = self._rebuild_syncs, None
+                    self._unpublished = set()
+                    for product_id in changed:
+                        try:
+                            await self._sync_locked(product_id)
+                        except Exception as e:
+                            print(f"Could not update image index for product {product_id}: {e}")
+                    if changed and SHARED_INDEX:
+                        self._unpublished = set(changed)
+                        if self._publish_task is None or self._publish_task.done():
+                            self._publish_task = asyncio.create_task(self._publish_later())
+            finally:
+                if build_lock is not None:
+                    build_lock.release()
+            self.rebuild_status["state"] = "done"
+            print(f"Rebuilt the image index ({self.indexed_count} products)")
+        except Exception as e:
+            self.rebuild_status.update(state="failed", error=str(e))
+            print(f"Image index rebuild failed: {e}")
+        finally:
+            self._rebuild_syncs = None
+            self.rebuild_status["finished_at"] = datetime.utcnow().isoformat() + "Z"
+            if lock is not None:
+                lock.release()
 
-    async def _fetch_image(self, image_url: str) -> Image.Image:
+    async def rollback_index(self, generation: Optional[str] = None) -> str:
+        """Serve an earlier published generation again, by default the one before the current one.
+
+        All workers switch to it. Products changed since it was published are
+        not in it; a rebuild brings them back.
+        """
+        if not SHARED_INDEX:
+            raise HTTPException(status_code=400, detail="Rollback needs the shared index (IMAGE_SEARCH_SHARED_INDEX=1)")
+        if self.shards is not None:
+            raise HTTPException(status_code=400, detail=SHARDED_GENERATIONS_DETAIL)
+        lock = FileLock(IMAGE_INDEX_DIR, BUILD_LOCK)
+        await asyncio.to_thread(lock.acquire)
+        try:
+            async with self._update_lock:
+                compatible = self._compatible_generations()
+                if generation is None:
+                    older = compatible[compatible.index(self.generation) + 1:] if self.generation in compatible else []
+                    if not older:
+                        raise HTTPException(status_code=409, detail="No earlier generation to roll back to")
+                    generation = older[0]
+                elif generation not in compatible:
+                    raise HTTPException(status_code=404, detail=f"No usable index generation {generation}")
+                await self._attach_generation(generation)
+                set_current(IMAGE_INDEX_DIR, generation)
+                self._unpublished = set()
+                print(f"Rolled the image index back to generation {generation}")
+                return generation
+        finally:
+            lock.release()
+
+    def index_generations(self) -> Dict[str, Any]:
+        """Published generations with their version tags, and which one is being served."""
+        generations = []
+        for generation in reversed(list_generations(IMAGE_INDEX_DIR)):
+            try:
+                manifest = read_manifest(IMAGE_INDEX_DIR, generation)
+            except (OSError, ValueError):
+                continue
+            generations.append({
+                "generation": generation,
+                "created_at": manifest.get("created_at"),
+                "model": manifest.get("model"),
+                "preprocessing_version": manifest.get("preprocessing_version", "1"),
+                "encoder": manifest.get("encoder"),
+                "products": manifest.get("products"),
+                "full_build": bool(manifest.get("full_build")),
+                "source": manifest.get("source"),
+                "compatible": compatible_manifest(manifest),
+            })
+        return {
+            "model": CLIP_MODEL_NAME,
+            "preprocessing_version": PREPROCESSING_VERSION,
+            "serving": self.generation,
+            "current": read_current(IMAGE_INDEX_DIR),
+            "rebuild": self.rebuild_status,
+            "generations": generations,
+        }
+
+    async def sync_product(self, product_id: str):
+        """Bring a single product's index entry in line with the database.
+
+        Adds or refreshes the product if it is searchable and removes it
+        otherwise, without rebuilding the whole index. With a shared index the
+        change is published to the other workers shortly afterwards.
+        """
+        if not self.is_initialized:
+            self._pending_syncs.add(product_id)
+            return
+        if self.shards is not None:
+            await self._sync_shard(product_id)
+            return
+        async with self._update_lock:
+            await self._sync_locked(product_id)
+            if self._rebuild_syncs is not None:
+                self._rebuild_syncs.add(product_id)
+            if PRODUCT_NEIGHBOURS:
+                try:
+                    await self._update_neighbours(product_id)
+                except Exception as e:
+                    print(f"Could not update similar products for {product_id}: {e}")
+            if SHARED_INDEX:
+                self._unpublished.add(product_id)
+                if self._publish_task is None or self._publish_task.done():
+                    self._publish_task = asyncio.create_task(self._publish_later())
+
+    async def _sync_shard(self, product_id: str):
+        """sync_product() with a sharded index: send the product's features to the shard that owns it.
+
+        The shards keep such changes in memory only, until the next published
+        generation includes them. The embedding store is neither loaded nor
+        saved here, since this process does not know the rest of the catalog,
+        so the product is always encoded and its row dropped once sent.
+        """
+        packed_id = encode_product_ids([product_id])[0]
+        product = await self.database.products.find_one({"_id": ObjectId(product_id)})
+        if not product or not product.get("image_url") or product.get("status") == "disapproved":
+            await self.shards.remove(packed_id)
+        else:
+            key = image_key(product["image_url"])
+            try:
+                if not await self._encode_products([(product_id, key, product["image_url"])]):
+                    print(f"Could not index product: {product_id}")
+                    return
+                features = self.embedding_store.get(product_id, key, INDEX_FEATURES)
+                await self.shards.upsert(packed_id, features, product)
+            finally:
+                self.embedding_store.forget(product_id)
+        self.index_version += 1
+
+    async def _sync_locked(self, product_id: str):
+        product = await self.database.products.find_one({"_id": ObjectId(product_id)})
+        if not product or not product.get("image_url") or product.get("status") == "disapproved":
+            self._remove_rows([product_id])
+        else:
+            await self._upsert_product(product_id, product)
+        if self.vector_index.dead_count > INDEX_COMPACT_RATIO * len(self.vector_index):
+            await self._compact_index()
+
+    async def _upsert_product(self, product_id: str, product: Dict[str, Any]):
+        image_url = product["image_url"]
+        key = image_key(image_url)
+        rows = self._find_rows(product_id)
+        if len(rows) and self.product_image_keys[rows[0]] == key:
+            # Already indexed with the current image; refresh status, price etc.
+            self.product_attributes.update(int(rows[0]), product)
+            self.index_version += 1
+            return
+        features = self.embedding_store.get(product_id, key, INDEX_FEATURES)
+        if features is None:
+            if not await self._encode_products([(product_id, key, image_url)]):
+                print(f"Could not index product: {product_id}")
+                return
+            features = self.embedding_store.get(product_id, key, INDEX_FEATURES)
+            self._unsaved_rows.add(product_id)
+            if self._save_task is None or self._save_task.done():
+                self._save_task = asyncio.create_task(self._save_store_later())
+        self._remove_rows([product_id])
+        row = int(self.vector_index.add(features["embedding"])[0])
+        self.product_ids = np.vstack((self.product_ids, encode_product_ids([product_id])))
+        self.product_color_descriptors = np.vstack((self.product_color_descriptors, features["color_descriptor"][None, :]))
+        self.product_hsv = np.vstack((self.product_hsv, features["dominant_hsv"][None, :]))
+        self.product_attributes.append(product)
+        self.product_image_keys = np.append(self.product_image_keys, np.array([key], dtype="U40"))
+        self.index_version += 1
+        print(f"Indexed product {product_id} at row {row}")
+
+    def _remove_rows(self, product_ids: List[str]):
+        rows = np.concatenate([self._find_rows(product_id) for product_id in product_ids])
+        if len(rows):
+            self.vector_index.remove(rows)
+            self.index_version += 1
+            print(f"Removed {len(rows)} products from the image index")
+
+    async def _compact_index(self):
+        """Rebuild the index without the rows of removed products."""
+        rows = np.flatnonzero(self.vector_index.live)
+        await self._build_index(
+            [decode_product_id(raw) for raw in self.product_ids[rows]],
+            self.vector_index.reconstruct(rows),
+            self.product_color_descriptors[rows],
+            self.product_hsv[rows],
+            self.product_attributes.take(rows),
+            list(self.product_image_keys[rows]),
+        )
+
+    def _neighbour_candidates(self) -> np.ndarray:
+        """Rows that may be recommended as similar items: live, approved products."""
+        return self.vector_index.live & self.product_attributes.mask(ImageSearchFilters())
+
+    async def _neighbours_collection(self):
+        collection = self.database[NEIGHBOURS_COLLECTION]
+        if not self._neighbours_indexed:
+            # Lets a product's removal find the lists that mention it
+            await collection.create_index("neighbours.product_id")
+            self._neighbours_indexed = True
+        return collection
+
+    async def rebuild_neighbours(self) -> int:
+        """Recompute the similar-items list of every indexed product.
+
+        Lists are scored in batches on a worker thread and written as they
+        are ready; lists of products no longer indexed are deleted afterwards.
+        Returns the number of lists written.
+        """
+        collection = await self._neighbours_collection()
+        started = datetime.utcnow()
+        rows = np.flatnonzero(self.vector_index.live)
+        batches = batched_upserts(neighbour_documents(
+            self.vector_index, self.product_ids, rows, self._neighbour_candidates(), model=CLIP_MODEL_NAME,
+        ))
+        written = 0
+        while True:
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            await collection.bulk_write(batch, ordered=False)
+            written += len(batch)
+        await collection.delete_many({"updated_at": {"$lt": started}})
+        print(f"Computed similar products for {written} products")
+        return written
+
+    async def _ensure_neighbours(self):
+        """Build the similar-items lists if none exist yet (once, across worker processes)."""
+        lock = FileLock(IMAGE_INDEX_DIR, NEIGHBOURS_LOCK)
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            if await self.database[NEIGHBOURS_COLLECTION].estimated_document_count() == 0:
+                await self.rebuild_neighbours()
+        except Exception as e:
+            print(f"Could not build similar products: {e}")
+        finally:
+            lock.release()
+
+    async def _update_neighbours(self, product_id: str):
+        """Refresh the similar-items lists a product change can affect.
+
+        That is the product's own list (deleted if it left the index), the
+        lists of its new neighbours, and the lists that currently include it.
+        """
+        collection = await self._neighbours_collection()
+        listing = await collection.find({"neighbours.product_id": product_id}, {"_id": 1}).to_list(None)
+        affected = [str(document["_id"]) for document in listing]
+        own_rows = self._find_rows(product_id)
+        if len(own_rows):
+            affected.append(product_id)
+        else:
+            await collection.delete_one({"_id": ObjectId(product_id)})
+        candidates = self._neighbour_candidates()
+        rows = [self._find_rows(pid) for pid in affected]
+        if len(own_rows):
+            _, _, neighbours = next(nearest_neighbours(self.vector_index, own_rows, candidates))
+            rows.append(neighbours[0][neighbours[0] >= 0])
+        rows = np.unique(np.concatenate(rows)) if rows else np.zeros(0, dtype=np.int64)
+        batches = await asyncio.to_thread(lambda: list(batched_upserts(neighbour_documents(
+            self.vector_index, self.product_ids, rows, candidates, model=CLIP_MODEL_NAME,
+        ))))
+        for batch in batches:
+            await collection.bulk_write(batch, ordered=False)
+
+    async def _encode_products(self, items: List[Tuple[str, str, str]], progress: Optional[Dict[str, int]] = None) -> int:
+        """Download, preprocess and encode product images, adding them to the embedding store.
+
+        Runs as a pipeline: up to DOWNLOAD_CONCURRENCY downloads are in flight at
+        once, each downloaded image is decoded and preprocessed in a worker
+        thread, and preprocessed images are encoded ENCODE_BATCH_SIZE at a time
+        in a worker thread so the event loop keeps serving requests.
+        Returns the number of products encoded.
+        """
+        pending: asyncio.Queue = asyncio.Queue()
+        for item in items:
+            pending.put_nowait(item)
+        # Bounded so downloads pause when the encoder falls behind
+        prepared: asyncio.Queue = asyncio.Queue(maxsize=ENCODE_BATCH_SIZE * 2)
+        encoded = 0
+
+        async def download_worker(client: httpx.AsyncClient):
+            while True:
+                try:
+                    product_id, key, image_url = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                image = await self._fetch_image(image_url, client)
+                if image is None:
+                    print(f"Could not fetch image for product: {product_id}")
+                    continue
+                try:
+                    image_input, color_features = await asyncio.to_thread(self._prepare_image, image)
+                except Exception as e:
+                    print(f"Error processing product {product_id}: {e}")
+                    continue
+                await prepared.put((product_id, key, image_input, color_features))
+
+        async def flush(batch):
+            nonlocal encoded
+            try:
+                embeddings = await asyncio.to_thread(
+                    self._encode_batch, torch.stack([item[2] for item in batch])
+                )
+            except Exception as e:
+                print(f"Error encoding batch of {len(batch)} images: {e}")
+                return
+            for (product_id, key, _, color_features), embedding in zip(batch, embeddings):
+                self.embedding_store.put(product_id, key, {"embedding": embedding, **color_features})
+            encoded += len(batch)
+            if progress is not None:
+                progress["encoded"] = encoded
+            print(f"Encoded {encoded}/{len(items)} product images")
+
+        async def encode_worker():
+            batch = []
+            while True:
+                item = await prepared.get()
+                if item is None:
+                    break
+                batch.append(item)
+                if len(batch) >= ENCODE_BATCH_SIZE:
+                    await flush(batch)
+                    batch = []
+            if batch:
+                await flush(batch)
+
+        encoder = asyncio.create_task(encode_worker())
+        try:
+            async with httpx.AsyncClient(timeout=IMAGE_FETCH_TIMEOUT, follow_redirects=True) as client:
+                workers = min(DOWNLOAD_CONCURRENCY, len(items))
+                await asyncio.gather(*(download_worker(client) for _ in range(workers)))
+            await prepared.put(None)
+            await encoder
+        finally:
+            encoder.cancel()
+        return encoded
+
+    def _prepare_image(self, image: Image.Image) -> Tuple[torch.Tensor, Dict[str, np.ndarray]]:
+        """Preprocess an image for the encoder and extract its color features."""
+        return self.preprocess(image), extract_color_features(image)
+
+    def _encode_batch(self, image_inputs: torch.Tensor) -> np.ndarray:
+        """Encode a batch of preprocessed images into normalized embeddings."""
+        with torch.no_grad():
+            embeddings = self.model.encode_image(image_inputs.to(self.device)).float()
+            embeddings /= embeddings.norm(dim=-1, keepdim=True)
+        return embeddings.cpu().numpy()
+
+    async def _fetch_image(self, image_url: str, client: Optional[httpx.AsyncClient] = None) -> Optional[Image.Image]:
         """Fetch an image from URL and return PIL Image object."""
         try:
-            response = requests.get(image_url, timeout=10)
+            if client is None:
+                async with httpx.AsyncClient(timeout=IMAGE_FETCH_TIMEOUT, follow_redirects=True) as own_client:
+                    response = await own_client.get(image_url)
+            else:
+                response = await client.get(image_url)
             response.raise_for_status()
-            return Image.open(io.BytesIO(response.content)).convert('RGB')
-        except (RequestException, IOError) as e:
+            return await asyncio.to_thread(decode_image, response.content)
+        except (httpx.HTTPError, ImageRejected, IOError) as e:
             print(f"Error fetching image from {image_url}: {e}")
             return None
 
-    async def find_similar_products(self, file: UploadFile, top_k: int = 5, top_n_clip: int = 20, hue_threshold: float = 20.0) -> List[Dict[Any, Any]]:
+    @staticmethod
+    def _hue_distance(hues: np.ndarray, hue: float) -> np.ndarray:
+        """Circular distance between an array of hues and a single hue."""
+        diff = np.abs(hues - hue) % HUE_RANGE
+        return np.minimum(diff, HUE_RANGE - diff)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss counters of the query caches."""
+        return {
+            "index_version": self.index_version,
+            "embeddings": self.query_embedding_cache.stats(),
+            "results": self.result_cache.stats(),
+            "query_encoder": self.query_encoder.stats(),
+            "text_embeddings": self.text_embedding_cache.stats(),
+            "text_encoder": self.text_encoder.stats(),
+            "index": self.index_info(),
+        }
+
+    def index_info(self) -> Dict[str, Any]:
+        """Size, storage type and quantization accuracy of the vector index."""
+        if self.shards is not None:
+            return {"built": True, "sharded": True, **self.shards.info(), "preprocessing_version": PREPROCESSING_VERSION}
+        if self.vector_index is None:
+            return {"built": False}
+        return {
+            "built": True,
+            "kind": self.vector_index.kind,
+            "dtype": self.vector_index.dtype,
+            "products": self.indexed_count,
+            "rows": len(self.vector_index),
+            "embedding_bytes": self.vector_index.nbytes,
+            "id_bytes": self.product_ids.nbytes,
+            "quantization": self.vector_index.quantization_report,
+            "shared": SHARED_INDEX,
+            "generation": self.generation,
+            "preprocessing_version": PREPROCESSING_VERSION,
+        }
+
+    def _encode_query_batch(self, images: List[Image.Image]) -> List[Tuple[np.ndarray, float, np.ndarray]]:
+        """Encode query images in one forward pass and extract their color features.
+
+        Runs on the query encoder's worker thread.
+        """
+        embeddings = self._encode_batch(torch.stack([self.preprocess(image) for image in images]))
+        features = [extract_color_features(image) for image in images]
+        return [
+            (embedding, float(feature["dominant_hsv"][0]), feature["color_descriptor"])
+            for embedding, feature in zip(embeddings, features)
+        ]
+
+    @staticmethod
+    def _query_keys(image: Image.Image) -> Tuple[str, int, Dict[str, np.ndarray]]:
+        """Content hash, perceptual hash and color features of a query image."""
+        return content_hash(image), perceptual_hash(image), extract_color_features(image)
+
+    def _encode_text_batch(self, texts: List[str]) -> List[np.ndarray]:
+        """Encode text queries in one forward pass of the text tower."""
+        tokens = clip.tokenize(texts, truncate=True).to(self.device)
+        with torch.no_grad():
+            embeddings = self.model.encode_text(tokens).float()
+            embeddings /= embeddings.norm(dim=-1, keepdim=True)
+        return list(embeddings.cpu().numpy())
+
+    async def find_products_by_text(self, query: str, top_k: int = 12,
+                                    filters: Optional[ImageSearchFilters] = None) -> List[Dict[Any, Any]]:
+        """Rank catalog products by CLIP similarity between their images and a text query."""
+        return await self._fetch_ranked_products(await self.rank_text(query, top_k, filters))
+
+    async def rank_text(self, query: str, top_k: int = 12,
+                        filters: Optional[ImageSearchFilters] = None) -> List[Tuple[str, float]]:
+        """Return (product_id, CLIP score) pairs for a text query, best first."""
+        if filters is None:
+            filters = ImageSearchFilters()
+        if not self.is_initialized:
+            await self.initialize()
+        await self._refresh_generation()
+        text = " ".join(query.lower().split())
+        if not text or not self.indexed_count:
+            return []
+        text_embedding = self.text_embedding_cache.get(text)
+        if text_embedding is None:
+            text_embedding = await self.text_encoder.submit(text)
+            self.text_embedding_cache.put(text, text_embedding)
+        if self.shards is not None:
+            candidates = (await self._search_shards(text_embedding[None, :], top_k, filters))[0]
+        else:
+            scores, rows = self.vector_index.search(
+                text_embedding, top_k, mask=self.product_attributes.mask(filters)
+            )
+            candidates = self._candidates(rows[0], scores[0])
+        return [
+            (decode_product_id(raw), float(score))
+            for raw, score in zip(candidates["product_ids"], candidates["scores"])
+        ]
+
+    def _rank(self, query_embedding: np.ndarray, query_hue: float, query_colors: np.ndarray, top_k: int,
+              top_n_clip: int, hue_threshold: float,
+              filters: Optional[ImageSearchFilters] = None) -> List[Tuple[str, float]]:
+        """Return (product_id, CLIP score) pairs for the best matches that pass the filters.
+
+        Candidates are ordered by CLIP similarity plus COLOR_WEIGHT times the
+        intersection of their color descriptors with the query's.
+        """
+        return self._rank_many([(query_embedding, query_hue, query_colors)], top_k, top_n_clip, hue_threshold, filters)[0]
+
+    def _rank_many(self, queries: List[Tuple[np.ndarray, float, np.ndarray]], top_k: int, top_n_clip: int,
+                   hue_threshold: float, filters: Optional[ImageSearchFilters] = None) -> List[List[Tuple[str, float]]]:
+        """_rank() for several (embedding, hue, color descriptor) queries, searched as one matrix."""
+        # Get top N by CLIP similarity among the products matching the filters
+        mask = self.product_attributes.mask(filters)
+        query_embeddings = np.stack([embedding for embedding, _, _ in queries])
+        similarities, indices = self.vector_index.search(query_embeddings, top_n_clip, mask=mask)
+        return [
+            self._rerank(self._candidates(indices[i], similarities[i]), query_hue, query_colors, top_k, hue_threshold)
+            for i, (_, query_hue, query_colors) in enumerate(queries)
+        ]
+
+    async def _rank_queries(self, queries: List[Tuple[np.ndarray, float, np.ndarray]], top_k: int, top_n_clip: int,
+                            hue_threshold: float,
+                            filters: Optional[ImageSearchFilters] = None) -> List[List[Tuple[str, float]]]:
+        """_rank_many() against the local index, or scattered to the shards and gathered."""
+        if self.shards is None:
+            return self._rank_many(queries, top_k, top_n_clip, hue_threshold, filters)
+        query_embeddings = np.stack([embedding for embedding, _, _ in queries])
+        candidates = await self._search_shards(query_embeddings, top_n_clip, filters)
+        return [
+            self._rerank(query_candidates, query_hue, query_colors, top_k, hue_threshold)
+            for query_candidates, (_, query_hue, query_colors) in zip(candidates, queries)
+        ]
+
+    async def _search_shards(self, queries: np.ndarray, k: int,
+                             filters: Optional[ImageSearchFilters]) -> List[Dict[str, np.ndarray]]:
+        try:
+            return await self.shards.search(queries, k, filters)
+        except ShardUnavailable as e:
+            raise HTTPException(status_code=503, detail=f"Image search index unavailable: {e}")
+
+    def _candidates(self, rows: np.ndarray, scores: np.ndarray) -> Dict[str, np.ndarray]:
+        """Local index rows found for one query, in the form index shards return candidates."""
+        found = rows >= 0
+        rows = rows[found]
+        return {
+            "scores": scores[found],
+            "product_ids": self.product_ids[rows],
+            "hues": self.product_hsv[rows, 0],
+            "colors": self.product_color_descriptors[rows],
+        }
+
+    def _rerank(self, candidates: Dict[str, np.ndarray], query_hue: float, query_colors: np.ndarray,
+                top_k: int, hue_threshold: float) -> List[Tuple[str, float]]:
+        """Apply the hue filter and color re-ranking to one query's CLIP candidates."""
+        # Filter by hue similarity against the hues precomputed at index time
+        keep = self._hue_distance(candidates["hues"], query_hue) < hue_threshold
+        scores, colors = candidates["scores"][keep], candidates["colors"][keep]
+        product_ids = candidates["product_ids"][keep]
+        color_similarity = np.minimum(colors.astype(np.float32), query_colors.astype(np.float32)).sum(axis=1)
+        order = np.argsort(-(scores + COLOR_WEIGHT * color_similarity), kind="stable")[:top_k]
+        return [(decode_product_id(product_ids[i]), float(scores[i])) for i in order]
+
+    async def _fetch_ranked_products(self, ranked: List[Tuple[str, float]]) -> List[Dict[Any, Any]]:
+        """Fetch ranked products in one query, keeping rank order and adding scores."""
+        return await fetch_ranked_products(self.database, ranked)
+
+    async def find_similar_products(self, file: UploadFile, top_k: int = 5, top_n_clip: int = 20, hue_threshold: float = 20.0,
+                                    filters: Optional[ImageSearchFilters] = None) -> List[Dict[Any, Any]]:
         print("[DEBUG] find_similar_products called")
         if not self.is_initialized:
             await self.initialize()
-        if len(self.product_ids) == 0:
+        if not self.indexed_count:
             print("[DEBUG] No product_ids available")
             return []
-        try:
-            # Process the uploaded image
-            image_data = await file.read()
-            image = Image.open(io.BytesIO(image_data)).convert('RGB')
-            # Preprocess and encode the query image
-            image_input = self.preprocess(image).unsqueeze(0).to(self.device)
-            with torch.no_grad():
-                query_embedding = self.model.encode_image(image_input)
-                query_embedding /= query_embedding.norm(dim=-1, keepdim=True)
-            # CLIP similarity with all product embeddings
-            if self.product_embeddings.device != query_embedding.device:
-                query_embedding = query_embedding.to(self.product_embeddings.device)
-            clip_similarities = (query_embedding @ self.product_embeddings.T).squeeze(0)
-            # Get top N by CLIP similarity
-            n = min(top_n_clip, len(clip_similarities))
-            top_clip_similarities, top_indices = torch.topk(clip_similarities, n)
-            print(f"[DEBUG] Number of top_indices: {len(top_indices)}")
-            print("[DEBUG] About to extract dominant color for query image")
+        # Read the upload within the size limit
+        image_data = await read_upload(file)
+        ranked = await self.rank_image(image_data, top_k, top_n_clip, hue_threshold, filters)
+        return await self._fetch_ranked_products(ranked)
+
+    async def find_similar_products_batch(self, files: List[UploadFile], top_k: int = 5, top_n_clip: int = 20,
+                                          hue_threshold: float = 20.0,
+                                          filters: Optional[ImageSearchFilters] = None) -> List[List[Dict[Any, Any]]]:
+        """find_similar_products() for several uploads at once, e.g. the pieces of an outfit."""
+        images_data = [await read_upload(file) for file in files]
+        ranked_lists = await self.rank_images(images_data, top_k, top_n_clip, hue_threshold, filters)
+        return await fetch_ranked_product_lists(self.database, ranked_lists)
+
+    async def rank_image(self, image_data: bytes, top_k: int = 5, top_n_clip: int = 20, hue_threshold: float = 20.0,
+                         filters: Optional[ImageSearchFilters] = None) -> List[Tuple[str, float]]:
+        """Return (product_id, CLIP score) pairs for the products most similar to an encoded image."""
+        return (await self.rank_images([image_data], top_k, top_n_clip, hue_threshold, filters))[0]
+
+    async def rank_images(self, images_data: List[bytes], top_k: int = 5, top_n_clip: int = 20,
+                          hue_threshold: float = 20.0,
+                          filters: Optional[ImageSearchFilters] = None) -> List[List[Tuple[str, float]]]:
+        """rank_image() for several encoded images, in order.
+
+        Images missing from the caches are encoded in one CLIP forward pass
+        and searched against the catalog in one matrix product. Ranked results
+        are only reused for the same picture; query embeddings also for
+        near-identical pictures of the same dominant color.
+        """
+        if filters is None:
+            filters = ImageSearchFilters()
+        if not self.is_initialized:
+            await self.initialize()
+        await self._refresh_generation()
+        if not self.indexed_count:
+            return [[] for _ in images_data]
+
+        async def decode(position: int, image_data: bytes) -> Image.Image:
+            # Decode at reduced size; say which image was rejected
             try:
-                query_dom_color = self._extract_dominant_color(image)
-                query_hue = float(query_dom_color[0])
-                print(f"[DEBUG] Query dominant hue: {query_hue}")
-            except Exception as e:
-                print(f"[DEBUG] Exception during dominant color extraction: {e}")
-                raise
-            # Filter by hue similarity
-            color_matched = []
-            for i, idx in enumerate(top_indices):
-                product_id = self.product_ids[idx]
-                product = await self.database.products.find_one({"_id": ObjectId(product_id)})
-                if product and "image_url" in product and product["image_url"]:
-                    prod_image = await self._fetch_image(product["image_url"])
-                    if prod_image:
-                        try:
-                            prod_dom_color = self._extract_dominant_color(prod_image)
-                            prod_hue = float(prod_dom_color[0])
-                            hue_dist = abs(query_hue - prod_hue)
-                            print(f"[DEBUG] Product {product_id} hue: {prod_hue}, hue_dist: {hue_dist}")
-                            if hue_dist < hue_threshold:
-                                product["_id"] = str(product["_id"])
-                                product["similarity_score"] = float(top_clip_similarities[i])
-                                color_matched.append((product, float(top_clip_similarities[i])))
-                        except Exception as e:
-                            print(f"[DEBUG] Exception during product dominant color extraction: {e}")
-            if not color_matched:
-                print("[DEBUG] No products passed the hue filter")
-            # Sort by CLIP similarity and return top_k
-            color_matched.sort(key=lambda x: x[1], reverse=True)
-            return [p for p, _ in color_matched[:top_k]]
+                return await asyncio.to_thread(decode_upload, image_data)
+            except HTTPException as e:
+                if len(images_data) == 1:
+                    raise
+                raise HTTPException(status_code=e.status_code, detail=f"Image {position + 1}: {e.detail}")
+
+        images = await asyncio.gather(*(decode(position, data) for position, data in enumerate(images_data)))
+        try:
+            keys = await asyncio.to_thread(lambda: [self._query_keys(image) for image in images])
+            digests, image_hashes, features = zip(*keys)
+            search_params = (top_k, top_n_clip, hue_threshold, filters.cache_key(), self.index_version)
+            results = [self.result_cache.get((digest,) + search_params) for digest in digests]
+            misses = [i for i, ranked in enumerate(results) if ranked is None]
+            if not misses:
+                return results
+            colors = {i: (color_key(features[i]["dominant_hsv"]),) for i in misses}
+            embeddings = {i: self.query_embedding_cache.get_similar(image_hashes[i], colors[i]) for i in misses}
+            to_encode = [i for i in misses if embeddings[i] is None]
+            encoded = await self.query_encoder.submit_many([images[i] for i in to_encode])
+            for i, (embedding, _, _) in zip(to_encode, encoded):
+                embeddings[i] = embedding
+                self.query_embedding_cache.put_similar(image_hashes[i], embedding, colors[i])
+            queries = {
+                i: (embeddings[i], float(features[i]["dominant_hsv"][0]), features[i]["color_descriptor"]) for i in misses
+            }
+            ranked_lists = await self._rank_queries([queries[i] for i in misses], top_k, top_n_clip, hue_threshold, filters)
+            for i, ranked in zip(misses, ranked_lists):
+                results[i] = ranked
+                self.result_cache.put((digests[i],) + search_params, ranked)
+            return results
+        except HTTPException:
+            raise
         except Exception as e:
             print(f"[DEBUG] Exception occurred: {e}")
-            raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
\ No newline at end of file
+            raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
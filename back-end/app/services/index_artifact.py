@@ -0,0 +1,207 @@
+# services/index_artifact.py
+import os
+import json
+import time
+import shutil
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Published index generations live under <root>/generations/<id>/, and the
+# <root>/CURRENT file names the one workers should serve
+GENERATIONS_DIR = "generations"
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+# Lock files: building/publishing generations, writing the embedding store,
+# building the similar-items lists, and background rebuilds of the whole index
+BUILD_LOCK = "build.lock"
+STORE_LOCK = "store.lock"
+NEIGHBOURS_LOCK = "neighbours.lock"
+REBUILD_LOCK = "rebuild.lock"
+
+
+def _generations_root(root: str) -> str:
+    return os.path.join(root, GENERATIONS_DIR)
+
+
+def read_current(root: str) -> Optional[str]:
+    """Return the id of the generation currently published, if any."""
+    try:
+        with open(os.path.join(root, CURRENT_FILE), encoding="utf-8") as f:
+            generation = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return generation or None
+
+
+def current_published_at(root: str) -> Optional[float]:
+    """Time the CURRENT pointer was last switched, or None if nothing is published."""
+    try:
+        return os.path.getmtime(os.path.join(root, CURRENT_FILE))
+    except FileNotFoundError:
+        return None
+
+
+def set_current(root: str, generation: str):
+    """Atomically point CURRENT at a generation."""
+    tmp_path = os.path.join(root, f"{CURRENT_FILE}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(generation)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILE))
+
+
+def publish_generation(root: str, arrays: Dict[str, np.ndarray], manifest: Dict[str, Any],
+                       make_current: bool = True) -> str:
+    """Write an index generation and (by default) make it the current one.
+
+    Arrays are written as individual ``.npy`` files into a temporary directory
+    that is renamed into place once complete, so readers never see a partially
+    written generation.
+    """
+    # Ids sort in publication order (microseconds keep quick successive publishes apart)
+    generation = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+    generations = _generations_root(root)
+    os.makedirs(generations, exist_ok=True)
+    tmp_dir = os.path.join(generations, f".tmp-{generation}")
+    os.makedirs(tmp_dir)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(array), allow_pickle=False)
+        manifest = {
+            **manifest,
+            "generation": generation,
+            "created_at": datetime.utcnow().isoformat() + "Z",
+            "arrays": sorted(arrays),
+        }
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(tmp_dir, os.path.join(generations, generation))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    if make_current:
+        set_current(root, generation)
+    return generation
+
+
+def read_manifest(root: str, generation: str) -> Dict[str, Any]:
+    """Load just a generation's manifest."""
+    with open(os.path.join(_generations_root(root), generation, MANIFEST_FILE), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_generation(root: str, generation: str, mmap: bool = True) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    """Load a generation's manifest and arrays.
+
+    With ``mmap`` the arrays are read-only memory maps, so every process that
+    loads the same generation shares one copy in the OS page cache.
+    """
+    directory = os.path.join(_generations_root(root), generation)
+    manifest = read_manifest(root, generation)
+    arrays = {
+        name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r" if mmap else None, allow_pickle=False)
+        for name in manifest["arrays"]
+    }
+    return manifest, arrays
+
+
+def list_generations(root: str) -> List[str]:
+    """Ids of all complete generations, oldest first."""
+    generations = _generations_root(root)
+    if not os.path.isdir(generations):
+        return []
+    return sorted(
+        name for name in os.listdir(generations)
+        if not name.startswith(".") and os.path.exists(os.path.join(generations, name, MANIFEST_FILE))
+    )
+
+
+def prune_generations(root: str, keep: int = 2, min_age_seconds: float = 300.0, keep_full_builds: int = 0):
+    """Delete old generations, keeping the newest ``keep`` and the current one.
+
+    The newest ``keep_full_builds`` generations built from the whole catalog
+    (``full_build`` in their manifest) are kept as well, so there is still a
+    complete build to roll back to after many incremental updates.
+    Generations younger than ``min_age_seconds`` are kept too, so workers that
+    have not yet switched away from them are not left with deleted files
+    (which matters on Windows; POSIX keeps unlinked mapped files alive).
+    """
+    current = read_current(root)
+    now = time.time()
+    generations = list_generations(root)
+    kept = set(generations[-keep:]) if keep else set()
+    if keep_full_builds:
+        full_builds = [generation for generation in generations if _is_full_build(root, generation)]
+        kept.update(full_builds[-keep_full_builds:])
+    for generation in generations:
+        if generation == current or generation in kept:
+            continue
+        directory = os.path.join(_generations_root(root), generation)
+        if now - os.path.getmtime(directory) < min_age_seconds:
+            continue
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _is_full_build(root: str, generation: str) -> bool:
+    try:
+        return bool(read_manifest(root, generation).get("full_build"))
+    except (OSError, ValueError):
+        return False
+
+
+class FileLock:
+    """Exclusive inter-process lock on a file under the index directory.
+
+    Used so only one worker process builds or publishes the index at a time.
+    Locks are per open file, so the same process must not take a lock it
+    already holds.
+    """
+
+    def __init__(self, root: str, name: str = BUILD_LOCK):
+        os.makedirs(root, exist_ok=True)
+        self.path = os.path.join(root, name)
+        self._fd: Optional[int] = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Take the lock; without ``blocking``, return False if another process holds it."""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            else:
+                while True:
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            raise
+                        time.sleep(0.5)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,215 @@
+# services/index_shards.py
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.schemas.imagesearch import ImageSearchFilters
+from app.services.inference_protocol import ConnectionPool, ProtocolError
+from app.services.product_filters import CATEGORICAL_FIELDS
+from app.services.vector_index import top_k
+
+# Shard servers (see shard_server) holding the index partitions, as a
+# comma-separated list of "unix:/path/to.sock" or "host:port" addresses in
+# shard order. Empty: the whole index is searched in this process.
+SHARD_ADDRESSES = [address.strip() for address in os.getenv("IMAGE_SEARCH_SHARDS", "").split(",") if address.strip()]
+# Open connections kept to each shard
+SHARD_POOL_SIZE = 4
+# Seconds a shard gets to answer a search before the query goes on without it
+SHARD_TIMEOUT = float(os.getenv("IMAGE_SEARCH_SHARD_TIMEOUT", "2.0"))
+
+
+def shard_of(packed_ids: np.ndarray, shards: int) -> np.ndarray:
+    """Shard number of each product, from its packed 12-byte ObjectId.
+
+    Uses the low four bytes (the tail of the random value and the counter),
+    so products spread evenly and every process agrees on the owner.
+    """
+    tail = np.ascontiguousarray(np.asarray(packed_ids, dtype=np.uint8).reshape(-1, 12)[:, 8:12])
+    return (tail.view(">u4")[:, 0] % shards).astype(np.int64)
+
+
+def pack_arrays(arrays: Dict[str, np.ndarray]) -> Tuple[List[Dict[str, Any]], bytes]:
+    """Describe arrays for a message header and concatenate their bytes as the payload."""
+    meta, chunks = [], []
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        meta.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape)})
+        chunks.append(array.tobytes())
+    return meta, b"".join(chunks)
+
+
+def unpack_arrays(meta: List[Dict[str, Any]], payload: bytes) -> Dict[str, np.ndarray]:
+    """Inverse of pack_arrays()."""
+    arrays, offset = {}, 0
+    for entry in meta:
+        dtype, shape = np.dtype(entry["dtype"]), tuple(entry["shape"])
+        size = int(np.prod(shape)) * dtype.itemsize
+        if offset + size > len(payload):
+            raise ProtocolError(f"Array {entry['name']} is truncated")
+        arrays[entry["name"]] = np.frombuffer(payload, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        offset += size
+    return arrays
+
+
+def merge_candidates(parts: List[Dict[str, np.ndarray]], k: int) -> Dict[str, np.ndarray]:
+    """Merge per-shard candidate lists into the k best per query.
+
+    Each part holds ``scores`` of shape (queries, k_shard) and per-candidate
+    arrays of shape (queries, k_shard, ...); empty slots have score -inf.
+    """
+    merged = {name: np.concatenate([part[name] for part in parts], axis=1) for name in parts[0]}
+    scores, order = top_k(merged.pop("scores"), k)
+    result = {"scores": scores}
+    for name, values in merged.items():
+        index = order.reshape(order.shape + (1,) * (values.ndim - 2))
+        result[name] = np.take_along_axis(values, index, axis=1)
+    return result
+
+
+class ShardUnavailable(ConnectionError):
+    """Raised when a shard cannot be reached or does not answer in time."""
+
+
+class ShardedIndex:
+    """Client side of a vector index partitioned across shard servers.
+
+    Every product lives on exactly one shard (see shard_of). A search sends
+    the query embeddings to all shards at once, each returns its own top-k
+    candidates with their hue and color descriptor, and the lists are merged
+    here. Shards that fail or time out are left out of that search.
+    """
+
+    def __init__(self, addresses: List[str], model: str, preprocessing_version: str,
+                 pool_size: int = SHARD_POOL_SIZE, timeout: float = SHARD_TIMEOUT):
+        self.addresses = list(addresses)
+        self.model = model
+        self.preprocessing_version = preprocessing_version
+        self.timeout = timeout
+        self._pools = [ConnectionPool(address, pool_size) for address in self.addresses]
+        self._status: List[Dict[str, Any]] = [{} for _ in self.addresses]
+        # Searches answered without every shard
+        self.partial_searches = 0
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    @property
+    def products(self) -> int:
+        """Products held by all shards, as of their last reported status."""
+        return sum(status.get("products") or 0 for status in self._status)
+
+    async def _request(self, shard: int, op: str, params: Optional[Dict[str, Any]] = None,
+                       payload: bytes = b"", timeout: Optional[float] = None) -> Tuple[Any, bytes]:
+        address = self.addresses[shard]
+        try:
+            response, data = await asyncio.wait_for(
+                self._pools[shard].request({"op": op, "params": params or {}}, payload), timeout or self.timeout
+            )
+        except asyncio.TimeoutError:
+            raise ShardUnavailable(f"Shard {shard} ({address}) timed out")
+        except (OSError, asyncio.IncompleteReadError) as e:
+            raise ShardUnavailable(f"Shard {shard} ({address}) unavailable: {e}")
+        if not response.get("ok"):
+            raise ShardUnavailable(f"Shard {shard} ({address}) failed: {response.get('detail')}")
+        return response.get("result"), data
+
+    async def connect(self, timeout: float = 10.0) -> List[Dict[str, Any]]:
+        """Check every shard is up, holds its own partition and serves a compatible index."""
+        statuses = await asyncio.gather(*(self._request(shard, "status", timeout=timeout) for shard in range(len(self))))
+        self._status = [status for status, _ in statuses]
+        for shard, status in enumerate(self._status):
+            if (status.get("shard"), status.get("shards")) != (shard, len(self)):
+                raise ValueError(
+                    f"{self.addresses[shard]} serves shard {status.get('shard')} of {status.get('shards')}, "
+                    f"expected shard {shard} of {len(self)}"
+                )
+            if not status.get("ready"):
+                raise ValueError(f"Shard {shard} has no index loaded: {status.get('error') or 'nothing published yet'}")
+            if (status.get("model"), status.get("preprocessing_version")) != (self.model, self.preprocessing_version):
+                raise ValueError(
+                    f"Shard {shard} serves an index built with {status.get('model')} "
+                    f"(preprocessing version {status.get('preprocessing_version')})"
+                )
+        return self._status
+
+    async def search(self, queries: np.ndarray, k: int,
+                     filters: Optional[ImageSearchFilters] = None) -> List[Dict[str, np.ndarray]]:
+        """Top-k candidates of each query across all shards, best first.
+
+        Returns one dict per query with ``scores``, packed ``product_ids``,
+        ``hues`` and ``colors`` (color descriptors). Raises ShardUnavailable
+        only if no shard answered.
+        """
+        queries = np.ascontiguousarray(np.atleast_2d(queries), dtype=np.float32)
+        params = {
+            "k": k,
+            "shape": list(queries.shape),
+            "filters": (filters or ImageSearchFilters()).model_dump(),
+        }
+        payload = queries.tobytes()
+
+        async def search_shard(shard: int) -> Dict[str, np.ndarray]:
+            meta, data = await self._request(shard, "search", params, payload)
+            return unpack_arrays(meta, data)
+
+        responses = await asyncio.gather(*(search_shard(shard) for shard in range(len(self))), return_exceptions=True)
+        parts = []
+        for response in responses:
+            if isinstance(response, BaseException):
+                if not isinstance(response, ConnectionError):
+                    raise response
+                print(f"Image search shard skipped: {response}")
+                continue
+            parts.append(response)
+        if not parts:
+            raise ShardUnavailable("No image search shard answered")
+        if len(parts) < len(self):
+            self.partial_searches += 1
+        merged = merge_candidates(parts, k)
+        candidates = []
+        for i in range(len(queries)):
+            found = np.isfinite(merged["scores"][i])
+            candidates.append({name: values[i][found] for name, values in merged.items()})
+        return candidates
+
+    async def upsert(self, packed_id: np.ndarray, features: Dict[str, np.ndarray], product: Dict[str, Any]):
+        """Add or replace a product on the shard that owns it."""
+        meta, payload = pack_arrays({
+            "product_id": packed_id,
+            "embedding": np.asarray(features["embedding"], dtype=np.float32),
+            "color_descriptor": np.asarray(features["color_descriptor"]),
+            "dominant_hsv": np.asarray(features["dominant_hsv"], dtype=np.float32),
+        })
+        # Only the fields search filters use; the rest of the document may not be JSON
+        attributes = {field: product.get(field) for field in CATEGORICAL_FIELDS + ("price",)}
+        shard = int(shard_of(packed_id, len(self))[0])
+        self._status[shard], _ = await self._request(shard, "upsert", {"arrays": meta, "product": attributes}, payload)
+
+    async def remove(self, packed_id: np.ndarray):
+        """Remove a product from the shard that owns it."""
+        shard = int(shard_of(packed_id, len(self))[0])
+        self._status[shard], _ = await self._request(shard, "remove", {"product_id": bytes(packed_id.reshape(12)).hex()})
+
+    async def refresh_status(self) -> List[Dict[str, Any]]:
+        """Ask every shard for its status; unreachable shards report their error."""
+        responses = await asyncio.gather(
+            *(self._request(shard, "status") for shard in range(len(self))), return_exceptions=True
+        )
+        self._status = [
+            response[0] if not isinstance(response, BaseException) else {"error": str(response)}
+            for response in responses
+        ]
+        return self._status
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "shards": [
+                {"address": address, **{key: status.get(key) for key in ("products", "generation", "error")}}
+                for address, status in zip(self.addresses, self._status)
+            ],
+            "products": self.products,
+            "timeout": self.timeout,
+            "partial_searches": self.partial_searches,
+        }
@@ -0,0 +1,135 @@
+# services/inference_client.py
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, UploadFile
+
+from app.schemas.imagesearch import ImageSearchFilters
+from app.services.image_io import read_upload
+from app.services.inference_protocol import INFERENCE_ADDRESS, ConnectionPool, ProtocolError
+from app.services.search_results import fetch_ranked_product_lists, fetch_ranked_products
+
+# Open connections kept to the inference server per API worker
+CONNECTION_POOL_SIZE = 8
+# Seconds between readiness checks while the inference server starts up
+STATUS_POLL_INTERVAL = 2.0
+
+
+class RemoteImageSearch:
+    """Image search backed by a separate inference process (see inference_server).
+
+    Offers the same methods the routes use on ImageSearchService, but never
+    imports torch: images are sent to the server, which returns ranked
+    product ids, and the products are fetched from MongoDB here.
+    """
+
+    def __init__(self, database, address: str = INFERENCE_ADDRESS, pool_size: int = CONNECTION_POOL_SIZE):
+        self.database = database
+        self.address = address
+        self._pool = ConnectionPool(address, pool_size)
+        self.is_initialized = False
+        self.state = "idle"
+        self.error: Optional[str] = None
+        self._status: Dict[str, Any] = {}
+        self._init_task: Optional[asyncio.Task] = None
+
+    async def _request(self, op: str, params: Optional[Dict[str, Any]] = None, payload: bytes = b"") -> Any:
+        """Send one request over a pooled connection and return its result."""
+        try:
+            response, _ = await self._pool.request({"op": op, "params": params or {}}, payload)
+        except OSError as e:
+            raise HTTPException(status_code=503, detail=f"Image search server unavailable: {e}")
+        except (asyncio.IncompleteReadError, ProtocolError) as e:
+            raise HTTPException(status_code=503, detail=f"Image search server connection failed: {e}")
+        if not response.get("ok"):
+            raise HTTPException(status_code=response.get("status", 500), detail=response.get("detail"))
+        return response.get("result")
+
+    def status(self) -> Dict[str, Any]:
+        """Last readiness report received from the inference server."""
+        return {**self._status, "ready": self.is_initialized, "state": self.state,
+                "mode": "remote", "address": self.address, "error": self.error}
+
+    async def initialize(self):
+        """Wait until the inference server has its model and index loaded."""
+        if self.is_initialized:
+            return
+        if self._init_task is None or self._init_task.done():
+            self._init_task = asyncio.create_task(self._wait_until_ready())
+        await asyncio.shield(self._init_task)
+
+    async def _wait_until_ready(self):
+        op = "initialize"
+        while True:
+            try:
+                self._status = await self._request(op)
+                self.state, self.error = self._status.get("state", "unknown"), self._status.get("error")
+                op = "status"
+            except HTTPException as e:
+                self.state, self.error = "unavailable", str(e.detail)
+            if self._status.get("ready"):
+                self.is_initialized = True
+                return
+            if self.state == "failed":
+                # Ask the server to retry on the next poll
+                op = "initialize"
+            await asyncio.sleep(STATUS_POLL_INTERVAL)
+
+    async def cache_stats(self) -> Dict[str, Any]:
+        return await self._request("cache_stats")
+
+    async def sync_product(self, product_id: str):
+        await self._request("sync_product", {"product_id": product_id})
+
+    async def index_generations(self) -> Dict[str, Any]:
+        return await self._request("index_generations")
+
+    async def start_rebuild(self) -> Dict[str, Any]:
+        return await self._request("start_rebuild")
+
+    async def rollback_index(self, generation: Optional[str] = None) -> str:
+        return await self._request("rollback_index", {"generation": generation})
+
+    async def find_similar_products(self, file: UploadFile, top_k: int = 5, top_n_clip: int = 20,
+                                    hue_threshold: float = 20.0,
+                                    filters: Optional[ImageSearchFilters] = None) -> List[Dict[Any, Any]]:
+        image_data = await read_upload(file)
+        ranked = await self.rank_image(image_data, top_k, top_n_clip, hue_threshold, filters)
+        return await fetch_ranked_products(self.database, ranked)
+
+    async def rank_image(self, image_data: bytes, top_k: int = 5, top_n_clip: int = 20, hue_threshold: float = 20.0,
+                         filters: Optional[ImageSearchFilters] = None) -> List[Tuple[str, float]]:
+        ranked = await self._request("rank_image", {
+            "top_k": top_k,
+            "top_n_clip": top_n_clip,
+            "hue_threshold": hue_threshold,
+            "filters": (filters or ImageSearchFilters()).model_dump(),
+        }, image_data)
+        return _pairs(ranked)
+
+    async def find_similar_products_batch(self, files: List[UploadFile], top_k: int = 5, top_n_clip: int = 20,
+                                          hue_threshold: float = 20.0,
+                                          filters: Optional[ImageSearchFilters] = None) -> List[List[Dict[Any, Any]]]:
+        images_data = [await read_upload(file) for file in files]
+        # All images go in one message; the server splits the payload by size
+        ranked_lists = await self._request("rank_images", {
+            "sizes": [len(data) for data in images_data],
+            "top_k": top_k,
+            "top_n_clip": top_n_clip,
+            "hue_threshold": hue_threshold,
+            "filters": (filters or ImageSearchFilters()).model_dump(),
+        }, b"".join(images_data))
+        return await fetch_ranked_product_lists(self.database, [_pairs(ranked) for ranked in ranked_lists])
+
+    async def find_products_by_text(self, query: str, top_k: int = 12,
+                                    filters: Optional[ImageSearchFilters] = None) -> List[Dict[Any, Any]]:
+        ranked = await self._request("rank_text", {
+            "query": query,
+            "top_k": top_k,
+            "filters": (filters or ImageSearchFilters()).model_dump(),
+        })
+        return await fetch_ranked_products(self.database, _pairs(ranked))
+
+
+def _pairs(ranked: List[List[Any]]) -> List[Tuple[str, float]]:
+    return [(product_id, float(score)) for product_id, score in ranked]
@@ -0,0 +1,105 @@
+# services/inference_protocol.py
+import asyncio
+import json
+import os
+import struct
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+# Where the image search inference process listens: "unix:/path/to.sock" or "host:port"
+DEFAULT_INFERENCE_ADDRESS = (
+    "127.0.0.1:8765" if os.name == "nt" else "unix:/tmp/smartwear-image-search.sock"
+)
+INFERENCE_ADDRESS = os.getenv("IMAGE_SEARCH_INFERENCE_ADDRESS", DEFAULT_INFERENCE_ADDRESS)
+# Frames larger than this are rejected before being read
+MAX_HEADER_BYTES = 4 * 1024 * 1024
+MAX_PAYLOAD_BYTES = 256 * 1024 * 1024
+
+_LENGTH = struct.Struct(">II")
+
+
+class ProtocolError(ConnectionError):
+    """Raised for malformed or oversized frames."""
+
+
+def _json_default(value: Any) -> Any:
+    # numpy scalars and arrays
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+async def write_message(writer: asyncio.StreamWriter, header: Dict[str, Any], payload: bytes = b""):
+    """Send one frame: header and payload lengths, a JSON header, then raw payload bytes."""
+    encoded = json.dumps(header, default=_json_default).encode("utf-8")
+    writer.write(_LENGTH.pack(len(encoded), len(payload)) + encoded)
+    if payload:
+        writer.write(payload)
+    await writer.drain()
+
+
+async def read_message(reader: asyncio.StreamReader) -> Tuple[Dict[str, Any], bytes]:
+    """Read one frame written by write_message()."""
+    header_size, payload_size = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    if header_size > MAX_HEADER_BYTES or payload_size > MAX_PAYLOAD_BYTES:
+        raise ProtocolError(f"Frame too large ({header_size} + {payload_size} bytes)")
+    header = json.loads(await reader.readexactly(header_size))
+    payload = await reader.readexactly(payload_size) if payload_size else b""
+    return header, payload
+
+
+def _parse_address(address: str) -> Tuple[str, Any]:
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return "tcp", (host or "127.0.0.1", int(port))
+
+
+async def open_connection(address: str = INFERENCE_ADDRESS) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    kind, target = _parse_address(address)
+    if kind == "unix":
+        return await asyncio.open_unix_connection(target, limit=MAX_HEADER_BYTES)
+    return await asyncio.open_connection(*target, limit=MAX_HEADER_BYTES)
+
+
+async def start_server(handler: Callable[[asyncio.StreamReader, asyncio.StreamWriter], Awaitable[None]],
+                       address: str = INFERENCE_ADDRESS) -> asyncio.AbstractServer:
+    kind, target = _parse_address(address)
+    if kind == "unix":
+        # A socket file left behind by a previous run would make bind() fail
+        if os.path.exists(target):
+            os.remove(target)
+        return await asyncio.start_unix_server(handler, target, limit=MAX_HEADER_BYTES)
+    return await asyncio.start_server(handler, *target, limit=MAX_HEADER_BYTES)
+
+
+class ConnectionPool:
+    """Reusable connections to one server speaking this protocol.
+
+    At most ``size`` requests are in flight at once, one per connection.
+    Connection problems surface as OSError, asyncio.IncompleteReadError or
+    ProtocolError; the connection involved is then discarded.
+    """
+
+    def __init__(self, address: str, size: int = 8):
+        self.address = address
+        self._idle: Optional[asyncio.Queue] = None
+        self._slots = asyncio.Semaphore(size)
+
+    async def request(self, header: Dict[str, Any], payload: bytes = b"") -> Tuple[Dict[str, Any], bytes]:
+        """Send one frame and return the response frame."""
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        async with self._slots:
+            try:
+                reader, writer = self._idle.get_nowait()
+            except asyncio.QueueEmpty:
+                reader, writer = await open_connection(self.address)
+            try:
+                await write_message(writer, header, payload)
+                response = await read_message(reader)
+            except BaseException:
+                # Failed or cancelled mid-request: the connection may hold a stale response
+                writer.close()
+                raise
+            self._idle.put_nowait((reader, writer))
+        return response
@@ -0,0 +1,124 @@
+# services/inference_server.py
+"""Standalone image search process that owns the CLIP model and the index.
+
+Run it next to the API, then start the API workers with
+IMAGE_SEARCH_MODE=remote so they forward image search to it instead of
+loading torch themselves:
+
+    python -m app.services.inference_server [--address unix:/tmp/smartwear-image-search.sock]
+
+Requests from all API workers share one model, so concurrent queries are
+batched into the same forward pass.
+"""
+import argparse
+import asyncio
+from typing import Any, Dict
+
+from fastapi import HTTPException
+
+from app.database import connect_to_mongo
+from app.schemas.imagesearch import ImageSearchFilters
+from app.services.imagesearch_service import ImageSearchService
+from app.services.inference_protocol import INFERENCE_ADDRESS, read_message, start_server, write_message
+
+
+class InferenceServer:
+    """Answers framed requests from RemoteImageSearch clients using a local ImageSearchService."""
+
+    def __init__(self, service: ImageSearchService):
+        self.service = service
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve requests on one connection, one at a time, until the client closes it."""
+        try:
+            while True:
+                try:
+                    header, payload = await read_message(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                try:
+                    response = {"ok": True, "result": await self.dispatch(header, payload)}
+                except HTTPException as e:
+                    response = {"ok": False, "status": e.status_code, "detail": e.detail}
+                except Exception as e:
+                    print(f"Inference request {header.get('op')} failed: {e}")
+                    response = {"ok": False, "status": 500, "detail": str(e)}
+                await write_message(writer, response)
+        except ConnectionError as e:
+            print(f"Inference connection closed: {e}")
+        finally:
+            writer.close()
+
+    async def dispatch(self, header: Dict[str, Any], payload: bytes) -> Any:
+        op, params = header.get("op"), header.get("params", {})
+        service = self.service
+        if op == "status":
+            return service.status()
+        if op == "cache_stats":
+            return service.cache_stats()
+        if op == "initialize":
+            # Start (or retry) initialization without making the caller wait for it
+            if not service.is_initialized:
+                asyncio.create_task(self._initialize())
+            return service.status()
+        if not service.is_initialized:
+            raise HTTPException(status_code=503, detail=f"Image search is not ready yet ({service.state})")
+        if op == "rank_image":
+            filters = ImageSearchFilters(**params.pop("filters", {}))
+            return await service.rank_image(payload, filters=filters, **params)
+        if op == "rank_images":
+            filters = ImageSearchFilters(**params.pop("filters", {}))
+            images_data, offset = [], 0
+            for size in params.pop("sizes"):
+                images_data.append(payload[offset:offset + size])
+                offset += size
+            return await service.rank_images(images_data, filters=filters, **params)
+        if op == "rank_text":
+            filters = ImageSearchFilters(**params.pop("filters", {}))
+            return await service.rank_text(params["query"], params.get("top_k", 12), filters)
+        if op == "sync_product":
+            await service.sync_product(params["product_id"])
+            return None
+        if op == "index_generations":
+            return service.index_generations()
+        if op == "start_rebuild":
+            return service.start_rebuild()
+        if op == "rollback_index":
+            return await service.rollback_index(params.get("generation"))
+        raise HTTPException(status_code=400, detail=f"Unknown operation '{op}'")
+
+    async def _initialize(self):
+        try:
+            await self.service.initialize()
+        except Exception as e:
+            print(f"Image search initialization failed: {e}")
+
+
+async def serve(address: str):
+    client = await connect_to_mongo()
+    service = ImageSearchService(client["smartwear"])
+    server = InferenceServer(service)
+    listener = await start_server(server.handle_connection, address)
+    print(f"Image search inference server listening on {address}")
+    asyncio.create_task(server._initialize())
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await service.flush_store()
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Image search inference server")
+    parser.add_argument("--address", default=INFERENCE_ADDRESS,
+                        help='"unix:/path/to.sock" or "host:port"')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.address))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+# services/product_dedupe.py
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.services.search_results import decode_product_id
+
+# Near-duplicate detection when importing products (see scripts/main.py).
+# Images whose 64-bit perceptual hashes differ in at most this many bits are
+# duplicates, unless both have CLIP embeddings less similar than
+# DEDUPE_CONFIRM_SIMILARITY (unrelated pictures that happen to hash alike)
+DEDUPE_HASH_DISTANCE = int(os.getenv("IMAGE_DEDUPE_HASH_DISTANCE", "6"))
+DEDUPE_CONFIRM_SIMILARITY = float(os.getenv("IMAGE_DEDUPE_CONFIRM_SIMILARITY", "0.85"))
+# CLIP similarity at which images are duplicates whatever their hashes, e.g.
+# the same photo cropped, padded or watermarked differently
+DEDUPE_CLIP_SIMILARITY = float(os.getenv("IMAGE_DEDUPE_CLIP_SIMILARITY", "0.97"))
+
+
+def hash_to_hex(image_hash: int) -> str:
+    """Form in which perceptual hashes are stored on product documents (``image_hash``)."""
+    return format(image_hash, "016x")
+
+
+def hex_to_hash(value: str) -> int:
+    return int(value, 16)
+
+
+class DuplicateDetector:
+    """Decides which new product images duplicate ones already known.
+
+    Known images are the catalog's (by image URL, by the perceptual hashes
+    stored on product documents and, when a published index is attached, by
+    CLIP embedding) plus every image accepted so far, so repeats within the
+    import itself are caught as well. Matches are references: a catalog
+    product id, or whatever reference the accepted item was given.
+    """
+
+    def __init__(self, hash_distance: int = DEDUPE_HASH_DISTANCE,
+                 clip_similarity: float = DEDUPE_CLIP_SIMILARITY,
+                 confirm_similarity: float = DEDUPE_CONFIRM_SIMILARITY):
+        self.hash_distance = hash_distance
+        self.clip_similarity = clip_similarity
+        self.confirm_similarity = confirm_similarity
+        self.urls: Dict[str, str] = {}
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.hash_refs: List[str] = []
+        # Published catalog index, and its rows by product id
+        self.vector_index = None
+        self.index_refs: List[str] = []
+        self.index_rows: Dict[str, int] = {}
+        # Embeddings of accepted items, with their references
+        self.embeddings: Optional[np.ndarray] = None
+        self.embedding_refs: List[str] = []
+        self.embedding_rows: Dict[str, int] = {}
+
+    def add_catalog(self, products: List[Dict[str, Any]]):
+        """Register catalog products by ``_id``, ``image_url`` and stored ``image_hash``."""
+        hashes, refs = [], []
+        for product in products:
+            ref = str(product["_id"])
+            if product.get("image_url"):
+                self.urls.setdefault(product["image_url"], ref)
+            if product.get("image_hash"):
+                hashes.append(hex_to_hash(product["image_hash"]))
+                refs.append(ref)
+        self.hashes = np.concatenate((self.hashes, np.array(hashes, dtype=np.uint64)))
+        self.hash_refs.extend(refs)
+
+    def attach_index(self, vector_index, product_ids: np.ndarray):
+        """Also compare CLIP embeddings with a published index (rows of packed ``product_ids``)."""
+        self.vector_index = vector_index
+        self.index_refs = [decode_product_id(raw) for raw in product_ids]
+        self.index_rows = {ref: row for row, ref in enumerate(self.index_refs)}
+
+    def find_duplicates(self, refs: List[str], image_urls: List[Optional[str]], hashes: List[Optional[int]],
+                        embeddings: Optional[np.ndarray] = None) -> List[Optional[Dict[str, Any]]]:
+        """Check a batch of new items in order; return the match of each duplicate, None otherwise.
+
+        ``hashes`` may hold None for images that could not be fetched, which
+        are then only matched by URL. ``embeddings`` are normalized CLIP
+        embeddings, one row per item (zeros where unknown), if available.
+        Items found to be unique are registered, so later items (in this
+        batch or the next) that repeat them are reported as duplicates. The
+        image URLs of duplicates are registered too, as references to what
+        they duplicate, so a repeated URL always gets the same verdict.
+        """
+        n = len(refs)
+        has_hash = np.array([image_hash is not None for image_hash in hashes], dtype=bool)
+        batch_hashes = np.array([image_hash or 0 for image_hash in hashes], dtype=np.uint64)
+        known = self._known_matches(image_urls, batch_hashes, has_hash, embeddings)
+        # Pairwise comparisons inside the batch; only earlier items count
+        distances = np.bitwise_count(batch_hashes[:, None] ^ batch_hashes[None, :])
+        similarities = embeddings @ embeddings.T if embeddings is not None else None
+        results: List[Optional[Dict[str, Any]]] = []
+        accepted: List[int] = []
+        # Image URLs seen earlier in the batch, with the reference they resolved to
+        batch_urls: Dict[str, str] = {}
+        for i in range(n):
+            match = known[i]
+            if match is None and image_urls[i] in batch_urls:
+                match = {"duplicate_of": batch_urls[image_urls[i]], "reason": "image_url"}
+            if match is None and accepted:
+                earlier = np.array(accepted)
+                pair_similarities = similarities[i, earlier] if similarities is not None else None
+                pair_distances = np.where(has_hash[i] & has_hash[earlier], distances[i, earlier], 64)
+                best = self._best_match(pair_distances, pair_similarities)
+                if best is not None:
+                    position, match = best
+                    match["duplicate_of"] = refs[accepted[position]]
+            results.append(match)
+            if image_urls[i]:
+                batch_urls.setdefault(image_urls[i], refs[i] if match is None else match["duplicate_of"])
+            if match is None:
+                accepted.append(i)
+        for i in accepted:
+            self._register(refs[i], image_urls[i], hashes[i], embeddings[i] if embeddings is not None else None)
+        for image_url, ref in batch_urls.items():
+            self.urls.setdefault(image_url, ref)
+        return results
+
+    def _known_matches(self, image_urls: List[Optional[str]], hashes: np.ndarray, has_hash: np.ndarray,
+                       embeddings: Optional[np.ndarray]) -> List[Optional[Dict[str, Any]]]:
+        """Best match of each item among the catalog and earlier batches."""
+        matches: List[Optional[Dict[str, Any]]] = [None] * len(image_urls)
+        distances = np.bitwise_count(hashes[:, None] ^ self.hashes[None, :])
+        distances[~has_hash] = 64
+        for i, image_url in enumerate(image_urls):
+            if image_url and image_url in self.urls:
+                matches[i] = {"duplicate_of": self.urls[image_url], "reason": "image_url"}
+                continue
+            # Hash matches, confirmed by CLIP where both embeddings are known
+            candidates = np.flatnonzero(distances[i] <= self.hash_distance)
+            similarities = None
+            if embeddings is not None and len(candidates):
+                similarities = [self._similarity(embeddings[i], self.hash_refs[c]) for c in candidates]
+            best = self._best_match(distances[i, candidates], similarities)
+            if best is not None:
+                position, match = best
+                match["duplicate_of"] = self.hash_refs[candidates[position]]
+                matches[i] = match
+        if embeddings is None:
+            return matches
+        # Closest catalog product and closest accepted item by CLIP similarity
+        sources = []
+        if self.vector_index is not None and len(self.vector_index):
+            scores, rows = self.vector_index.search(embeddings, 1)
+            sources.append((scores[:, 0], rows[:, 0], self.index_refs))
+        if self.embeddings is not None:
+            scores = embeddings @ self.embeddings.T
+            rows = np.argmax(scores, axis=1)
+            sources.append((scores[np.arange(len(rows)), rows], rows, self.embedding_refs))
+        for scores, rows, source_refs in sources:
+            for i in np.flatnonzero((rows >= 0) & (scores >= self.clip_similarity)):
+                similarity = float(scores[i])
+                if matches[i] is None or (matches[i]["reason"] == "clip" and similarity > matches[i]["clip_similarity"]):
+                    matches[i] = {"duplicate_of": source_refs[rows[i]], "reason": "clip", "clip_similarity": similarity}
+        return matches
+
+    def _similarity(self, embedding: np.ndarray, ref: str) -> Optional[float]:
+        """CLIP similarity between an embedding and a known item, if its embedding is known."""
+        if ref in self.index_rows:
+            return float(self.vector_index.reconstruct(np.array([self.index_rows[ref]]))[0] @ embedding)
+        if ref in self.embedding_rows:
+            return float(self.embeddings[self.embedding_rows[ref]] @ embedding)
+        return None
+
+    def _best_match(self, distances: np.ndarray, similarities) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """Position and details of the best qualifying candidate, if any.
+
+        Hash matches come first, closest first; ``similarities`` (CLIP, per
+        candidate) may hold None where an embedding is unknown.
+        """
+        if similarities is not None:
+            similarities = np.array([np.nan if s is None else s for s in similarities], dtype=np.float32)
+        for position in np.argsort(distances, kind="stable"):
+            distance = int(distances[position])
+            if distance > self.hash_distance:
+                break
+            similarity = None if similarities is None or np.isnan(similarities[position]) else float(similarities[position])
+            if similarity is None or similarity >= self.confirm_similarity:
+                match = {"reason": "image_hash", "hash_distance": distance}
+                if similarity is not None:
+                    match["clip_similarity"] = similarity
+                return int(position), match
+        if similarities is not None and np.any(similarities >= self.clip_similarity):
+            position = int(np.nanargmax(similarities))
+            return position, {"reason": "clip", "clip_similarity": float(similarities[position])}
+        return None
+
+    def _register(self, ref: str, image_url: Optional[str], image_hash: Optional[int],
+                  embedding: Optional[np.ndarray]):
+        if image_url:
+            self.urls.setdefault(image_url, ref)
+        if image_hash is not None:
+            self.hashes = np.append(self.hashes, np.uint64(image_hash))
+            self.hash_refs.append(ref)
+        if embedding is not None and np.any(embedding):
+            row = np.asarray(embedding, dtype=np.float32)[None, :]
+            self.embeddings = row if self.embeddings is None else np.vstack((self.embeddings, row))
+            self.embedding_rows[ref] = len(self.embedding_refs)
+            self.embedding_refs.append(ref)
@@ -0,0 +1,113 @@
+# services/product_filters.py
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from app.schemas.imagesearch import ImageSearchFilters
+
+# Product fields stored as integer codes, one column per field
+CATEGORICAL_FIELDS = ("status", "gender", "subcategory", "product_type")
+
+
+class ProductAttributes:
+    """Product fields kept in columns aligned with the vector index rows.
+
+    Search filters become a boolean mask over these columns before scoring,
+    so top-k only ever sees eligible products.
+    """
+
+    def __init__(self):
+        self.vocab: Dict[str, Dict[str, int]] = {field: {} for field in CATEGORICAL_FIELDS}
+        self.codes: Dict[str, np.ndarray] = {field: np.zeros(0, dtype=np.int32) for field in CATEGORICAL_FIELDS}
+        self.price = np.zeros(0, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.price)
+
+    @classmethod
+    def from_products(cls, products: List[Dict[str, Any]]) -> "ProductAttributes":
+        attributes = cls()
+        for field in CATEGORICAL_FIELDS:
+            attributes.codes[field] = np.array(
+                [attributes._code(field, product.get(field)) for product in products], dtype=np.int32
+            )
+        attributes.price = np.array([_price(product) for product in products], dtype=np.float32)
+        return attributes
+
+    def _code(self, field: str, value: Any) -> int:
+        """Return the code of a field value, adding it to the vocabulary if new."""
+        vocab = self.vocab[field]
+        value = "" if value is None else str(value)
+        if value not in vocab:
+            vocab[value] = len(vocab)
+        return vocab[value]
+
+    def append(self, product: Dict[str, Any]) -> int:
+        """Add a row for a product and return its row number."""
+        for field in CATEGORICAL_FIELDS:
+            self.codes[field] = np.append(self.codes[field], np.int32(self._code(field, product.get(field))))
+        self.price = np.append(self.price, np.float32(_price(product)))
+        return len(self.price) - 1
+
+    def update(self, row: int, product: Dict[str, Any]):
+        """Refresh a row in place, e.g. after a status change."""
+        for field in CATEGORICAL_FIELDS:
+            self.codes[field][row] = self._code(field, product.get(field))
+        self.price[row] = _price(product)
+
+    def take(self, rows: np.ndarray) -> "ProductAttributes":
+        """Return the attributes of the given rows, in order."""
+        subset = ProductAttributes()
+        subset.vocab = {field: dict(vocab) for field, vocab in self.vocab.items()}
+        subset.codes = {field: codes[rows] for field, codes in self.codes.items()}
+        subset.price = self.price[rows]
+        return subset
+
+    def to_arrays(self, rows: np.ndarray) -> Dict[str, np.ndarray]:
+        """Columns of the given rows, named ``attr_<field>``, for saving; the vocabulary is saved separately."""
+        arrays = {f"attr_{field}": codes[rows] for field, codes in self.codes.items()}
+        arrays["attr_price"] = self.price[rows]
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], vocab: Dict[str, Dict[str, int]]) -> "ProductAttributes":
+        """Rebuild attributes saved with ``to_arrays()``; columns are copied since update() writes in place."""
+        attributes = cls()
+        attributes.vocab = {field: dict(vocab.get(field, {})) for field in CATEGORICAL_FIELDS}
+        attributes.codes = {field: np.array(arrays[f"attr_{field}"], dtype=np.int32) for field in CATEGORICAL_FIELDS}
+        attributes.price = np.array(arrays["attr_price"], dtype=np.float32)
+        return attributes
+
+    def mask(self, filters: Optional[ImageSearchFilters]) -> Optional[np.ndarray]:
+        """Boolean mask of rows matching the filters, or None if nothing is filtered."""
+        if filters is None:
+            return None
+        mask = None
+        conditions = {
+            "status": [filters.status] if filters.status else None,
+            "gender": filters.genders(),
+            "subcategory": [filters.subcategory] if filters.subcategory else None,
+            "product_type": [filters.product_type] if filters.product_type else None,
+        }
+        for field, values in conditions.items():
+            if values is None:
+                continue
+            wanted = [self.vocab[field][value] for value in values if value in self.vocab[field]]
+            field_mask = np.isin(self.codes[field], wanted)
+            mask = field_mask if mask is None else mask & field_mask
+        if filters.min_price is not None:
+            mask = _and(mask, self.price >= filters.min_price)
+        if filters.max_price is not None:
+            mask = _and(mask, self.price <= filters.max_price)
+        return mask
+
+
+def _and(mask: Optional[np.ndarray], other: np.ndarray) -> np.ndarray:
+    return other if mask is None else mask & other
+
+
+def _price(product: Dict[str, Any]) -> float:
+    try:
+        return float(product.get("price"))
+    except (TypeError, ValueError):
+        return float("nan")
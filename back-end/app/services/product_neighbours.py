@@ -0,0 +1,67 @@
+# services/product_neighbours.py
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+from bson.objectid import ObjectId
+from pymongo import ReplaceOne
+
+from app.services.search_results import decode_product_id
+from app.services.vector_index import top_k
+
+# Precomputed "similar items": one document per product, keyed by its _id
+NEIGHBOURS_COLLECTION = "product_neighbours"
+# Neighbours stored per product
+NEIGHBOUR_COUNT = int(os.getenv("PRODUCT_NEIGHBOUR_COUNT", "24"))
+# Products whose neighbours are scored per matrix product (memory ~ rows x catalog x 4 bytes)
+NEIGHBOUR_BATCH_ROWS = 256
+# Documents per bulk write
+WRITE_BATCH_SIZE = 1000
+
+
+def nearest_neighbours(vector_index, rows: np.ndarray, eligible: np.ndarray, k: int = NEIGHBOUR_COUNT,
+                       batch_rows: int = NEIGHBOUR_BATCH_ROWS) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Yield (rows, scores, neighbour rows) blocks with the top-k eligible neighbours of each row.
+
+    Scoring is exact (one matrix product per block of rows) and a row is
+    never its own neighbour. Missing neighbours have row -1.
+    """
+    for start in range(0, len(rows), batch_rows):
+        block = rows[start:start + batch_rows]
+        scores = vector_index.score(vector_index.reconstruct(block))
+        scores[:, ~eligible] = -np.inf
+        scores[np.arange(len(block)), block] = -np.inf
+        best_scores, best = top_k(scores, k)
+        best[np.isneginf(best_scores)] = -1
+        yield block, best_scores, best
+
+
+def neighbour_documents(vector_index, product_ids: np.ndarray, rows: np.ndarray, eligible: np.ndarray,
+                        k: int = NEIGHBOUR_COUNT, **fields) -> Iterator[Dict[str, Any]]:
+    """Neighbour documents for the given index rows; ``product_ids`` are the packed ids of all rows."""
+    updated_at = datetime.utcnow()
+    for block, scores, neighbours in nearest_neighbours(vector_index, rows, eligible, k):
+        for row, row_scores, row_neighbours in zip(block, scores, neighbours):
+            yield {
+                "_id": ObjectId(decode_product_id(product_ids[row])),
+                "neighbours": [
+                    {"product_id": decode_product_id(product_ids[neighbour]), "score": float(score)}
+                    for neighbour, score in zip(row_neighbours, row_scores) if neighbour >= 0
+                ],
+                "updated_at": updated_at,
+                **fields,
+            }
+
+
+def batched_upserts(documents: Iterator[Dict[str, Any]],
+                    batch_size: int = WRITE_BATCH_SIZE) -> Iterator[List[ReplaceOne]]:
+    """Group documents into lists of upserts for bulk_write()."""
+    batch = []
+    for document in documents:
+        batch.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
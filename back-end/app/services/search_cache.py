@@ -0,0 +1,164 @@
+# services/search_cache.py
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+import numpy as np
+from PIL import Image
+
+from app.services.color_features import DOMINANT_BINS
+
+
+def perceptual_hash(image: Image.Image, hash_size: int = 8) -> int:
+    """Return a 64-bit difference hash (dHash) of an image.
+
+    The image is shrunk to a (hash_size + 1) x hash_size greyscale thumbnail and
+    each bit records whether a pixel is brighter than its right neighbour, so
+    re-encoded, resized or lightly recompressed copies of a picture usually hash
+    to the same value.
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def content_hash(image: Image.Image) -> str:
+    """Return a digest of an image's decoded pixels, equal only for identical pictures."""
+    digest = hashlib.sha1(f"{image.mode}:{image.size}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def color_key(dominant_hsv: np.ndarray) -> Tuple[int, int, int]:
+    """Quantized dominant color (see color_features.dominant_color), the color part of a cache key.
+
+    Perceptual hashes are computed in greyscale, so the same picture in
+    another color hashes alike; keying on this as well keeps them apart.
+    """
+    return tuple(int(value) * bins // 256 for value, bins in zip(np.clip(dominant_hsv, 0, 255), DOMINANT_BINS))
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after ``ttl`` seconds."""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value, counting a hit or a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            self._added(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def _added(self, key: Hashable):
+        """Called with the lock held after an entry is stored."""
+
+    def _remove(self, key: Hashable):
+        """Drop an entry; called with the lock held."""
+        del self._entries[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class PerceptualHashCache(TTLCache):
+    """TTL/LRU cache keyed by an image's perceptual hash plus query parameters.
+
+    A lookup that misses on the exact hash falls back to the closest cached
+    hash with the same parameters within ``max_distance`` differing bits, so
+    near-identical uploads share an entry.
+
+    The 64 hash bits are split into ``max_distance + 1`` bands; two hashes
+    that close must agree on at least one band, so only the entries sharing
+    a band with the lookup are compared.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600.0, max_distance: int = 4):
+        super().__init__(max_size, ttl)
+        self.max_distance = max_distance
+        bands = min(max_distance + 1, 64)
+        edges = [64 * band // bands for band in range(bands + 1)]
+        # (shift, mask) of each band
+        self._band_bits: List[Tuple[int, int]] = [
+            (edges[band], (1 << (edges[band + 1] - edges[band])) - 1) for band in range(bands)
+        ]
+        # (band, band value, params) -> keys of the entries holding it
+        self._bands: Dict[Tuple, Set[Tuple]] = {}
+
+    def _band_keys(self, key: Tuple) -> List[Tuple]:
+        return [(band, (key[0] >> shift) & mask, key[1:]) for band, (shift, mask) in enumerate(self._band_bits)]
+
+    def _added(self, key: Tuple):
+        if self.max_distance > 0:
+            for band_key in self._band_keys(key):
+                self._bands.setdefault(band_key, set()).add(key)
+
+    def _remove(self, key: Tuple):
+        super()._remove(key)
+        if self.max_distance > 0:
+            for band_key in self._band_keys(key):
+                keys = self._bands.get(band_key)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._bands[band_key]
+
+    def get_similar(self, image_hash: int, params: Tuple = (), default: Any = None) -> Any:
+        key = (image_hash,) + tuple(params)
+        if self.max_distance > 0:
+            with self._lock:
+                if key not in self._entries:
+                    best, best_distance = None, self.max_distance + 1
+                    for band_key in self._band_keys(key):
+                        for cached_key in self._bands.get(band_key, ()):
+                            distance = (cached_key[0] ^ image_hash).bit_count()
+                            if distance < best_distance:
+                                best, best_distance = cached_key, distance
+                    if best is not None:
+                        key = best
+        return self.get(key, default)
+
+    def put_similar(self, image_hash: int, value: Any, params: Tuple = ()):
+        self.put((image_hash,) + tuple(params), value)
+
+    def stats(self) -> dict:
+        return {**super().stats(), "max_hash_distance": self.max_distance}
@@ -0,0 +1,41 @@
+# services/search_results.py
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from bson.objectid import ObjectId
+
+
+def encode_product_ids(product_ids: List[str]) -> np.ndarray:
+    """Pack string ObjectIds into an (n, 12) array of their raw bytes."""
+    raw = b"".join(ObjectId(product_id).binary for product_id in product_ids)
+    return np.frombuffer(raw, dtype=np.uint8).reshape(-1, 12).copy()
+
+
+def decode_product_id(raw: np.ndarray) -> str:
+    """Turn one row of a packed id array back into an ObjectId string."""
+    return raw.tobytes().hex()
+
+
+async def fetch_ranked_products(database, ranked: List[Tuple[str, float]]) -> List[Dict[Any, Any]]:
+    """Fetch ranked products in one query, keeping rank order and adding scores."""
+    return (await fetch_ranked_product_lists(database, [ranked]))[0]
+
+
+async def fetch_ranked_product_lists(database, ranked_lists: List[List[Tuple[str, float]]]) -> List[List[Dict[Any, Any]]]:
+    """fetch_ranked_products() for several rankings, with one query for all of them."""
+    product_ids = {product_id for ranked in ranked_lists for product_id, _ in ranked}
+    if not product_ids:
+        return [[] for _ in ranked_lists]
+    cursor = database.products.find({"_id": {"$in": [ObjectId(pid) for pid in product_ids]}})
+    products_by_id = {str(product["_id"]): product async for product in cursor}
+    results = []
+    for ranked in ranked_lists:
+        products = []
+        for product_id, score in ranked:
+            product = products_by_id.get(product_id)
+            if product is None:
+                continue
+            # Copied: a product can appear in several rankings with different scores
+            products.append({**product, "_id": product_id, "similarity_score": score})
+        results.append(products)
+    return results
@@ -0,0 +1,69 @@
+# services/search_sessions.py
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from fastapi import HTTPException
+
+from app.services.search_results import fetch_ranked_products
+
+# Ranked candidate lists of recent image searches, so "load more" can page
+# through them without encoding the image again. Kept in Mongo rather than in
+# memory so any API worker can serve the next page.
+SEARCH_SESSIONS_COLLECTION = "image_search_sessions"
+# Seconds a candidate list stays available after the search
+SEARCH_SESSION_TTL = int(os.getenv("IMAGE_SEARCH_SESSION_TTL", "1800"))
+# Candidates ranked and kept per search
+SEARCH_SESSION_DEPTH = int(os.getenv("IMAGE_SEARCH_SESSION_DEPTH", "120"))
+
+_indexed = False
+
+
+async def _sessions_collection(database):
+    global _indexed
+    collection = database[SEARCH_SESSIONS_COLLECTION]
+    if not _indexed:
+        # MongoDB deletes expired lists in the background
+        await collection.create_index("created_at", expireAfterSeconds=SEARCH_SESSION_TTL)
+        _indexed = True
+    return collection
+
+
+async def start_search(database, ranked: List[Tuple[str, float]], limit: int,
+                       status: Optional[str] = "approved") -> Tuple[List[Dict[Any, Any]], Optional[str]]:
+    """Return the first page of a ranked candidate list, and a search id when there are more pages.
+
+    ``status`` is the product status the search was filtered by; later pages
+    leave out products whose status has changed since.
+    """
+    products = await fetch_ranked_products(database, ranked[:limit])
+    if len(ranked) <= limit:
+        return products, None
+    collection = await _sessions_collection(database)
+    result = await collection.insert_one({
+        "ranked": [[product_id, score] for product_id, score in ranked],
+        "status": status,
+        "created_at": datetime.utcnow(),
+    })
+    return products, str(result.inserted_id)
+
+
+async def search_page(database, search_id: str, offset: int, limit: int) -> Tuple[List[Dict[Any, Any]], int]:
+    """Return one page of a stored search and the total number of candidates.
+
+    Products no longer matching the search's status filter (e.g. unapproved
+    after the search) are dropped from the page, so it may come back short.
+    """
+    session = None
+    if ObjectId.is_valid(search_id):
+        collection = await _sessions_collection(database)
+        session = await collection.find_one({"_id": ObjectId(search_id)})
+    if session is None:
+        raise HTTPException(status_code=404, detail="Search not found or expired; search again")
+    ranked = [(product_id, float(score)) for product_id, score in session["ranked"]]
+    products = await fetch_ranked_products(database, ranked[offset:offset + limit])
+    status = session.get("status")
+    if status:
+        products = [product for product in products if product.get("status") == status]
+    return products, len(ranked)
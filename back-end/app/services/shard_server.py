@@ -0,0 +1,288 @@
+# services/shard_server.py
+"""Serves one partition of the published image index to sharded API workers.
+
+Each shard loads the current generation under IMAGE_INDEX_DIR (e.g. one
+written by scripts/build_image_index.py), keeps only the products it owns
+(see index_shards.shard_of) and answers top-k searches for query embeddings.
+It never loads the CLIP model, so it needs neither torch nor a GPU:
+
+    python -m app.services.shard_server --shard 0 --shards 4 --address 127.0.0.1:8801
+
+Point the API (or inference server) at the shards, in shard order, with
+IMAGE_SEARCH_SHARDS=127.0.0.1:8801,127.0.0.1:8802,... A newer generation is
+picked up as soon as it is published. Products changed through the API since
+then are kept in memory and applied again on top of reloaded generations,
+until a full build that read the catalog after the change is published; a
+restarted shard forgets them until the next generation.
+"""
+import argparse
+import asyncio
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from fastapi import HTTPException
+
+from app.schemas.imagesearch import ImageSearchFilters
+from app.services.index_artifact import load_generation, read_current
+from app.services.index_shards import pack_arrays, shard_of, unpack_arrays
+from app.services.inference_protocol import read_message, start_server, write_message
+from app.services.product_filters import ProductAttributes
+from app.services.vector_index import load_vector_index
+
+# Same default as imagesearch_service, which cannot be imported here without torch
+IMAGE_INDEX_DIR = os.getenv(
+    "IMAGE_INDEX_DIR",
+    os.path.join(os.path.dirname(__file__), "..", "..", "data", "image_index"),
+)
+IVF_NPROBE = int(os.getenv("IMAGE_SEARCH_IVF_NPROBE", "8"))
+# Seconds between checks for a newly published generation
+INDEX_POLL_INTERVAL = float(os.getenv("IMAGE_SEARCH_INDEX_POLL_SECONDS", "2"))
+# Rebuild the shard's index once this share of its rows are deleted placeholders
+INDEX_COMPACT_RATIO = 0.25
+# Generation arrays shared by all rows rather than holding one entry per row
+SHARED_ARRAYS = ("centroids",)
+
+
+class IndexShard:
+    """The rows of one shard, with their hue, color descriptor and filter attributes."""
+
+    def __init__(self, shard: int, shards: int, index_dir: str = IMAGE_INDEX_DIR, generation: Optional[str] = None):
+        if not 0 <= shard < shards:
+            raise ValueError(f"Shard {shard} is outside 0..{shards - 1}")
+        self.shard, self.shards = shard, shards
+        self.index_dir = index_dir
+        # A pinned generation is served as is; otherwise CURRENT is followed
+        self.pinned = generation
+        self.generation: Optional[str] = None
+        self.manifest: Dict[str, Any] = {}
+        self.vector_index = None
+        self.product_ids = np.zeros((0, 12), dtype=np.uint8)
+        self.color_descriptors = np.zeros((0, 0), dtype=np.float16)
+        self.hsv = np.zeros((0, 3), dtype=np.float32)
+        self.attributes = ProductAttributes()
+        # Latest live change per product: raw ObjectId -> (time received,
+        # (features, product) or None once removed), replayed onto reloaded
+        # generations that do not include it yet
+        self._journal: Dict[bytes, Tuple[float, Optional[Tuple[Dict[str, np.ndarray], Dict[str, Any]]]]] = {}
+        self.error: Optional[str] = None
+
+    def status(self) -> Dict[str, Any]:
+        products = 0
+        if self.vector_index is not None:
+            products = len(self.vector_index) - self.vector_index.dead_count
+        return {
+            "ready": self.vector_index is not None,
+            "shard": self.shard,
+            "shards": self.shards,
+            "generation": self.generation,
+            "model": self.manifest.get("model"),
+            "preprocessing_version": self.manifest.get("preprocessing_version", "1") if self.manifest else None,
+            "kind": self.manifest.get("kind"),
+            "dtype": self.manifest.get("dtype"),
+            "products": products,
+            "live_updates": len(self._journal),
+            "error": self.error,
+        }
+
+    def _load(self, generation: str) -> Dict[str, Any]:
+        """Read this shard's rows of a generation into memory (runs in a worker thread)."""
+        manifest, arrays = load_generation(self.index_dir, generation)
+        rows = np.flatnonzero(shard_of(arrays["product_ids"], self.shards) == self.shard)
+        own = {name: array if name in SHARED_ARRAYS else np.asarray(array[rows]) for name, array in arrays.items()}
+        vector_index = load_vector_index(manifest["kind"], own, manifest["dtype"], nprobe=IVF_NPROBE)
+        vector_index.quantization_report = manifest.get("quantization")
+        return {
+            "generation": generation,
+            "manifest": manifest,
+            "vector_index": vector_index,
+            "product_ids": own["product_ids"],
+            "color_descriptors": own["color_descriptors"],
+            "hsv": own["hsv"],
+            "attributes": ProductAttributes.from_arrays(own, manifest["attribute_vocab"]),
+        }
+
+    def _swap(self, loaded: Dict[str, Any]):
+        self.generation = loaded["generation"]
+        self.manifest = loaded["manifest"]
+        self.vector_index = loaded["vector_index"]
+        self.product_ids = loaded["product_ids"]
+        self.color_descriptors = loaded["color_descriptors"]
+        self.hsv = loaded["hsv"]
+        self.attributes = loaded["attributes"]
+        catalog_read_at = self.manifest.get("catalog_read_at")
+        if catalog_read_at is not None:
+            # Full builds read the catalog after these changes already hold them, and
+            # may hold newer ones made without the API (e.g. by the import script)
+            self._journal = {raw: entry for raw, entry in self._journal.items() if entry[0] >= catalog_read_at}
+        for raw, (_, change) in self._journal.items():
+            self._apply(raw, change)
+        print(
+            f"Shard {self.shard}/{self.shards} serving generation {self.generation} "
+            f"({self.status()['products']} products, {len(self._journal)} live updates)"
+        )
+
+    async def refresh(self):
+        """Load the pinned or current generation if it is not the one being served."""
+        generation = self.pinned or read_current(self.index_dir)
+        if generation is None or generation == self.generation:
+            return
+        try:
+            loaded = await asyncio.to_thread(self._load, generation)
+        except (OSError, ValueError, KeyError) as e:
+            self.error = f"Could not load generation {generation}: {e}"
+            print(self.error)
+            return
+        self.error = None
+        self._swap(loaded)
+
+    async def watch(self):
+        """Follow CURRENT for newly published generations."""
+        while True:
+            await self.refresh()
+            await asyncio.sleep(INDEX_POLL_INTERVAL)
+
+    def _find_rows(self, raw: bytes) -> np.ndarray:
+        packed = np.frombuffer(raw, dtype=np.uint8)
+        return np.flatnonzero((self.product_ids == packed).all(axis=1) & self.vector_index.live)
+
+    def _apply(self, raw: bytes, change: Optional[Tuple[Dict[str, np.ndarray], Dict[str, Any]]]):
+        """Remove a product's row and, unless it was removed, append its new one."""
+        rows = self._find_rows(raw)
+        if len(rows):
+            self.vector_index.remove(rows)
+        if change is not None:
+            features, product = change
+            self.vector_index.add(features["embedding"])
+            self.product_ids = np.vstack((self.product_ids, np.frombuffer(raw, dtype=np.uint8)[None, :]))
+            self.color_descriptors = np.vstack((self.color_descriptors, features["color_descriptor"][None, :]))
+            self.hsv = np.vstack((self.hsv, features["dominant_hsv"][None, :]))
+            self.attributes.append(product)
+        if self.vector_index.dead_count > INDEX_COMPACT_RATIO * len(self.vector_index):
+            self._compact()
+
+    def _compact(self):
+        """Drop the rows of removed products."""
+        rows = np.flatnonzero(self.vector_index.live)
+        vector_index = load_vector_index(
+            self.vector_index.kind, self.vector_index.to_arrays(rows), self.vector_index.dtype, nprobe=IVF_NPROBE
+        )
+        vector_index.quantization_report = self.vector_index.quantization_report
+        self.vector_index = vector_index
+        self.product_ids = self.product_ids[rows]
+        self.color_descriptors = self.color_descriptors[rows]
+        self.hsv = self.hsv[rows]
+        self.attributes = self.attributes.take(rows)
+
+    def upsert(self, arrays: Dict[str, np.ndarray], product: Dict[str, Any]):
+        raw = arrays["product_id"].tobytes()
+        self._check_owner(raw)
+        features = {
+            "embedding": np.array(arrays["embedding"], dtype=np.float32),
+            "color_descriptor": np.array(arrays["color_descriptor"], dtype=self.color_descriptors.dtype),
+            "dominant_hsv": np.array(arrays["dominant_hsv"], dtype=np.float32),
+        }
+        self._journal[raw] = (time.time(), (features, product))
+        self._apply(raw, (features, product))
+
+    def remove(self, raw: bytes):
+        self._check_owner(raw)
+        self._journal[raw] = (time.time(), None)
+        self._apply(raw, None)
+
+    def _check_owner(self, raw: bytes):
+        owner = int(shard_of(np.frombuffer(raw, dtype=np.uint8), self.shards)[0])
+        if owner != self.shard:
+            raise HTTPException(status_code=400, detail=f"Product {raw.hex()} belongs to shard {owner}")
+
+    def search(self, queries: np.ndarray, k: int, filters: ImageSearchFilters) -> Dict[str, np.ndarray]:
+        """This shard's top-k candidates per query, with the features the coordinator re-ranks by."""
+        scores, rows = self.vector_index.search(queries, k, mask=self.attributes.mask(filters))
+        rows = np.where(rows >= 0, rows, 0)
+        return {
+            "scores": scores.astype(np.float32),
+            "product_ids": self.product_ids[rows],
+            "hues": self.hsv[rows, 0],
+            "colors": self.color_descriptors[rows],
+        }
+
+
+class ShardServer:
+    """Answers framed requests from ShardedIndex clients."""
+
+    def __init__(self, shard: IndexShard):
+        self.shard = shard
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve requests on one connection, one at a time, until the client closes it."""
+        try:
+            while True:
+                try:
+                    header, payload = await read_message(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                data = b""
+                try:
+                    result, data = self.dispatch(header, payload)
+                    response = {"ok": True, "result": result}
+                except HTTPException as e:
+                    response = {"ok": False, "status": e.status_code, "detail": e.detail}
+                except Exception as e:
+                    print(f"Shard request {header.get('op')} failed: {e}")
+                    response = {"ok": False, "status": 500, "detail": str(e)}
+                await write_message(writer, response, data)
+        except ConnectionError as e:
+            print(f"Shard connection closed: {e}")
+        finally:
+            writer.close()
+
+    def dispatch(self, header: Dict[str, Any], payload: bytes) -> Tuple[Any, bytes]:
+        # Synchronous, so a search never sees a half-applied update or reload
+        op, params = header.get("op"), header.get("params", {})
+        shard = self.shard
+        if op == "status":
+            return shard.status(), b""
+        if shard.vector_index is None:
+            raise HTTPException(status_code=503, detail=shard.error or "No index generation loaded yet")
+        if op == "search":
+            queries = np.frombuffer(payload, dtype=np.float32).reshape(params["shape"])
+            filters = ImageSearchFilters(**params.get("filters", {}))
+            return pack_arrays(shard.search(queries, int(params["k"]), filters))
+        if op == "upsert":
+            shard.upsert(unpack_arrays(params["arrays"], payload), params["product"])
+            return shard.status(), b""
+        if op == "remove":
+            shard.remove(bytes.fromhex(params["product_id"]))
+            return shard.status(), b""
+        raise HTTPException(status_code=400, detail=f"Unknown operation '{op}'")
+
+
+async def serve(shard: IndexShard, address: str):
+    await shard.refresh()
+    listener = await start_server(ShardServer(shard).handle_connection, address)
+    print(f"Image index shard {shard.shard}/{shard.shards} listening on {address}")
+    watcher = asyncio.create_task(shard.watch())
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        watcher.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Image index shard server")
+    parser.add_argument("--shard", type=int, required=True, help="This shard's number, from 0")
+    parser.add_argument("--shards", type=int, required=True, help="Total number of shards")
+    parser.add_argument("--address", required=True, help='"unix:/path/to.sock" or "host:port"')
+    parser.add_argument("--index-dir", default=IMAGE_INDEX_DIR)
+    parser.add_argument("--generation", default=None, help="Serve this generation instead of following CURRENT")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(IndexShard(args.shard, args.shards, args.index_dir, args.generation), args.address))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import asyncio
+import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.routes import users, cart, images, products, admin
@@ -17,6 +19,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Image search paging (see app/routes/imagesearch.py)
+    expose_headers=["X-Search-Id", "X-Total-Count"],
 )
 
 @app.on_event("startup")
@@ -25,9 +29,18 @@ async def startup_db():
     app.mongodb_client = await connect_to_mongo()
     app.mongodb = app.mongodb_client["smartwear"]
 
+@app.on_event("startup")
+async def start_image_search_warmup():
+    """Load the image search model and index in the background."""
+    if os.getenv("IMAGE_SEARCH_WARMUP", "1") != "0":
+        app.image_search_warmup = asyncio.create_task(imagesearch.warm_up(app.mongodb))
+
 @app.on_event("shutdown")
 async def shutdown_db():
-    """Close MongoDB connection."""
+    """Save image search state and close the MongoDB connection."""
+    if hasattr(app, "image_search_warmup"):
+        app.image_search_warmup.cancel()
+    await imagesearch.shut_down()
     if hasattr(app, "mongodb_client"):
         app.mongodb_client.close()
 
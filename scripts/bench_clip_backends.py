@@ -0,0 +1,135 @@
+"""Compare the CLIP image encoder backends against the reference PyTorch model.
+
+For each backend (see app/services/clip_backends.py) and intra-op thread
+count, reports single-image latency (the search query path), batch
+throughput (the indexing path), the speed-up over the reference model at
+the same thread count, and embedding drift: cosine similarity to the
+reference embeddings and recall@k of each image's nearest neighbours
+among the others, i.e. how much search results would change.
+
+    python scripts/bench_clip_backends.py --images-dir back-end/data/images --threads 1 4
+    cd back-end && IMAGE_SEARCH_CLIP_BACKEND=quantized IMAGE_SEARCH_CLIP_THREADS=4 uvicorn main:app
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "back-end")
+sys.path.insert(0, BACKEND_DIR)
+
+import torch  # noqa: E402
+
+from app.services.clip_backends import CLIP_BACKENDS, load_clip  # noqa: E402
+from app.services.imagesearch_service import CLIP_MODEL_NAME, IMAGE_INDEX_DIR  # noqa: E402
+from bench_dominant_color import synthetic_image  # noqa: E402
+
+# Single-image latency is measured on at most this many images
+LATENCY_IMAGES = 32
+
+
+def load_images(args):
+    if args.images_dir:
+        paths = sorted(glob.glob(os.path.join(args.images_dir, "*")))[:args.images]
+        return [Image.open(path).convert("RGB") for path in paths]
+    rng = np.random.default_rng(args.seed)
+    return [synthetic_image(rng) for _ in range(args.images)]
+
+
+def embed(encoder, inputs: torch.Tensor, batch_size: int) -> np.ndarray:
+    """Normalized embeddings of preprocessed images, as the service computes them."""
+    blocks = []
+    with torch.no_grad():
+        for start in range(0, len(inputs), batch_size):
+            embeddings = encoder.encode_image(inputs[start:start + batch_size]).float()
+            blocks.append((embeddings / embeddings.norm(dim=-1, keepdim=True)).numpy())
+    return np.concatenate(blocks)
+
+
+def measure(encoder, inputs: torch.Tensor, batch_size: int):
+    embed(encoder, inputs[:batch_size], batch_size)  # warm-up
+    latencies = []
+    for image in inputs[:LATENCY_IMAGES]:
+        start = time.perf_counter()
+        embed(encoder, image[None], 1)
+        latencies.append((time.perf_counter() - start) * 1000)
+    start = time.perf_counter()
+    embeddings = embed(encoder, inputs, batch_size)
+    elapsed = time.perf_counter() - start
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "images_per_second": len(inputs) / elapsed,
+    }, embeddings
+
+
+def neighbours(embeddings: np.ndarray, k: int) -> np.ndarray:
+    scores = embeddings @ embeddings.T
+    np.fill_diagonal(scores, -np.inf)
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def drift(reference: np.ndarray, embeddings: np.ndarray, k: int):
+    cosine = np.sum(reference * embeddings, axis=1)
+    reference_rows, rows = neighbours(reference, k), neighbours(embeddings, k)
+    recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(reference_rows, rows)])
+    return {"cosine_mean": float(cosine.mean()), "cosine_min": float(cosine.min()), f"recall@{k}": float(recall)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--backends", nargs="+", choices=CLIP_BACKENDS, default=list(CLIP_BACKENDS[1:]))
+    parser.add_argument("--threads", type=int, nargs="+", default=[0],
+                        help="intra-op thread counts to try (0: library default)")
+    parser.add_argument("--images", type=int, default=128)
+    parser.add_argument("--images-dir", help="real images to encode (default: synthetic ones)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--k", type=int, default=10, help="neighbours compared for recall")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    images = load_images(args)
+    if len(images) <= args.k:
+        print(f"Need more than {args.k} images")
+        return 1
+    results = []
+    reference_embeddings = None
+    for threads in args.threads:
+        reference, preprocess = load_clip(CLIP_MODEL_NAME, "cpu", backend="torch", threads=threads)
+        inputs = torch.stack([preprocess(image) for image in images])
+        reference_speed, embeddings = measure(reference, inputs, args.batch_size)
+        if reference_embeddings is None:
+            reference_embeddings = embeddings
+        print(f"threads={threads or torch.get_num_threads()}: torch p50 {reference_speed['p50_ms']:.1f} ms, "
+              f"{reference_speed['images_per_second']:.1f} images/sec")
+        results.append({"backend": "torch", "threads": threads, **reference_speed})
+        for backend in args.backends:
+            encoder, _ = load_clip(CLIP_MODEL_NAME, "cpu", backend=backend, threads=threads, cache_dir=IMAGE_INDEX_DIR)
+            speed, embeddings = measure(encoder, inputs, args.batch_size)
+            result = {
+                "backend": backend,
+                "threads": threads,
+                **speed,
+                "latency_speedup": reference_speed["p50_ms"] / speed["p50_ms"],
+                "throughput_speedup": speed["images_per_second"] / reference_speed["images_per_second"],
+                **drift(reference_embeddings, embeddings, args.k),
+            }
+            results.append(result)
+            print(f"{'':>10}{backend}: p50 {speed['p50_ms']:.1f} ms ({result['latency_speedup']:.2f}x), "
+                  f"{speed['images_per_second']:.1f} images/sec ({result['throughput_speedup']:.2f}x), "
+                  f"cosine mean {result['cosine_mean']:.4f} min {result['cosine_min']:.4f}, "
+                  f"recall@{args.k} {result[f'recall@{args.k}']:.3f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"model": CLIP_MODEL_NAME, "images": len(images), "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""Compare the histogram dominant-color extractor with the previous KMeans one.
+
+Times app.services.color_features.dominant_color (on the shared 64x64
+center sample) against dominant_color_kmeans (k-means over every pixel of
+the full-size center crop) and reports how often the two agree on hue,
+which is what the image search color filter compares. Runs on synthetic
+garment-like images, or on real catalog images with --images-dir. The
+KMeans side needs scikit-learn and is skipped without it.
+
+    python scripts/bench_dominant_color.py --images 200
+    python scripts/bench_dominant_color.py --images-dir back-end/data/images --json out.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "back-end")
+sys.path.insert(0, BACKEND_DIR)
+
+from app.services.color_features import center_sample, dominant_color, dominant_color_kmeans  # noqa: E402
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+# Hue difference (PIL scale, 0-255) below which the search treats colors as the same
+HUE_THRESHOLD = 20
+
+
+def synthetic_image(rng: np.random.Generator, width: int = 600, height: int = 800) -> Image.Image:
+    """A light background with a garment-shaped block of one main color, a trim color and noise."""
+    background = tuple(int(c) for c in rng.integers(200, 256, size=3))
+    image = Image.new("RGB", (width, height), background)
+    draw = ImageDraw.Draw(image)
+    main = tuple(int(c) for c in rng.integers(0, 256, size=3))
+    trim = tuple(int(c) for c in rng.integers(0, 256, size=3))
+    left, right = int(width * rng.uniform(0.1, 0.25)), int(width * rng.uniform(0.75, 0.9))
+    top, bottom = int(height * rng.uniform(0.05, 0.2)), int(height * rng.uniform(0.8, 0.95))
+    draw.rectangle((left, top, right, bottom), fill=main)
+    for _ in range(int(rng.integers(2, 8))):
+        x, y = int(rng.integers(left, right)), int(rng.integers(top, bottom))
+        size = int(rng.integers(10, 80))
+        draw.ellipse((x, y, x + size, y + size), fill=trim)
+    pixels = np.asarray(image, dtype=np.int16)
+    noise = rng.normal(0, 8, size=pixels.shape)
+    return Image.fromarray(np.clip(pixels + noise, 0, 255).astype(np.uint8))
+
+
+def load_images(args):
+    if args.images_dir:
+        names = sorted(name for name in os.listdir(args.images_dir) if name.lower().endswith(IMAGE_EXTENSIONS))
+        for name in names[:args.images]:
+            yield Image.open(os.path.join(args.images_dir, name)).convert("RGB")
+    else:
+        rng = np.random.default_rng(args.seed)
+        for _ in range(args.images):
+            yield synthetic_image(rng)
+
+
+def hue_distance(a: float, b: float) -> float:
+    """Circular distance between two PIL hues."""
+    diff = abs(a - b) % 256
+    return min(diff, 256 - diff)
+
+
+def timing_summary(seconds):
+    ms = np.array(seconds) * 1000
+    return {"mean_ms": float(ms.mean()), "p50_ms": float(np.percentile(ms, 50)),
+            "p95_ms": float(np.percentile(ms, 95))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--images", type=int, default=100, help="number of images to process")
+    parser.add_argument("--images-dir", help="directory of real images (default: synthetic images)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    try:
+        import sklearn  # noqa: F401
+        with_kmeans = True
+    except ImportError:
+        print("scikit-learn is not installed; timing the histogram extractor only")
+        with_kmeans = False
+
+    histogram_times, kmeans_times, hue_diffs = [], [], []
+    for image in load_images(args):
+        started = time.perf_counter()
+        fast = dominant_color(center_sample(image))
+        histogram_times.append(time.perf_counter() - started)
+        if with_kmeans:
+            started = time.perf_counter()
+            reference = dominant_color_kmeans(image)
+            kmeans_times.append(time.perf_counter() - started)
+            hue_diffs.append(hue_distance(float(fast[0]), float(reference[0])))
+    if not histogram_times:
+        print("No images to process")
+        return 1
+
+    results = {"images": len(histogram_times), "histogram": timing_summary(histogram_times)}
+    print(f"{len(histogram_times)} images")
+    print("histogram: mean {mean_ms:.2f} ms, p50 {p50_ms:.2f} ms, p95 {p95_ms:.2f} ms".format(**results["histogram"]))
+    if with_kmeans:
+        results["kmeans"] = timing_summary(kmeans_times)
+        results["speedup"] = results["kmeans"]["mean_ms"] / results["histogram"]["mean_ms"]
+        diffs = np.array(hue_diffs)
+        results["hue_agreement"] = {
+            f"within_{HUE_THRESHOLD}": float((diffs < HUE_THRESHOLD).mean()),
+            "within_10": float((diffs < 10).mean()),
+            "median_diff": float(np.median(diffs)),
+            "p90_diff": float(np.percentile(diffs, 90)),
+        }
+        print("kmeans:    mean {mean_ms:.2f} ms, p50 {p50_ms:.2f} ms, p95 {p95_ms:.2f} ms".format(**results["kmeans"]))
+        print(f"speed-up:  {results['speedup']:.1f}x")
+        agreement = results["hue_agreement"]
+        print(f"hue agreement: {agreement[f'within_{HUE_THRESHOLD}']:.1%} within {HUE_THRESHOLD}, "
+              f"{agreement['within_10']:.1%} within 10, median diff {agreement['median_diff']:.1f}, "
+              f"p90 diff {agreement['p90_diff']:.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,290 @@
+"""Benchmark image search latency and recall on a synthetic catalog.
+
+Measures p50/p95/p99 latency of each search stage and, for the approximate
+and compact index variants, recall@k against exact float32 search:
+
+- decode: decode_image() on phone-sized JPEGs (or the images in --images-dir)
+- encode: CLIP forward pass plus color features for one query image
+  (skipped when torch/clip are not installed)
+- similarity: nearest-neighbour search over the catalog embeddings
+- filtering: building the filter mask plus a masked search
+
+Catalog embeddings are clustered random unit vectors, so IVF behaves much
+as it does on real CLIP embeddings. Results are written as JSON for
+comparing runs across commits:
+
+    python scripts/bench_image_search.py --sizes 1000 10000 100000 --output bench.json
+    python scripts/bench_image_search.py --compare bench.json
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "back-end")
+sys.path.insert(0, BACKEND_DIR)
+
+from app.schemas.imagesearch import ImageSearchFilters  # noqa: E402
+from app.services.image_io import decode_image  # noqa: E402
+from app.services.product_filters import ProductAttributes  # noqa: E402
+from app.services.vector_index import build_vector_index  # noqa: E402
+
+EMBEDDING_DIM = 512
+# Candidates fetched by find_similar_products before the color re-ranking
+TOP_N_CLIP = 20
+GENDERS = ["Men", "Women", "Girl", "Boy"]
+SUBCATEGORIES = ["shirts", "trousers", "kurtas", "shalwar kameez", "jackets", "sherwani"]
+# (kind, dtype, nprobe) variants compared against exact float32
+VARIANTS = [
+    ("exact", "float16", None),
+    ("exact", "int8", None),
+    ("ivf", "float32", 4),
+    ("ivf", "float32", 8),
+    ("ivf", "float32", 16),
+    ("ivf", "float32", 32),
+    ("ivf", "int8", 16),
+]
+
+
+def percentiles(samples_ms):
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    return {
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p95_ms": float(np.percentile(samples, 95)),
+        "p99_ms": float(np.percentile(samples, 99)),
+        "mean_ms": float(samples.mean()),
+        "runs": len(samples),
+    }
+
+
+def timed(fn, inputs):
+    """Call fn on each input, returning per-call latencies in ms and the results."""
+    samples, results = [], []
+    for item in inputs:
+        start = time.perf_counter()
+        results.append(fn(item))
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return samples, results
+
+
+def synthetic_catalog(n, rng):
+    """Clustered unit embeddings plus random product attributes."""
+    clusters = max(1, int(np.sqrt(n)))
+    centers = rng.normal(size=(clusters, EMBEDDING_DIM)).astype(np.float32)
+    embeddings = centers[rng.integers(0, clusters, n)] + 0.6 * rng.normal(size=(n, EMBEDDING_DIM)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    products = [
+        {
+            "status": "approved" if rng.random() < 0.8 else "pending",
+            "gender": GENDERS[rng.integers(len(GENDERS))],
+            "subcategory": SUBCATEGORIES[rng.integers(len(SUBCATEGORIES))],
+            "price": float(rng.integers(500, 20000)),
+        }
+        for _ in range(n)
+    ]
+    return embeddings, ProductAttributes.from_products(products)
+
+
+def synthetic_queries(embeddings, count, rng):
+    """Perturbed catalog vectors, like photos of catalog items."""
+    queries = embeddings[rng.choice(len(embeddings), count, replace=len(embeddings) < count)]
+    queries = queries + 0.02 * rng.normal(size=queries.shape).astype(np.float32)
+    return (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+
+def synthetic_jpegs(count, rng, size=(1200, 1600)):
+    """Phone-photo-sized JPEGs with smooth gradients and noise."""
+    images = []
+    width, height = size
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    for _ in range(count):
+        base = rng.random(3).astype(np.float32) * 255
+        pixels = base * (0.5 + 0.5 * x) * (0.5 + 0.5 * y) + rng.normal(0, 12, (height, width, 3))
+        buffer = io.BytesIO()
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, "JPEG", quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+def bench_decode(args, rng):
+    if args.images_dir:
+        paths = sorted(glob.glob(os.path.join(args.images_dir, "*")))[:args.images]
+        blobs = [open(path, "rb").read() for path in paths]
+        source = args.images_dir
+    else:
+        blobs = synthetic_jpegs(args.images, rng)
+        source = "synthetic 1200x1600 JPEG"
+    samples, images = timed(decode_image, blobs)
+    return {"source": source, **percentiles(samples)}, images
+
+
+def bench_encode(images):
+    """Query encoding as the service does it, if torch and clip are available."""
+    try:
+        from app.services.clip_backends import load_clip
+        from app.services.imagesearch_service import CLIP_MODEL_NAME, IMAGE_INDEX_DIR, ImageSearchService
+    except ImportError as e:
+        return {"skipped": f"{e}"}
+    service = ImageSearchService(database=None)
+    service.model, service.preprocess = load_clip(CLIP_MODEL_NAME, service.device, cache_dir=IMAGE_INDEX_DIR)
+    service._encode_query_batch(images[:1])  # warm-up
+    samples, _ = timed(lambda image: service._encode_query_batch([image]), images)
+    return {"device": service.device, "backend": service.model.backend, **percentiles(samples)}
+
+
+def recall_at_k(reference_rows, rows, k):
+    hits = [len(set(a[:k]) & set(b[b >= 0][:k])) / k for a, b in zip(reference_rows, rows)]
+    return float(np.mean(hits))
+
+
+def bench_catalog(n, args, rng):
+    embeddings, attributes = synthetic_catalog(n, rng)
+    queries = synthetic_queries(embeddings, args.queries, rng)
+    filters = ImageSearchFilters(gender="Men", max_price=8000.0)
+    k = args.k
+    result = {"catalog_size": n, "queries": len(queries), "k": k}
+
+    start = time.perf_counter()
+    exact = build_vector_index(embeddings, "exact")
+    result["exact_build_s"] = time.perf_counter() - start
+    samples, exact_results = timed(lambda q: exact.search(q, TOP_N_CLIP), queries)
+    result["similarity"] = percentiles(samples)
+    reference = np.concatenate([rows for _, rows in exact_results])
+
+    samples, masks = timed(lambda _: attributes.mask(filters), queries)
+    result["filter_mask"] = percentiles(samples)
+    mask = masks[0]
+    result["filter_selectivity"] = float(mask.mean())
+    samples, filtered_results = timed(lambda q: exact.search(q, TOP_N_CLIP, mask=mask), queries)
+    result["filtering"] = percentiles(samples)
+    filtered_reference = np.concatenate([rows for _, rows in filtered_results])
+
+    variants = []
+    for kind, dtype, nprobe in VARIANTS:
+        start = time.perf_counter()
+        index = build_vector_index(embeddings, kind, min_ivf_size=0, nprobe=nprobe or 8, dtype=dtype)
+        build_s = time.perf_counter() - start
+        search = (lambda q, m=None: index.search(q, TOP_N_CLIP, mask=m, nprobe=nprobe)) if kind == "ivf" \
+            else (lambda q, m=None: index.search(q, TOP_N_CLIP, mask=m))
+        samples, results = timed(search, queries)
+        rows = np.concatenate([found for _, found in results])
+        filtered_samples, filtered = timed(lambda q: search(q, mask), queries)
+        filtered_rows = np.concatenate([found for _, found in filtered])
+        variants.append({
+            "kind": kind,
+            "dtype": dtype,
+            "nprobe": nprobe,
+            "nlist": getattr(index, "nlist", None),
+            "build_s": build_s,
+            "index_bytes": index.nbytes,
+            "similarity": percentiles(samples),
+            "filtering": percentiles(filtered_samples),
+            f"recall@{k}": recall_at_k(reference, rows, k),
+            f"filtered_recall@{k}": recall_at_k(filtered_reference, filtered_rows, k),
+        })
+    result["variants"] = variants
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(report):
+    for stage in ("decode", "encode"):
+        stats = report[stage]
+        if "skipped" in stats:
+            print(f"{stage:>10}: skipped ({stats['skipped']})")
+        else:
+            print(f"{stage:>10}: p50 {stats['p50_ms']:.2f} ms  p95 {stats['p95_ms']:.2f} ms  p99 {stats['p99_ms']:.2f} ms")
+    for catalog in report["catalogs"]:
+        k = catalog["k"]
+        print(f"\ncatalog of {catalog['catalog_size']} products "
+              f"(filter keeps {catalog['filter_selectivity']:.0%})")
+        print(f"{'index':<22}{'sim p50':>10}{'sim p99':>10}{'filt p50':>10}{'recall':>9}{'filt rec':>10}")
+        print(f"{'exact float32':<22}{catalog['similarity']['p50_ms']:>10.2f}{catalog['similarity']['p99_ms']:>10.2f}"
+              f"{catalog['filtering']['p50_ms']:>10.2f}{1.0:>9.3f}{1.0:>10.3f}")
+        for variant in catalog["variants"]:
+            name = f"{variant['kind']} {variant['dtype']}" + (f" np={variant['nprobe']}" if variant["nprobe"] else "")
+            print(f"{name:<22}{variant['similarity']['p50_ms']:>10.2f}{variant['similarity']['p99_ms']:>10.2f}"
+                  f"{variant['filtering']['p50_ms']:>10.2f}{variant[f'recall@{k}']:>9.3f}"
+                  f"{variant[f'filtered_recall@{k}']:>10.3f}")
+
+
+def compare(report, baseline):
+    """Print p50 changes against a previous report."""
+    print(f"\nvs {baseline['meta'].get('git_commit')} ({baseline['meta'].get('timestamp')}):")
+    for stage in ("decode", "encode"):
+        old, new = baseline.get(stage, {}), report[stage]
+        if "p50_ms" in old and "p50_ms" in new:
+            print(f"{stage:>10}: p50 {old['p50_ms']:.2f} -> {new['p50_ms']:.2f} ms ({new['p50_ms'] / old['p50_ms']:.2f}x)")
+    old_catalogs = {catalog["catalog_size"]: catalog for catalog in baseline.get("catalogs", [])}
+    for catalog in report["catalogs"]:
+        old = old_catalogs.get(catalog["catalog_size"])
+        if old is None:
+            continue
+        for stage in ("similarity", "filtering"):
+            before, after = old[stage]["p50_ms"], catalog[stage]["p50_ms"]
+            print(f"{catalog['catalog_size']:>8} {stage}: p50 {before:.2f} -> {after:.2f} ms ({after / before:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--images", type=int, default=50, help="images for the decode and encode stages")
+    parser.add_argument("--images-dir", help="decode these images instead of synthetic ones")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-encode", action="store_true", help="skip the CLIP stage")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    report = {
+        "meta": {
+            "git_commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": args.seed,
+        },
+    }
+    report["decode"], images = bench_decode(args, rng)
+    report["encode"] = {"skipped": "--no-encode"} if args.no_encode else bench_encode(images)
+    report["catalogs"] = []
+    for n in args.sizes:
+        print(f"Benchmarking catalog of {n} products...", file=sys.stderr)
+        report["catalogs"].append(bench_catalog(n, args, rng))
+
+    print_summary(report)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
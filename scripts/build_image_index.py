@@ -0,0 +1,250 @@
+"""Build the image search index offline.
+
+Reads products from MongoDB, downloads and encodes their images with CLIP in
+a pool of worker processes, and publishes a versioned index generation (plus
+the embedding store) under the API's IMAGE_INDEX_DIR. Start the API with
+IMAGE_SEARCH_INDEX_STARTUP=load to serve it without re-indexing. Generations
+are tagged with the CLIP model and preprocessing version: API workers still
+running an older model keep serving their own generation, so an index for a
+new model can be built ahead of the deploy that switches to it.
+
+Each finished chunk is written to <index dir>/partial/, so an interrupted run
+picks up where it stopped when started again.
+
+    python scripts/build_image_index.py --workers 8
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "back-end")
+sys.path.insert(0, BACKEND_DIR)
+
+import httpx  # noqa: E402
+import torch  # noqa: E402
+from pymongo import MongoClient  # noqa: E402
+
+from app.database import MONGO_DB_URL  # noqa: E402
+from app.services.clip_backends import CLIP_BACKEND, CLIP_BACKENDS, load_clip  # noqa: E402
+from app.services.embedding_store import EmbeddingStore, image_key  # noqa: E402
+from app.services.image_io import ImageRejected, decode_image  # noqa: E402
+from app.services.index_artifact import BUILD_LOCK, STORE_LOCK, FileLock  # noqa: E402
+from app.services.imagesearch_service import (  # noqa: E402
+    CLIP_MODEL_NAME, EMBEDDING_DTYPE, ENCODE_BATCH_SIZE, IMAGE_FETCH_TIMEOUT, IMAGE_INDEX_DIR,
+    INDEX_FEATURES, IVF_MIN_SIZE, IVF_NLIST, IVF_NPROBE, PREPROCESSING_VERSION, VECTOR_INDEX_TYPE,
+    ImageSearchService, publish_index,
+)
+from app.services.product_filters import ProductAttributes  # noqa: E402
+from app.services.search_results import encode_product_ids  # noqa: E402
+from app.services.vector_index import build_vector_index  # noqa: E402
+
+# Concurrent image downloads inside each worker process
+DOWNLOADS_PER_WORKER = 8
+
+# Set up in each worker process by _init_worker()
+_service = None
+
+
+def _init_worker(torch_threads, backend, index_dir):
+    """Load CLIP once per worker process."""
+    global _service
+    _service = ImageSearchService(database=None)
+    _service.device = "cpu"
+    _service.model, _service.preprocess = load_clip(
+        CLIP_MODEL_NAME, "cpu", backend=backend, threads=torch_threads, cache_dir=index_dir
+    )
+
+
+def _download(client, image_url):
+    try:
+        response = client.get(image_url)
+        response.raise_for_status()
+        return decode_image(response.content)
+    except (httpx.HTTPError, ImageRejected, IOError) as e:
+        print(f"Error fetching image from {image_url}: {e}")
+        return None
+
+
+def _encode_chunk(items):
+    """Download and encode one chunk of (product_id, image_key, image_url) items.
+
+    Returns the ids and keys of the products that were encoded with their
+    feature arrays, in the same order.
+    """
+    with httpx.Client(timeout=IMAGE_FETCH_TIMEOUT, follow_redirects=True) as client, \
+            ThreadPoolExecutor(DOWNLOADS_PER_WORKER) as pool:
+        images = list(pool.map(lambda item: _download(client, item[2]), items))
+    done, inputs, features = [], [], {"color_descriptor": [], "dominant_hsv": []}
+    for (product_id, key, _), image in zip(items, images):
+        if image is None:
+            continue
+        try:
+            image_input, color_features = _service._prepare_image(image)
+        except Exception as e:
+            print(f"Error processing product {product_id}: {e}")
+            continue
+        done.append((product_id, key))
+        inputs.append(image_input)
+        for name, value in color_features.items():
+            features[name].append(value)
+    embeddings = [
+        _service._encode_batch(torch.stack(inputs[start:start + ENCODE_BATCH_SIZE]))
+        for start in range(0, len(inputs), ENCODE_BATCH_SIZE)
+    ]
+    features = {name: np.stack(values) for name, values in features.items() if values}
+    if embeddings:
+        features["embedding"] = np.concatenate(embeddings)
+    return done, features, len(items)
+
+
+def _save_partial(partial_dir, done, features):
+    """Write one finished chunk atomically."""
+    path = os.path.join(partial_dir, f"chunk-{uuid.uuid4().hex}.npz")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            product_ids=np.array([product_id for product_id, _ in done], dtype="U24"),
+            image_keys=np.array([key for _, key in done], dtype="U40"),
+            **{f"f_{name}": values for name, values in features.items()},
+        )
+    os.replace(tmp_path, path)
+
+
+def _load_partials(partial_dir, store):
+    """Put the features of chunks finished by earlier runs into the store."""
+    count = 0
+    for path in sorted(glob.glob(os.path.join(partial_dir, "chunk-*.npz"))):
+        with np.load(path, allow_pickle=False) as data:
+            features = {name[len("f_"):]: data[name] for name in data.files if name.startswith("f_")}
+            for row, (product_id, key) in enumerate(zip(data["product_ids"], data["image_keys"])):
+                store.put(str(product_id), str(key), {name: values[row] for name, values in features.items()})
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_DB_URL", MONGO_DB_URL))
+    parser.add_argument("--database", default="smartwear")
+    parser.add_argument("--index-dir", default=IMAGE_INDEX_DIR)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="encoder processes (default: one per core)")
+    parser.add_argument("--chunk-size", type=int, default=256,
+                        help="images per work unit; finished units survive interruption")
+    parser.add_argument("--include-pending", action="store_true",
+                        help="index every product that is not disapproved, as the API does")
+    parser.add_argument("--limit", type=int, default=0, help="only index the first N products")
+    parser.add_argument("--backend", choices=CLIP_BACKENDS, default=CLIP_BACKEND,
+                        help="CLIP image encoder backend (see scripts/bench_clip_backends.py)")
+    args = parser.parse_args()
+
+    query = {"status": {"$ne": "disapproved"}} if args.include_pending else {"status": "approved"}
+    client = MongoClient(args.mongo_uri)
+    catalog_read_at = time.time()
+    cursor = client[args.database].products.find(query).sort("_id", 1)
+    if args.limit:
+        cursor = cursor.limit(args.limit)
+    products = [product for product in cursor if product.get("image_url")]
+    print(f"Found {len(products)} products with images")
+
+    store = EmbeddingStore(args.index_dir, CLIP_MODEL_NAME, PREPROCESSING_VERSION)
+    print(f"Embedding store has {store.load()} cached products")
+    partial_dir = os.path.join(args.index_dir, "partial")
+    os.makedirs(partial_dir, exist_ok=True)
+    print(f"Resuming {_load_partials(partial_dir, store)} products from an interrupted run")
+
+    catalog = [(str(product["_id"]), image_key(product["image_url"]), product) for product in products]
+    to_encode = [
+        (product_id, key, product["image_url"]) for product_id, key, product in catalog
+        if store.get(product_id, key, INDEX_FEATURES) is None
+    ]
+    chunks = [to_encode[start:start + args.chunk_size] for start in range(0, len(to_encode), args.chunk_size)]
+    workers = max(1, min(args.workers, len(chunks)))
+    print(f"Encoding {len(to_encode)} images in {len(chunks)} chunks with {workers} worker processes")
+
+    started = time.perf_counter()
+    attempted = encoded = 0
+    if chunks:
+        torch_threads = max(1, (os.cpu_count() or 1) // workers)
+        init_args = (torch_threads, args.backend, args.index_dir)
+        with multiprocessing.get_context("spawn").Pool(workers, _init_worker, init_args) as pool:
+            for done, features, chunk_size in pool.imap_unordered(_encode_chunk, chunks):
+                if done:
+                    _save_partial(partial_dir, done, features)
+                    for row, (product_id, key) in enumerate(done):
+                        store.put(product_id, key, {name: values[row] for name, values in features.items()})
+                attempted += chunk_size
+                encoded += len(done)
+                elapsed = time.perf_counter() - started
+                print(f"Encoded {encoded}/{len(to_encode)} images "
+                      f"({attempted - encoded} failed, {encoded / elapsed:.1f} images/sec)")
+    elapsed = time.perf_counter() - started
+
+    valid = [
+        (product_id, key, product, store.get(product_id, key, INDEX_FEATURES))
+        for product_id, key, product in catalog
+    ]
+    valid = [item for item in valid if item[3] is not None]
+    if not valid:
+        print("No products could be indexed")
+        return 1
+    product_ids = [product_id for product_id, _, _, _ in valid]
+    # A running API may be writing the same files; take the same locks it does
+    store_lock = FileLock(args.index_dir, STORE_LOCK)
+    store_lock.acquire()
+    try:
+        # Re-read the store so rows the API wrote meanwhile (e.g. pending
+        # products, which this build may leave out) are kept alongside ours
+        for product_id, key, _, features in valid:
+            store.put(product_id, key, features)
+        store.load()
+        rebuilt = set(product_ids)
+        store.save(product_ids + [product_id for product_id in store.product_ids() if product_id not in rebuilt])
+    finally:
+        store_lock.release()
+
+    embeddings = np.stack([features["embedding"] for _, _, _, features in valid]).astype(np.float32)
+    vector_index = build_vector_index(
+        embeddings, VECTOR_INDEX_TYPE, min_ivf_size=IVF_MIN_SIZE, nlist=IVF_NLIST,
+        nprobe=IVF_NPROBE, dtype=EMBEDDING_DTYPE,
+    )
+    build_lock = FileLock(args.index_dir, BUILD_LOCK)
+    build_lock.acquire()
+    try:
+        generation = publish_index(
+            vector_index,
+            encode_product_ids(product_ids),
+            np.stack([features["color_descriptor"] for _, _, _, features in valid]).astype(np.float16),
+            np.stack([features["dominant_hsv"] for _, _, _, features in valid]).astype(np.float32),
+            ProductAttributes.from_products([product for _, _, product, _ in valid]),
+            index_dir=args.index_dir,
+            image_keys=np.array([key for _, key, _, _ in valid], dtype="U40"),
+            source="build_image_index",
+            full_build=True,
+            catalog_read_at=catalog_read_at,
+            encoder=args.backend,
+            catalog_query="approved" if not args.include_pending else "not disapproved",
+            encode_seconds=round(elapsed, 1),
+            images_per_second=round(encoded / elapsed, 2) if elapsed > 0 else None,
+        )
+    finally:
+        build_lock.release()
+    for path in glob.glob(os.path.join(partial_dir, "chunk-*.npz")):
+        os.remove(path)
+
+    print(f"Published generation {generation}: {len(valid)} products, "
+          f"{encoded} encoded in {elapsed:.1f}s"
+          + (f" ({encoded / elapsed:.1f} images/sec)" if encoded and elapsed > 0 else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
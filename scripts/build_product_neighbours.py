@@ -0,0 +1,79 @@
+"""Precompute the "similar items" list of every product.
+
+Loads the published image search index generation (see
+scripts/build_image_index.py), scores every product against the catalog in
+batches, and writes the top neighbours of each product to the
+product_neighbours collection, which GET /products/{id}/similar reads.
+Needs numpy and pymongo only; the API keeps the lists current afterwards
+as products are added, approved or disapproved.
+
+    python scripts/build_product_neighbours.py
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "back-end")
+sys.path.insert(0, BACKEND_DIR)
+
+from pymongo import MongoClient  # noqa: E402
+
+from app.database import MONGO_DB_URL  # noqa: E402
+from app.schemas.imagesearch import ImageSearchFilters  # noqa: E402
+from app.services.index_artifact import load_generation, read_current  # noqa: E402
+from app.services.product_filters import ProductAttributes  # noqa: E402
+from app.services.product_neighbours import (  # noqa: E402
+    NEIGHBOUR_COUNT, NEIGHBOURS_COLLECTION, batched_upserts, neighbour_documents,
+)
+from app.services.vector_index import load_vector_index  # noqa: E402
+
+DEFAULT_INDEX_DIR = os.getenv("IMAGE_INDEX_DIR", os.path.join(BACKEND_DIR, "data", "image_index"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_DB_URL", MONGO_DB_URL))
+    parser.add_argument("--database", default="smartwear")
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR)
+    parser.add_argument("--generation", help="index generation to use (default: the current one)")
+    parser.add_argument("--k", type=int, default=NEIGHBOUR_COUNT, help="neighbours stored per product")
+    args = parser.parse_args()
+
+    generation = args.generation or read_current(args.index_dir)
+    if generation is None:
+        print(f"No published index generation in {args.index_dir}; run build_image_index.py first")
+        return 1
+    manifest, arrays = load_generation(args.index_dir, generation)
+    vector_index = load_vector_index(manifest["kind"], arrays, manifest["dtype"])
+    attributes = ProductAttributes.from_arrays(arrays, manifest["attribute_vocab"])
+    product_ids = arrays["product_ids"]
+    # Only approved products are recommended
+    candidates = attributes.mask(ImageSearchFilters())
+    rows = np.arange(len(vector_index))
+    print(f"Computing {args.k} neighbours for {len(rows)} products from generation {generation}")
+
+    collection = MongoClient(args.mongo_uri)[args.database][NEIGHBOURS_COLLECTION]
+    collection.create_index("neighbours.product_id")
+    started_at = datetime.utcnow()
+    started = time.perf_counter()
+    written = 0
+    documents = neighbour_documents(
+        vector_index, product_ids, rows, candidates, k=args.k,
+        model=manifest["model"], generation=generation,
+    )
+    for batch in batched_upserts(documents):
+        collection.bulk_write(batch, ordered=False)
+        written += len(batch)
+        elapsed = time.perf_counter() - started
+        print(f"Wrote {written}/{len(rows)} neighbour lists ({written / elapsed:.0f} products/sec)")
+    removed = collection.delete_many({"updated_at": {"$lt": started_at}}).deleted_count
+    print(f"Done in {time.perf_counter() - started:.1f}s; removed {removed} lists of products no longer indexed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,30 @@
 import cloudinary
 import cloudinary.uploader
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from bson.objectid import ObjectId
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 import json
 import os
+import sys
+
+import httpx
+import numpy as np
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "back-end")
+sys.path.insert(0, BACKEND_DIR)
+
+from app.services.image_io import ImageRejected, decode_image  # noqa: E402
+from app.services.index_artifact import list_generations, load_generation, read_current, read_manifest  # noqa: E402
+from app.services.product_dedupe import DuplicateDetector, hash_to_hex  # noqa: E402
+from app.services.search_cache import perceptual_hash  # noqa: E402
+from app.services.vector_index import load_vector_index  # noqa: E402
+
+# Products checked for duplicates and inserted together
+IMPORT_BATCH_SIZE = 64
+# Concurrent image downloads while checking a batch
+DOWNLOAD_CONCURRENCY = 16
+IMAGE_FETCH_TIMEOUT = 10.0
 
 # Configure Cloudinary
 cloudinary.config(
@@ -30,38 +52,157 @@ collection = db["products"]  # Collection name
 #     response = cloudinary.uploader.upload(image_path)
 #     return response.get("url")
 
-# Function to save product data to MongoDB
-def save_product_to_mongo(product):
+# Function to download product images
+def fetch_images(image_urls):
+    """
+    Downloads and decodes images concurrently.
+    :param image_urls: List of image URLs (None entries are skipped).
+    :return: List of PIL images, None where an image could not be fetched.
+    """
+    def fetch(client, image_url):
+        if not image_url:
+            return None
+        try:
+            response = client.get(image_url)
+            response.raise_for_status()
+            return decode_image(response.content)
+        except (httpx.HTTPError, ImageRejected, IOError) as e:
+            print(f"Error fetching image from {image_url}: {e}")
+            return None
+
+    with httpx.Client(timeout=IMAGE_FETCH_TIMEOUT, follow_redirects=True) as client, \
+            ThreadPoolExecutor(DOWNLOAD_CONCURRENCY) as pool:
+        return list(pool.map(lambda image_url: fetch(client, image_url), image_urls))
+
+# Function to give catalog products an image hash
+def backfill_image_hashes(batch_size=IMPORT_BATCH_SIZE):
+    """
+    Stores the perceptual hash of every catalog product image that has none
+    yet, so imports can be checked against the whole catalog.
+    """
+    products = list(collection.find(
+        {"image_url": {"$nin": [None, "", "NA"]}, "image_hash": {"$exists": False}}, {"image_url": 1}
+    ))
+    print(f"Hashing images of {len(products)} catalog products")
+    for start in range(0, len(products), batch_size):
+        batch = products[start:start + batch_size]
+        images = fetch_images([product["image_url"] for product in batch])
+        updates = [
+            UpdateOne({"_id": product["_id"]}, {"$set": {"image_hash": hash_to_hex(perceptual_hash(image))}})
+            for product, image in zip(batch, images) if image is not None
+        ]
+        if updates:
+            collection.bulk_write(updates, ordered=False)
+        print(f"Hashed {start + len(batch)}/{len(products)} catalog images")
+
+# Function to set up CLIP matching
+def load_clip_matcher(detector):
     """
-    Saves product data to MongoDB.
-    :param product: Dictionary containing product data.
-    :return: ID of the inserted MongoDB document.
+    Attaches the published image search index to the detector and returns a
+    function that embeds images with CLIP, or None if torch is not installed.
     """
-    result = collection.insert_one(product)
-    return result.inserted_id
+    try:
+        import torch
+        from app.services.clip_backends import load_clip
+        from app.services.imagesearch_service import CLIP_MODEL_NAME, IMAGE_INDEX_DIR, compatible_manifest
+    except ImportError as e:
+        print(f"CLIP is not available ({e}); matching by image URL and hash only")
+        return None
+    encoder, preprocess = load_clip(CLIP_MODEL_NAME, "cpu", cache_dir=IMAGE_INDEX_DIR)
+    current = read_current(IMAGE_INDEX_DIR)
+    generations = [current] if current else []
+    generations += [generation for generation in reversed(list_generations(IMAGE_INDEX_DIR)) if generation != current]
+    for generation in generations:
+        if compatible_manifest(read_manifest(IMAGE_INDEX_DIR, generation)):
+            manifest, arrays = load_generation(IMAGE_INDEX_DIR, generation)
+            detector.attach_index(load_vector_index(manifest["kind"], arrays, manifest["dtype"]), arrays["product_ids"])
+            print(f"Comparing CLIP embeddings with image index generation {generation} ({manifest['products']} products)")
+            break
+    else:
+        print("No published image index for this model; CLIP only compares imported images with each other")
+
+    def embed(images):
+        with torch.no_grad():
+            embeddings = encoder.encode_image(torch.stack([preprocess(image) for image in images])).float()
+            embeddings /= embeddings.norm(dim=-1, keepdim=True)
+        return embeddings.cpu().numpy()
+
+    return embed
 
 # Function to process products
-def process_products(json_data):
+def process_products(json_data, detector, embed=None, batch_size=IMPORT_BATCH_SIZE, dry_run=False):
     """
-    Processes each product in the JSON data: uploads the image if needed
-    and saves all data to MongoDB.
+    Processes the JSON data in batches: checks each product's image against
+    the catalog and the products imported before it, and saves the products
+    that are not duplicates to MongoDB.
     :param json_data: List of product dictionaries.
+    :param detector: DuplicateDetector loaded with the catalog.
+    :param embed: Optional function returning normalized CLIP embeddings of images.
+    :param dry_run: Only report duplicates, insert nothing.
+    :return: List of duplicates found, with what they duplicate.
     """
-    for product in json_data:
-        try:
+    duplicates = []
+    # Import position of each product by the id it is (or would be) saved under
+    positions = {}
+    inserted = 0
+    for start in range(0, len(json_data), batch_size):
+        batch = json_data[start:start + batch_size]
+        image_urls = []
+        for position, product in enumerate(batch, start):
             # # Upload image to Cloudinary if image_url is missing
             # if not product.get("image_url"):
             #     print(f"Uploading image for product: {product['name']}")
             #     product["image_url"] = upload_to_cloudinary(product["local_image_path"])
-            
+
             # Remove local image path before saving to MongoDB
             product.pop("local_image_path", None)
-            
-            # Save the product to MongoDB
-            document_id = save_product_to_mongo(product)
-            print(f"Product saved with ID: {document_id}")
-        except Exception as e:
-            print(f"Failed to process product: {product['name']}, Error: {e}")
+            product["_id"] = ObjectId()
+            positions[str(product["_id"])] = position
+            image_url = product.get("image_url")
+            image_urls.append(image_url if image_url and image_url != "NA" else None)
+
+        # Images already in the catalog or this import by URL need not be downloaded
+        images = fetch_images([
+            None if image_url in detector.urls or image_urls.index(image_url) < i else image_url
+            for i, image_url in enumerate(image_urls)
+        ])
+        hashes = [perceptual_hash(image) if image is not None else None for image in images]
+        embeddings = None
+        fetched = [i for i, image in enumerate(images) if image is not None]
+        if embed is not None and fetched:
+            found = embed([images[i] for i in fetched])
+            embeddings = np.zeros((len(batch), found.shape[1]), dtype=np.float32)
+            embeddings[fetched] = found
+
+        matches = detector.find_duplicates(
+            [str(product["_id"]) for product in batch], image_urls, hashes, embeddings
+        )
+        to_insert = []
+        for position, (product, image_hash, match) in enumerate(zip(batch, hashes, matches), start):
+            if image_hash is not None:
+                product["image_hash"] = hash_to_hex(image_hash)
+            if match is None:
+                to_insert.append(product)
+                continue
+            if match["duplicate_of"] in positions:
+                match["duplicate_of_import"] = positions[match["duplicate_of"]]
+            duplicates.append({
+                "import_index": position,
+                "name": product.get("name"),
+                "image_url": product.get("image_url"),
+                **match,
+            })
+            print(f"Duplicate product: {product.get('name')} ({match['reason']}, same as {match['duplicate_of']})")
+
+        if to_insert and not dry_run:
+            try:
+                result = collection.insert_many(to_insert, ordered=False)
+                inserted += len(result.inserted_ids)
+            except Exception as e:
+                print(f"Failed to save products {start}-{start + len(batch) - 1}, Error: {e}")
+        print(f"Checked {start + len(batch)}/{len(json_data)} products: "
+              f"{len(duplicates)} duplicates, {inserted} saved")
+    return duplicates
 
 # Function to load JSON data from a file
 def load_json_from_file(file_path):
@@ -75,12 +216,31 @@ def load_json_from_file(file_path):
 
 # Execute the process
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import scraped products, skipping near-duplicates")
+    # Define the path to the JSON file (from another folder)
+    parser.add_argument("file", nargs="?", default=os.path.join("output", "products.json"))
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="report duplicates without inserting anything")
+    parser.add_argument("--no-clip", action="store_true", help="match by image URL and hash only")
+    parser.add_argument("--backfill-hashes", action="store_true",
+                        help="first hash the images of catalog products that have no image_hash")
+    parser.add_argument("--report", default=os.path.join("output", "duplicates.json"),
+                        help="where to write the list of duplicates")
+    args = parser.parse_args()
     try:
-        # Define the path to the JSON file (from another folder)
-        json_file_path = os.path.join("output", "products.json")  # Update this path
-        products_json = load_json_from_file(json_file_path)
-        
+        products_json = load_json_from_file(args.file)
+
+        if args.backfill_hashes:
+            backfill_image_hashes(args.batch_size)
+        detector = DuplicateDetector()
+        detector.add_catalog(list(collection.find({}, {"image_url": 1, "image_hash": 1})))
+        print(f"Catalog has {len(detector.urls)} image URLs, {len(detector.hashes)} with image hashes")
+        embed = None if args.no_clip else load_clip_matcher(detector)
+
         # Process the product data
-        process_products(products_json)
+        duplicates = process_products(products_json, detector, embed, args.batch_size, args.dry_run)
+        with open(args.report, "w", encoding="utf-8") as file:
+            json.dump(duplicates, file, ensure_ascii=False, indent=4)
+        print(f"{len(duplicates)} duplicates {'found' if args.dry_run else 'skipped'}, listed in {args.report}")
     except Exception as e:
         print(f"An error occurred: {e}")
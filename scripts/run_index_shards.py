@@ -0,0 +1,192 @@
+"""Run the image index as local shard processes, e.g. to try sharding on one machine.
+
+Starts one app.services.shard_server process per shard on consecutive local
+ports, all serving the current generation under the index directory, and
+prints the IMAGE_SEARCH_SHARDS value to start the API (or inference server)
+with. Runs until interrupted.
+
+With --check, instead sends sample queries (catalog vectors plus noise) to
+the shards and compares the merged results with the same index searched in
+a single process: recall@k of the sharded top-k, and per-query latency.
+--synthetic publishes a random catalog to a temporary directory first, so
+this needs neither MongoDB nor the CLIP model.
+
+    python scripts/run_index_shards.py --shards 4
+    python scripts/run_index_shards.py --shards 4 --synthetic 200000 --check 200
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "back-end")
+sys.path.insert(0, BACKEND_DIR)
+
+from app.schemas.imagesearch import ImageSearchFilters  # noqa: E402
+from app.services.color_features import COLOR_BINS  # noqa: E402
+from app.services.index_artifact import load_generation, publish_generation, read_current  # noqa: E402
+from app.services.index_shards import ShardedIndex, ShardUnavailable  # noqa: E402
+from app.services.product_filters import ProductAttributes  # noqa: E402
+from app.services.shard_server import IMAGE_INDEX_DIR  # noqa: E402
+from app.services.vector_index import build_vector_index, load_vector_index  # noqa: E402
+
+
+def publish_synthetic(index_dir: str, products: int, kind: str, dtype: str, seed: int) -> str:
+    """Publish a random catalog of clustered unit vectors as a generation."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(products // 100, 1), 512)).astype(np.float32)
+    embeddings = centers[rng.integers(len(centers), size=products)]
+    embeddings += 0.5 * rng.standard_normal(embeddings.shape).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    # ObjectId-like ids: timestamp, random bytes, increasing counter
+    product_ids = np.zeros((products, 12), dtype=np.uint8)
+    product_ids[:, :4] = np.frombuffer(int(time.time()).to_bytes(4, "big"), dtype=np.uint8)
+    product_ids[:, 4:9] = rng.integers(256, size=5, dtype=np.uint8)
+    product_ids[:, 9:] = (np.arange(products, dtype=">u4").view(np.uint8).reshape(-1, 4))[:, 1:]
+    vector_index = build_vector_index(embeddings, kind, min_ivf_size=0, dtype=dtype)
+    colors = rng.dirichlet(np.ones(int(np.prod(COLOR_BINS))), size=products).astype(np.float16)
+    attributes = ProductAttributes.from_products([{"status": "approved"}] * products)
+    rows = np.arange(products)
+    arrays = {
+        **vector_index.to_arrays(rows),
+        "product_ids": product_ids,
+        "color_descriptors": colors,
+        "hsv": rng.uniform(0, 256, size=(products, 3)).astype(np.float32),
+        **attributes.to_arrays(rows),
+    }
+    return publish_generation(index_dir, arrays, {
+        "model": "synthetic",
+        "preprocessing_version": "1",
+        "kind": vector_index.kind,
+        "dtype": vector_index.dtype,
+        "products": products,
+        "attribute_vocab": attributes.vocab,
+        "source": "run_index_shards",
+    })
+
+
+def start_shards(shards: int, base_port: int, index_dir: str):
+    addresses = [f"127.0.0.1:{base_port + shard}" for shard in range(shards)]
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-m", "app.services.shard_server", "--shard", str(shard), "--shards", str(shards),
+             "--address", address, "--index-dir", index_dir],
+            cwd=BACKEND_DIR,
+        )
+        for shard, address in enumerate(addresses)
+    ]
+    return processes, addresses
+
+
+async def connect(index: ShardedIndex, timeout: float):
+    """Wait until every shard has loaded its partition."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return await index.connect()
+        except (ShardUnavailable, ValueError) as e:
+            if time.monotonic() > deadline:
+                raise
+            error = e
+        print(f"Waiting for shards: {error}")
+        await asyncio.sleep(1.0)
+
+
+def percentiles(latencies):
+    return {f"p{p}_ms": float(np.percentile(latencies, p)) for p in (50, 95)}
+
+
+async def check(index: ShardedIndex, index_dir: str, queries: int, k: int, seed: int):
+    """Compare sharded search with the whole generation searched in this process."""
+    manifest, arrays = load_generation(index_dir, read_current(index_dir))
+    single = load_vector_index(manifest["kind"], arrays, manifest["dtype"])
+    filters = ImageSearchFilters()
+    mask = ProductAttributes.from_arrays(arrays, manifest["attribute_vocab"]).mask(filters)
+    rng = np.random.default_rng(seed)
+    sample = single.reconstruct(np.sort(rng.choice(len(single), min(queries, len(single)), replace=False)))
+    sample += 0.05 * rng.standard_normal(sample.shape).astype(np.float32)
+    sample /= np.linalg.norm(sample, axis=1, keepdims=True)
+
+    recalls, sharded_latencies, single_latencies = [], [], []
+    for query in sample:
+        start = time.perf_counter()
+        _, rows = single.search(query, k, mask=mask)
+        single_latencies.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        candidates = (await index.search(query[None, :], k, filters))[0]
+        sharded_latencies.append((time.perf_counter() - start) * 1000)
+        expected = {arrays["product_ids"][row].tobytes() for row in rows[0] if row >= 0}
+        found = {raw.tobytes() for raw in candidates["product_ids"]}
+        recalls.append(len(expected & found) / max(len(expected), 1))
+
+    print(f"{len(sample)} queries, k={k}, {manifest['kind']} index, {manifest['products']} products")
+    print(f"  recall@{k} of sharded vs single-process search: {np.mean(recalls):.4f}")
+    print(f"  single process: {percentiles(single_latencies)}")
+    print(f"  {len(index)} shards:      {percentiles(sharded_latencies)} (partial searches: {index.partial_searches})")
+
+
+async def run(args, index_dir: str, addresses):
+    manifest_model, version = "synthetic", "1"
+    if not args.synthetic:
+        manifest, _ = load_generation(index_dir, read_current(index_dir))
+        manifest_model, version = manifest["model"], manifest.get("preprocessing_version", "1")
+    index = ShardedIndex(addresses, manifest_model, version, timeout=args.timeout)
+    statuses = await connect(index, args.startup_timeout)
+    for address, status in zip(addresses, statuses):
+        print(f"  shard {status['shard']} at {address}: {status['products']} products")
+    if args.check:
+        await check(index, index_dir, args.check, args.k, args.seed)
+        return
+    print(f"IMAGE_SEARCH_SHARDS={','.join(addresses)}")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--shards", type=int, default=2)
+    parser.add_argument("--base-port", type=int, default=8801)
+    parser.add_argument("--index-dir", default=IMAGE_INDEX_DIR)
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="publish this many random products to a temporary index directory first")
+    parser.add_argument("--kind", choices=("exact", "ivf"), default="exact", help="index type for --synthetic")
+    parser.add_argument("--dtype", default="float32", help="embedding storage for --synthetic")
+    parser.add_argument("--check", type=int, default=0, help="queries to compare against single-process search")
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds per shard request")
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    index_dir = args.index_dir
+    temporary = None
+    if args.synthetic:
+        temporary = tempfile.TemporaryDirectory(prefix="image-index-")
+        index_dir = temporary.name
+        generation = publish_synthetic(index_dir, args.synthetic, args.kind, args.dtype, args.seed)
+        print(f"Published synthetic generation {generation} with {args.synthetic} products")
+    elif read_current(index_dir) is None:
+        print(f"No published index generation under {index_dir}; run scripts/build_image_index.py first")
+        return 1
+
+    processes, addresses = start_shards(args.shards, args.base_port, index_dir)
+    try:
+        asyncio.run(run(args, index_dir, addresses))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        if temporary is not None:
+            temporary.cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())